@@ -12,70 +12,419 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import html
+import json
+import logging
 import os
+import re
+import shutil
+import sys
 import time
-import subprocess
+from contextlib import suppress
 from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import psycopg2
+from psycopg2 import sql
 
 # Импортируем конфигурацию напрямую, так как это отдельный скрипт
 import config
 
-def create_backup():
+# Размер куска, которым вывод pg_dump пишется в файл
+CHUNK_SIZE = 1024 * 1024
+
+# progress(записано_байт, прошло_секунд)
+ProgressCallback = Callable[[int, float], Awaitable[None]]
+
+TIMESTAMP_FORMAT = "%Y-%m-%d_%H-%M-%S"
+BACKUP_NAME_RE = re.compile(r"^backup_(?P<db>.+)_(?P<ts>\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})(?:\.dump|\.sql)?$")
+
+
+def human_size(size: float) -> str:
+    for unit in ("Б", "КБ", "МБ", "ГБ"):
+        if size < 1024 or unit == "ГБ":
+            return f"{size:.0f} {unit}" if unit == "Б" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def _path_size(path: str) -> int:
+    """Размер файла или суммарный размер каталога (для формата directory)."""
+    if os.path.isdir(path):
+        return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def _remove(path: str):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+#=== Манифест: число строк на момент дампа ===
+
+def _manifest_path(backup_path: str) -> str:
+    return backup_path + ".json"
+
+
+def read_manifest(backup_path: str) -> Optional[dict]:
+    try:
+        with open(_manifest_path(backup_path), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_manifest(backup_path: str, manifest: dict):
+    with open(_manifest_path(backup_path), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+
+
+def _count_rows(cursor) -> Dict[str, int]:
+    cursor.execute("SELECT tablename FROM pg_tables WHERE schemaname = 'public' ORDER BY tablename")
+    counts = {}
+    for (table,) in cursor.fetchall():
+        cursor.execute(sql.SQL("SELECT count(*) FROM {}").format(sql.Identifier(table)))
+        counts[table] = cursor.fetchone()[0]
+    return counts
+
+
+def _open_snapshot(db_params: dict):
     """
-    Создает резервную копию базы данных PostgreSQL с помощью pg_dump.
-    Возвращает кортеж (успех: bool, сообщение_или_путь_к_файлу: str).
+    Открывает транзакцию REPEATABLE READ, экспортирует ее снимок для pg_dump --snapshot
+    и считает строки в таблицах. Так дамп и подсчет видят одни и те же данные.
+    Соединение должно оставаться открытым, пока pg_dump не закончит.
+    """
+    conn = psycopg2.connect(**db_params)
+    conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT pg_export_snapshot()")
+        snapshot = cursor.fetchone()[0]
+        counts = _count_rows(cursor)
+    return conn, snapshot, counts
+
+
+def _close_snapshot(conn):
+    with suppress(psycopg2.Error):
+        conn.rollback()
+    conn.close()
+
+
+async def _stream_to_file(process: asyncio.subprocess.Process, path: str, started: float,
+                          progress: Optional[ProgressCallback]):
+    """Пишет stdout pg_dump в файл по мере поступления, не держа дамп в памяти."""
+    written, last_report = 0, started
+    with open(path, "wb") as f:
+        while chunk := await process.stdout.read(CHUNK_SIZE):
+            await asyncio.to_thread(f.write, chunk)
+            written += len(chunk)
+            now = time.monotonic()
+            if progress and now - last_report >= config.BACKUP_PROGRESS_INTERVAL:
+                last_report = now
+                await progress(written, now - started)
+
+
+async def _watch_directory(process: asyncio.subprocess.Process, path: str, started: float,
+                           progress: Optional[ProgressCallback]):
+    """В формате directory pg_dump пишет файлы сам - просто следим за размером каталога."""
+    while True:
+        try:
+            await asyncio.wait_for(process.wait(), config.BACKUP_PROGRESS_INTERVAL)
+            return
+        except asyncio.TimeoutError:
+            if progress:
+                size = await asyncio.to_thread(_path_size, path)
+                await progress(size, time.monotonic() - started)
+
+
+async def create_backup(progress: Optional[ProgressCallback] = None) -> Tuple[bool, str, Optional[dict]]:
+    """
+    Создает сжатую резервную копию базы данных PostgreSQL с помощью pg_dump,
+    не блокируя цикл событий. Формат задается config.BACKUP_FORMAT:
+    custom - один файл .dump, directory - каталог, выгружаемый в BACKUP_JOBS потоков.
+    Возвращает кортеж (успех: bool, путь_или_сообщение_об_ошибке: str,
+    статистика: {"size": байт, "duration": секунд} или None).
     """
     db_config = config.DB_CONFIG
     backup_dir = config.BACKUP_PATH
 
     # Убедимся, что директория для бэкапов существует
-    if not os.path.exists(backup_dir):
-        os.makedirs(backup_dir)
+    os.makedirs(backup_dir, exist_ok=True)
 
     # Формируем имя файла с датой и временем
-    timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    backup_file = os.path.join(backup_dir, f"backup_{db_config['dbname']}_{timestamp}.sql")
+    timestamp = datetime.now().strftime(TIMESTAMP_FORMAT)
+    directory_format = config.BACKUP_FORMAT == "directory"
+    backup_path = os.path.join(backup_dir, f"backup_{db_config['dbname']}_{timestamp}" + ("" if directory_format else ".dump"))
 
-    # Формируем команду для pg_dump
     # Устанавливаем переменную окружения с паролем, чтобы не вводить его в консоли
     pg_password = db_config.get("password")
     env = os.environ.copy()
     if pg_password:
         env["PGPASSWORD"] = pg_password
 
+    # --clean/--if-exists для архивных форматов не нужны: их передают pg_restore
     command = [
         "pg_dump",
         "-h", db_config["host"],
         "-p", db_config["port"],
         "-U", db_config["user"],
         "-d", db_config["dbname"],
-        "-f", backup_file,
-        "--clean", # Добавляет команды DROP перед созданием объектов
-        "--if-exists" # Не выдает ошибку, если объект уже существует
+        "-Z", str(config.BACKUP_COMPRESSION),
     ]
+    if directory_format:
+        command += ["-Fd", "-j", str(config.BACKUP_JOBS), "-f", backup_path]
+    else:
+        # Вывод идет в stdout и сразу пишется в файл
+        command += ["-Fc"]
 
+    started = time.monotonic()
     try:
-        # Запускаем процесс
-        process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = process.communicate()
+        snapshot_conn, snapshot, row_counts = await asyncio.to_thread(_open_snapshot, db_config)
+        command += ["--snapshot", snapshot]
+    except psycopg2.Error as e:
+        # Бэкап все равно нужен, просто проверить его восстановление будет не с чем сравнить
+        logging.warning(f"Не удалось получить снимок базы, бэкап без подсчета строк: {e}")
+        snapshot_conn, row_counts = None, None
 
-        if process.returncode == 0:
-            return True, backup_file
+    try:
+        return await _run_pg_dump(command, env, backup_path, directory_format, started, progress, row_counts)
+    finally:
+        if snapshot_conn is not None:
+            await asyncio.to_thread(_close_snapshot, snapshot_conn)
+
+
+async def _run_pg_dump(command: list, env: dict, backup_path: str, directory_format: bool, started: float,
+                       progress: Optional[ProgressCallback], row_counts: Optional[dict]) -> Tuple[bool, str, Optional[dict]]:
+    """Запускает pg_dump и пишет рядом с готовым бэкапом манифест с числом строк."""
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *command, env=env,
+            stdout=asyncio.subprocess.DEVNULL if directory_format else asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+    except FileNotFoundError:
+        return False, "Ошибка: утилита 'pg_dump' не найдена. Убедитесь, что PostgreSQL установлен на сервере.", None
+
+    # stderr читаем параллельно, иначе pg_dump может встать на переполненном канале
+    stderr_task = asyncio.create_task(process.stderr.read())
+    try:
+        if directory_format:
+            await _watch_directory(process, backup_path, started, progress)
         else:
-            # Если pg_dump вернул ошибку, читаем stderr
-            error_message = stderr.decode("utf-8").strip()
-            return False, f"Ошибка при создании бэкапа: {error_message}"
+            await _stream_to_file(process, backup_path, started, progress)
+        returncode = await process.wait()
+        stderr = await stderr_task
+    except BaseException as e:
+        # Отмена или ошибка записи: останавливаем pg_dump и убираем недописанный бэкап
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        stderr_task.cancel()
+        _remove(backup_path)
+        if not isinstance(e, Exception):
+            raise
+        return False, f"Непредвиденная ошибка: {e}", None
+
+    if returncode != 0:
+        _remove(backup_path)
+        return False, f"Ошибка при создании бэкапа: {stderr.decode('utf-8', 'replace').strip()}", None
+
+    duration = time.monotonic() - started
+    size = await asyncio.to_thread(_path_size, backup_path)
+    stats = {"size": size, "duration": duration}
+    await asyncio.to_thread(_write_manifest, backup_path, {
+        "created_at": int(time.time()), "format": config.BACKUP_FORMAT, **stats, "tables": row_counts,
+    })
+    return True, backup_path, stats
+
 
+#=== Ротация (дед-отец-сын) ===
+
+def list_backups() -> List[Tuple[datetime, str]]:
+    """Бэкапы текущей базы в BACKUP_PATH, от новых к старым."""
+    if not os.path.isdir(config.BACKUP_PATH):
+        return []
+    backups = []
+    for name in os.listdir(config.BACKUP_PATH):
+        match = BACKUP_NAME_RE.match(name)
+        if match and match["db"] == config.DB_CONFIG["dbname"]:
+            backups.append((datetime.strptime(match["ts"], TIMESTAMP_FORMAT), os.path.join(config.BACKUP_PATH, name)))
+    return sorted(backups, reverse=True)
+
+
+def select_retained(backups: List[Tuple[datetime, str]], daily: int, weekly: int, monthly: int) -> set:
+    """
+    Какие бэкапы оставить: самый свежий за каждый из последних daily дней,
+    weekly недель и monthly месяцев. Самый новый бэкап остается всегда.
+    """
+    keep = set()
+    periods = (
+        (lambda created: created.date(), daily),
+        (lambda created: created.isocalendar()[:2], weekly),
+        (lambda created: (created.year, created.month), monthly),
+    )
+    for period_of, limit in periods:
+        seen = set()
+        for created, path in backups:
+            period = period_of(created)
+            if period in seen:
+                continue
+            if len(seen) >= limit:
+                break
+            seen.add(period)
+            keep.add(path)
+    if backups:
+        keep.add(backups[0][1])
+    return keep
+
+
+def apply_retention() -> List[str]:
+    """Удаляет бэкапы, не попавшие под политику хранения. Возвращает удаленные пути."""
+    backups = list_backups()
+    keep = select_retained(backups, config.BACKUP_KEEP_DAILY, config.BACKUP_KEEP_WEEKLY, config.BACKUP_KEEP_MONTHLY)
+    removed = []
+    for _, path in backups:
+        if path not in keep:
+            _remove(path)
+            _remove(_manifest_path(path))
+            removed.append(path)
+    return removed
+
+
+#=== Проверка восстановления ===
+
+def last_verification() -> Optional[dict]:
+    """Самый свежий результат проверки восстановления среди хранящихся бэкапов."""
+    results = [m["verification"] for _, path in list_backups() if (m := read_manifest(path)) and m.get("verification")]
+    return max(results, key=lambda result: result["at"], default=None)
+
+
+def _recreate_database(name: str, drop_only: bool = False):
+    conn = psycopg2.connect(**config.DB_CONFIG)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(sql.SQL("DROP DATABASE IF EXISTS {}").format(sql.Identifier(name)))
+            if not drop_only:
+                cursor.execute(sql.SQL("CREATE DATABASE {}").format(sql.Identifier(name)))
+    finally:
+        conn.close()
+
+
+def _count_database(name: str) -> Dict[str, int]:
+    conn = psycopg2.connect(**{**config.DB_CONFIG, "dbname": name})
+    try:
+        with conn.cursor() as cursor:
+            return _count_rows(cursor)
+    finally:
+        conn.close()
+
+
+async def verify_restore(backup_path: str) -> Tuple[bool, dict]:
+    """
+    Восстанавливает бэкап в отдельную базу config.BACKUP_VERIFY_DB, замеряет время
+    восстановления и сравнивает число строк в каждой таблице с подсчетом из манифеста.
+    Возвращает (успех, отчет); отчет также сохраняется в манифест бэкапа.
+    """
+    scratch_db = config.BACKUP_VERIFY_DB
+    db_config = config.DB_CONFIG
+    if scratch_db == db_config["dbname"]:
+        raise ValueError("BACKUP_VERIFY_DB совпадает с рабочей базой")
+
+    report = {"at": int(time.time()), "backup": os.path.basename(backup_path), "restore_seconds": None,
+              "tables": 0, "mismatches": {}, "error": None}
+    manifest = read_manifest(backup_path) or {}
+    expected = manifest.get("tables")
+
+    env = os.environ.copy()
+    if db_config.get("password"):
+        env["PGPASSWORD"] = db_config["password"]
+    command = [
+        "pg_restore",
+        "-h", db_config["host"],
+        "-p", db_config["port"],
+        "-U", db_config["user"],
+        "-d", scratch_db,
+        "-j", str(config.BACKUP_JOBS),
+        "--no-owner",
+        backup_path,
+    ]
+
+    try:
+        await asyncio.to_thread(_recreate_database, scratch_db)
+        started = time.monotonic()
+        process = await asyncio.create_subprocess_exec(*command, env=env, stdout=asyncio.subprocess.DEVNULL,
+                                                       stderr=asyncio.subprocess.PIPE)
+        _, stderr = await process.communicate()
+        report["restore_seconds"] = round(time.monotonic() - started, 1)
+        if process.returncode != 0:
+            report["error"] = stderr.decode("utf-8", "replace").strip()[-1000:]
+        else:
+            restored = await asyncio.to_thread(_count_database, scratch_db)
+            report["tables"] = len(restored)
+            if expected is None:
+                report["error"] = "В манифесте нет числа строк - сравнивать не с чем"
+            else:
+                for table in sorted(set(expected) | set(restored)):
+                    if expected.get(table) != restored.get(table):
+                        report["mismatches"][table] = [expected.get(table), restored.get(table)]
     except FileNotFoundError:
-        return False, "Ошибка: утилита 'pg_dump' не найдена. Убедитесь, что PostgreSQL установлен на сервере."
-    except Exception as e:
-        return False, f"Непредвиденная ошибка: {e}"
+        report["error"] = "Утилита 'pg_restore' не найдена"
+    except psycopg2.Error as e:
+        report["error"] = f"Ошибка PostgreSQL: {e}"
+    finally:
+        with suppress(psycopg2.Error):
+            await asyncio.to_thread(_recreate_database, scratch_db, True)
+
+    success = report["error"] is None and not report["mismatches"]
+    report["ok"] = success
+    if manifest:
+        manifest["verification"] = report
+        await asyncio.to_thread(_write_manifest, backup_path, manifest)
+    return success, report
+
+
+def format_verification(report: dict) -> str:
+    if report["ok"]:
+        text = (f"✅ Проверка восстановления <code>{report['backup']}</code> пройдена\n"
+                f"Таблиц: {report['tables']}, строки совпадают\n")
+    else:
+        text = f"❌ Проверка восстановления <code>{report['backup']}</code> не пройдена\n"
+        if report["error"]:
+            text += f"<code>{html.escape(report['error'])}</code>\n"
+        for table, (expected, restored) in list(report["mismatches"].items())[:10]:
+            text += f"{table}: ожидалось {expected}, восстановлено {restored}\n"
+    if report["restore_seconds"] is not None:
+        text += f"Время восстановления: {report['restore_seconds']} с"
+    return text
+
+
+async def _print_progress(size: int, elapsed: float):
+    print(f"  записано {human_size(size)} за {elapsed:.0f} с")
+
 
 if __name__ == "__main__":
     # Этот блок позволяет запускать скрипт напрямую из консоли
-    print("Запускаю создание резервной копии...")
-    success, message = create_backup()
-    if success:
-        print(f"✅ Бэкап успешно создан: {message}")
+    # python backup_manager.py [--verify [путь]] [--prune]
+    if "--verify" in sys.argv:
+        args = sys.argv[sys.argv.index("--verify") + 1:]
+        path = args[0] if args and not args[0].startswith("--") else next((p for _, p in list_backups()), None)
+        if path is None:
+            print("❌ Бэкапов не найдено")
+        else:
+            print(f"Проверяю восстановление {path} в базу {config.BACKUP_VERIFY_DB}...")
+            _, report = asyncio.run(verify_restore(path))
+            print(json.dumps(report, ensure_ascii=False, indent=1))
+    elif "--prune" in sys.argv:
+        for path in apply_retention():
+            print(f"Удален: {path}")
     else:
-        print(f"❌ {message}")
+        print("Запускаю создание резервной копии...")
+        success, message, stats = asyncio.run(create_backup(progress=_print_progress))
+        if success:
+            speed = stats["size"] / max(stats["duration"], 0.001)
+            print(f"✅ Бэкап успешно создан: {message}")
+            print(f"   {human_size(stats['size'])} за {stats['duration']:.1f} с ({human_size(speed)}/с)")
+        else:
+            print(f"❌ {message}")
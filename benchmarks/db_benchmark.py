@@ -0,0 +1,216 @@
+# Copyright (C) 2025 smalllbro42
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+Бенчмарк методов Database на синтетических данных разного объема.
+
+Для каждого размера база очищается, заполняется через seed_data и каждый
+метод прогоняется на случайных пользователях/чатах. Результат сохраняется
+в benchmarks/reports/<метка>.json, два отчета можно сравнить через --compare.
+
+Запуск (из корня проекта):
+    python -m benchmarks.db_benchmark --sizes 1000 10000 100000 --label before
+    python -m benchmarks.db_benchmark --compare benchmarks/reports/before.json benchmarks/reports/after.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import time
+from typing import Callable, Dict, List
+
+from db import Database
+from benchmarks.seed_data import bench_db_params, reset_schema, seed
+
+REPORTS_DIR = os.path.join(os.path.dirname(__file__), "reports")
+FIRST_USER_ID = 1_000_000
+
+
+def _percentile(samples: List[float], q: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _measure(fn: Callable[[], object], iterations: int) -> Dict[str, float]:
+    fn()  # прогрев: кеш планов и страниц
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    return {
+        "iterations": iterations,
+        "mean_ms": round(statistics.fmean(samples), 3),
+        "p50_ms": round(_percentile(samples, 0.50), 3),
+        "p95_ms": round(_percentile(samples, 0.95), 3),
+        "max_ms": round(max(samples), 3),
+    }
+
+
+def _prepare_trade(db: Database, user_ids: List[int]) -> int:
+    """Создает готовый к проведению обмен 1 на 1 между двумя случайными игроками с машинами."""
+    while True:
+        initiator_id, partner_id = random.sample(user_ids, 2)
+        initiator_car = db._execute("SELECT car_id FROM garage WHERE user_id = %s LIMIT 1", (initiator_id,), fetch='one')
+        partner_car = db._execute("SELECT car_id FROM garage WHERE user_id = %s LIMIT 1", (partner_id,), fetch='one')
+        if initiator_car and partner_car:
+            break
+    trade_id = db.create_trade(initiator_id, partner_id)
+    db.update_trade_offer(trade_id, initiator_id, [initiator_car['car_id']])
+    db.update_trade_offer(trade_id, partner_id, [partner_car['car_id']])
+    return trade_id
+
+
+def build_cases(db: Database, user_ids: List[int], chat_ids: List[int]) -> tuple:
+    """
+    Набор замеряемых вызовов и очередь заранее подготовленных обменов.
+    Аргументы выбираются случайно на каждой итерации.
+    """
+    user = lambda: random.choice(user_ids)
+    chat = lambda: random.choice(chat_ids)
+    pending_trades: List[int] = []
+
+    def execute_trade():
+        # Подготовка обмена не должна попадать в замер, поэтому она делается заранее
+        trade_id = pending_trades.pop() if pending_trades else _prepare_trade(db, user_ids)
+        db.execute_trade(trade_id)
+
+    cases = {
+        "get_user": lambda: db.get_user(user()),
+        "get_filtered_garage": lambda: db.get_filtered_garage(user(), {}),
+        "get_filtered_garage[duplicates]": lambda: db.get_filtered_garage(user(), {"duplicates": True, "sort_by": "value_desc"}),
+        "get_filtered_garage[search]": lambda: db.get_filtered_garage(user(), {"search_query": "a"}),
+        "get_user_distinct_values": lambda: db.get_user_distinct_values(user(), "brand"),
+        "get_garage_count": lambda: db.get_garage_count(user()),
+        "get_collection_value": lambda: db.get_collection_value(user()),
+        "get_all_user_duplicates": lambda: db.get_all_user_duplicates(user()),
+        "get_tire_log_page": lambda: db.get_tire_log_page(user()),
+        "get_group_leaderboard": lambda: db.get_group_leaderboard(chat()),
+        "get_users_for_notification_check": db.get_users_for_notification_check,
+        "get_total_users": db.get_total_users,
+        "get_total_cars_in_game": db.get_total_cars_in_game,
+        "get_total_tires": db.get_total_tires,
+        "get_rarity_distribution": db.get_rarity_distribution,
+        "rollup_stats": db.rollup_stats,
+        "get_latest_stats": db.get_latest_stats,
+        "execute_trade": execute_trade,
+    }
+    return cases, pending_trades
+
+
+def run_size(db: Database, users: int, args) -> Dict[str, object]:
+    print(f"=== {users} пользователей ===")
+    reset_schema(db)
+    random.seed(args.seed)
+    seed_started = time.perf_counter()
+    counts = seed(
+        db, users, args.cars_per_user,
+        chats=max(1, users // 200),
+        tire_logs_per_user=args.tire_logs_per_user,
+        trades=users // 10,
+        first_user_id=FIRST_USER_ID,
+    )
+    seed_seconds = time.perf_counter() - seed_started
+
+    user_ids = list(range(FIRST_USER_ID, FIRST_USER_ID + users))
+    chat_ids = [row['chat_id'] for row in db._execute("SELECT chat_id FROM chats", fetch='all')]
+    cases, pending_trades = build_cases(db, user_ids, chat_ids)
+    if args.only:
+        cases = {name: fn for name, fn in cases.items() if name.split("[")[0] in args.only}
+    if "execute_trade" in cases:
+        pending_trades.extend(_prepare_trade(db, user_ids) for _ in range(args.iterations + 1))
+
+    results = {}
+    for name, fn in cases.items():
+        # Тяжелые агрегаты по всей базе гоняем реже
+        iterations = max(3, args.iterations // 10) if name.startswith(("get_total", "get_rarity", "get_users_for")) else args.iterations
+        results[name] = _measure(fn, iterations)
+        print(f"  {name:<36} p50 {results[name]['p50_ms']:>9.2f} ms   p95 {results[name]['p95_ms']:>9.2f} ms")
+
+    return {"users": users, "rows": counts, "seed_seconds": round(seed_seconds, 1), "methods": results}
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(old_path: str, new_path: str):
+    """Печатает изменение p50/p95 по каждому методу и размеру между двумя отчетами."""
+    with open(old_path, encoding="utf-8") as f:
+        old = {run["users"]: run for run in json.load(f)["runs"]}
+    with open(new_path, encoding="utf-8") as f:
+        new = {run["users"]: run for run in json.load(f)["runs"]}
+
+    for users in sorted(set(old) & set(new)):
+        print(f"=== {users} пользователей ===")
+        old_methods, new_methods = old[users]["methods"], new[users]["methods"]
+        for name in sorted(set(old_methods) & set(new_methods)):
+            line = f"  {name:<36}"
+            for key in ("p50_ms", "p95_ms"):
+                before, after = old_methods[name][key], new_methods[name][key]
+                change = (after - before) / before * 100 if before else 0.0
+                line += f" {key[:3]} {before:>8.2f} -> {after:>8.2f} ms ({change:+6.1f}%)"
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк методов Database на синтетических данных")
+    parser.add_argument("--dbname", default="carbot_bench", help="тестовая база (будет очищена!)")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000], help="число пользователей")
+    parser.add_argument("--cars-per-user", type=float, default=60)
+    parser.add_argument("--tire-logs-per-user", type=float, default=20)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--only", nargs="+", help="замерить только указанные методы")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--label", default=None, help="имя отчета (по умолчанию - дата и ревизия)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="сравнить два отчета и выйти")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    db = Database(bench_db_params(args.dbname))
+    server_version = db._execute("SHOW server_version", fetch='one')[0]
+    runs = [run_size(db, users, args) for users in args.sizes]
+
+    revision = _git_revision()
+    label = args.label or f"{time.strftime('%Y%m%d-%H%M%S')}-{revision}"
+    report = {
+        "label": label,
+        "git_revision": revision,
+        "created_at": int(time.time()),
+        "python": platform.python_version(),
+        "postgres": server_version,
+        "cars_per_user": args.cars_per_user,
+        "iterations": args.iterations,
+        "seed": args.seed,
+        "runs": runs,
+    }
+    os.makedirs(REPORTS_DIR, exist_ok=True)
+    path = os.path.join(REPORTS_DIR, f"{label}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Отчет сохранен: {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+# Copyright (C) 2025 smalllbro42
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+Локальная заглушка Telegram Bot API для нагрузочных тестов без интернета.
+
+Отвечает на методы, которые использует бот (sendMessage, editMessage*,
+sendPhoto, sendDice, getChatMember, answerCallbackQuery, refundStarPayment,
+getUpdates, setWebhook и т.д.), с настраиваемой задержкой и долей ответов 429.
+Неизвестные методы просто возвращают True.
+
+Апдейты из очереди отдаются через getUpdates, а после setWebhook - как у
+Telegram: POST на зарегистрированный URL с секретом в заголовке, не больше
+max_connections запросов одновременно, повтор при ошибке. Пока вебхук
+установлен, getUpdates отвечает 409.
+
+Служебные эндпоинты:
+    POST /_inject  - положить апдейт (или список апдейтов) в очередь
+    GET  /_stats   - счетчики вызовов по методам и ответы вебхука
+
+Запуск (из корня проекта), затем бот с telegram_api_server=http://127.0.0.1:8081:
+    python -m benchmarks.fake_api --port 8081 --latency-ms 40 --jitter-ms 20 --rate-429 0.01
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter, defaultdict, deque
+from typing import Any, Dict, Optional, Set
+
+import aiohttp
+from aiohttp import web
+
+BOT_USER = {"id": 42, "is_bot": True, "first_name": "CarCollect", "username": "carcollect_fake_bot"}
+DICE_MAX_VALUE = {"🎲": 6, "🎯": 6, "🎳": 6, "🏀": 5, "⚽": 5, "🎰": 64}
+
+
+class FakeBotAPI:
+    """
+    Имитация Bot API. latency_ms/jitter_ms - задержка каждого ответа,
+    rate_429 - доля случайных ответов Too Many Requests, per_chat_limit -
+    сколько сообщений в секунду можно отправить в один чат (0 - без лимита).
+    """
+    def __init__(self, latency_ms: float = 0, jitter_ms: float = 0, rate_429: float = 0.0,
+                 retry_after: int = 1, per_chat_limit: int = 0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.per_chat_limit = per_chat_limit
+        self.calls = Counter()
+        self.rejected = Counter()
+        self.updates: asyncio.Queue = asyncio.Queue()
+        # {"url", "secret_token", "max_connections"} после setWebhook
+        self.webhook: Optional[Dict[str, Any]] = None
+        # HTTP-статусы ответов вебхука, 0 - не удалось подключиться
+        self.webhook_responses = Counter()
+        self._message_ids = itertools.count(1)
+        self._chat_sends: Dict[Any, deque] = defaultdict(deque)
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._pusher: Optional[asyncio.Task] = None
+        self._deliveries: Set[asyncio.Task] = set()
+
+    def make_app(self) -> web.Application:
+        app = web.Application(client_max_size=50 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self._handle_method)
+        app.router.add_post("/_inject", self._handle_inject)
+        app.router.add_get("/_stats", self._handle_stats)
+        app.on_cleanup.append(self._on_cleanup)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> tuple:
+        """Запускает сервер в текущем цикле событий. Возвращает (runner, base_url)."""
+        runner = web.AppRunner(self.make_app(), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        real_port = site._server.sockets[0].getsockname()[1]
+        return runner, f"http://{host}:{real_port}"
+
+    # --- Служебные эндпоинты ---
+
+    async def _handle_inject(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        for update in payload if isinstance(payload, list) else [payload]:
+            self.updates.put_nowait(update)
+        return web.json_response({"ok": True, "queued": self.updates.qsize()})
+
+    async def _handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({"calls": dict(self.calls), "rejected_429": dict(self.rejected),
+                                  "webhook_responses": dict(self.webhook_responses)})
+
+    async def _on_cleanup(self, app: web.Application):
+        self._stop_pushing()
+        for task in list(self._deliveries):
+            task.cancel()
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+    # --- Доставка на вебхук ---
+
+    async def _deliver(self, update: Dict[str, Any]) -> int:
+        """Отправляет один апдейт на вебхук. Возвращает HTTP-статус ответа (0 - нет соединения)."""
+        headers = {}
+        if self.webhook["secret_token"]:
+            headers["X-Telegram-Bot-Api-Secret-Token"] = self.webhook["secret_token"]
+        try:
+            async with self._session.post(self.webhook["url"], json=update, headers=headers) as response:
+                status = response.status
+        except aiohttp.ClientError:
+            status = 0
+        self.webhook_responses[status] += 1
+        return status
+
+    async def _deliver_until_accepted(self, update: Dict[str, Any]):
+        # Как и Telegram, повторяем апдейт, пока вебхук не ответит 2xx
+        while self.webhook:
+            if 200 <= await self._deliver(update) < 300:
+                return
+            await asyncio.sleep(self.retry_after)
+        # Вебхук удалили - апдейт снова доступен через getUpdates
+        self.updates.put_nowait(update)
+
+    async def _push_updates(self):
+        connections = asyncio.Semaphore(self.webhook["max_connections"])
+        while True:
+            update = await self.updates.get()
+            try:
+                await connections.acquire()
+            except asyncio.CancelledError:
+                self.updates.put_nowait(update)
+                raise
+            task = asyncio.create_task(self._deliver_until_accepted(update))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+            task.add_done_callback(lambda _: connections.release())
+
+    def _stop_pushing(self):
+        # Уже начатые доставки сами вернут апдейт в очередь, если вебхук удален
+        if self._pusher:
+            self._pusher.cancel()
+            self._pusher = None
+
+    # --- Bot API ---
+
+    async def _handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = await self._read_params(request)
+        self.calls[method] += 1
+
+        if method == "getUpdates":
+            if self.webhook:
+                return web.json_response({
+                    "ok": False, "error_code": 409,
+                    "description": "Conflict: can't use getUpdates method while webhook is active; "
+                                   "use deleteWebhook to delete the webhook first",
+                }, status=409)
+            return self._ok(await self._get_updates(params))
+
+        delay = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+
+        if self._should_reject(method, params):
+            self.rejected[method] += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status=429)
+
+        handler = getattr(self, f"_m_{method}", None)
+        return self._ok(handler(params) if handler else True)
+
+    @staticmethod
+    async def _read_params(request: web.Request) -> Dict[str, Any]:
+        # aiogram шлет multipart/form-data, сложные поля закодированы в JSON
+        if request.content_type == "application/json":
+            return await request.json()
+        params = {}
+        for key, value in (await request.post()).items():
+            if isinstance(value, str) and value[:1] in "[{":
+                try:
+                    value = json.loads(value)
+                except ValueError:
+                    pass
+            params[key] = value
+        return params
+
+    def _should_reject(self, method: str, params: Dict[str, Any]) -> bool:
+        if self.rate_429 and random.random() < self.rate_429:
+            return True
+        if self.per_chat_limit and method.startswith("send") and "chat_id" in params:
+            now = time.monotonic()
+            sends = self._chat_sends[params["chat_id"]]
+            while sends and now - sends[0] > 1:
+                sends.popleft()
+            if len(sends) >= self.per_chat_limit:
+                return True
+            sends.append(now)
+        return False
+
+    async def _get_updates(self, params: Dict[str, Any]) -> list:
+        timeout = float(params.get("timeout") or 0)
+        limit = int(params.get("limit") or 100)
+        updates = []
+        try:
+            updates.append(await asyncio.wait_for(self.updates.get(), timeout) if timeout else self.updates.get_nowait())
+        except (asyncio.TimeoutError, asyncio.QueueEmpty):
+            return []
+        while len(updates) < limit and not self.updates.empty():
+            updates.append(self.updates.get_nowait())
+        return updates
+
+    @staticmethod
+    def _ok(result: Any) -> web.Response:
+        return web.json_response({"ok": True, "result": result})
+
+    @staticmethod
+    def _chat(chat_id: Any) -> Dict[str, Any]:
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            # @username канала
+            return {"id": -1000000000001, "type": "channel", "title": str(chat_id), "username": str(chat_id).lstrip("@")}
+        if chat_id > 0:
+            return {"id": chat_id, "type": "private", "first_name": f"Player {chat_id}"}
+        return {"id": chat_id, "type": "supergroup", "title": f"Chat {chat_id}"}
+
+    def _message(self, params: Dict[str, Any], **content) -> Dict[str, Any]:
+        message_id = params.get("message_id")
+        return {
+            "message_id": int(message_id) if message_id else next(self._message_ids),
+            "date": int(time.time()),
+            "chat": self._chat(params.get("chat_id")),
+            "from": BOT_USER,
+            **content,
+        }
+
+    def _photo(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        photo = [{"file_id": "fake-photo", "file_unique_id": "fake-photo", "width": 1280, "height": 720}]
+        return self._message(params, photo=photo, caption=params.get("caption"))
+
+    def _edited(self, params: Dict[str, Any], **content):
+        if params.get("inline_message_id"):
+            return True
+        return self._message(params, **content)
+
+    def _m_getMe(self, params):
+        return {**BOT_USER, "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+
+    def _m_sendMessage(self, params):
+        return self._message(params, text=params.get("text", ""))
+
+    def _m_sendPhoto(self, params):
+        return self._photo(params)
+
+    def _m_sendDocument(self, params):
+        return self._message(params, document={"file_id": "fake-document", "file_unique_id": "fake-document"})
+
+    def _m_sendDice(self, params):
+        emoji = params.get("emoji") or "🎲"
+        return self._message(params, dice={"emoji": emoji, "value": random.randint(1, DICE_MAX_VALUE.get(emoji, 6))})
+
+    def _m_sendInvoice(self, params):
+        return self._message(params, text=params.get("title", ""))
+
+    def _m_editMessageText(self, params):
+        return self._edited(params, text=params.get("text", ""))
+
+    def _m_editMessageCaption(self, params):
+        return self._edited(params, photo=self._photo(params)["photo"], caption=params.get("caption"))
+
+    def _m_editMessageMedia(self, params):
+        return self._edited(params, photo=self._photo(params)["photo"])
+
+    def _m_editMessageReplyMarkup(self, params):
+        return self._edited(params, text="")
+
+    def _m_setWebhook(self, params):
+        self._stop_pushing()
+        self.webhook = {
+            "url": params["url"],
+            "secret_token": params.get("secret_token"),
+            "max_connections": int(params.get("max_connections") or 40),
+        }
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        self._pusher = asyncio.create_task(self._push_updates())
+        return True
+
+    def _m_deleteWebhook(self, params):
+        self._stop_pushing()
+        self.webhook = None
+        return True
+
+    def _m_getWebhookInfo(self, params):
+        return {
+            "url": self.webhook["url"] if self.webhook else "",
+            "has_custom_certificate": False,
+            "pending_update_count": self.updates.qsize(),
+            "max_connections": self.webhook["max_connections"] if self.webhook else None,
+        }
+
+    def _m_getChatMember(self, params):
+        user_id = int(params.get("user_id", 0))
+        return {"status": "member", "user": {"id": user_id, "is_bot": False, "first_name": f"Player {user_id}"}}
+
+    def _m_getChat(self, params):
+        return {
+            **self._chat(params.get("chat_id")),
+            "accent_color_id": 0,
+            "max_reaction_count": 11,
+            "accepted_gift_types": {
+                "unlimited_gifts": True, "limited_gifts": True, "unique_gifts": True,
+                "premium_subscription": True, "gifts_from_channels": True,
+            },
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушка Telegram Bot API для нагрузочных тестов")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=30)
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--rate-429", type=float, default=0.0, help="доля запросов, получающих 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--per-chat-limit", type=int, default=0, help="сообщений в секунду на чат (0 - без лимита)")
+    args = parser.parse_args()
+
+    api = FakeBotAPI(args.latency_ms, args.jitter_ms, args.rate_429, args.retry_after, args.per_chat_limit)
+    print(f"Fake Bot API: http://{args.host}:{args.port}")
+    web.run_app(api.make_app(), host=args.host, port=args.port, access_log=None, print=None)
+
+
+if __name__ == "__main__":
+    main()
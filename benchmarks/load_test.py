@@ -0,0 +1,333 @@
+# Copyright (C) 2025 smalllbro42
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+Нагрузочный тест бота целиком: тысячи виртуальных игроков кликают по меню.
+
+Диспетчер собирается так же, как в main.py (все middleware и роутеры),
+а все вызовы Bot API уходят в заглушку benchmarks/fake_api.py. По умолчанию
+апдейты подаются напрямую в dp.feed_update. С --transport webhook драйвер
+поднимает вебхук-сервер бота, регистрирует его в заглушке через setWebhook,
+и апдейты приходят к боту HTTP-запросами, как от Telegram. В конце печатаются
+p50/p99 по каждому хендлеру, отчет сохраняется в benchmarks/reports/load-<метка>.json.
+
+С --max-db-queries / --max-api-calls каждый апдейт (режим direct) проверяется
+через assert_max_calls: превышение бюджета попадает в ошибки действия, так что
+взрыв числа запросов виден до выкладки.
+
+Перед запуском залейте тестовую базу (benchmarks.seed_data), игроки
+берутся из того же диапазона user_id. Токен нужен любой синтаксически
+верный, например token=123456:fake.
+
+    python -m benchmarks.load_test --dbname carbot_bench --players 2000 --duration 60
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import statistics
+import time
+from collections import Counter, defaultdict
+from typing import Any, Awaitable, Callable, Dict, List
+
+from aiogram import BaseMiddleware, Dispatcher
+from aiogram.types import TelegramObject, Update
+from aiohttp import web
+
+import config
+import main as bot_main
+from db import Database
+from logic import GameLogic
+from utils import metrics
+from utils.call_budget import assert_max_calls
+from utils.webhook import DrainingRequestHandler
+from benchmarks.fake_api import FakeBotAPI, BOT_USER
+from benchmarks.seed_data import bench_db_params
+
+REPORTS_DIR = os.path.join(os.path.dirname(__file__), "reports")
+WEBHOOK_SECRET = "load-test"
+# Сколько ждать обработки апдейта, пришедшего через вебхук
+WEBHOOK_UPDATE_TIMEOUT = 30
+
+# Переходы между экранами: (callback_data или команда, вес). Команды начинаются с "/"
+ACTIONS = [
+    ("main_menu", 10),
+    ("profile_menu", 8),
+    ("garage_menu", 6),
+    ("garage:view:list", 8),
+    ("garage:view:cards", 5),
+    ("garage:page:1", 6),
+    ("garage:sort:value", 3),
+    ("garage:toggle_duplicates", 3),
+    ("open_case_menu", 8),
+    ("confirm_open_case", 4),
+    ("shop_menu", 6),
+    ("shop_page:1", 2),
+    ("collect_pass_shop_info", 2),
+    ("minigames_menu", 5),
+    ("coin_flip_menu", 3),
+    ("flip:heads", 2),
+    ("roll_dice", 1),
+    ("referral_info", 2),
+    ("/menu", 3),
+]
+
+
+class HandlerTimer(BaseMiddleware):
+    """Собирает длительность каждого вызова хендлера по его имени."""
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        name = data["handler"].callback.__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            self.samples[name].append(time.perf_counter() - started)
+
+
+class UpdateWaiter(BaseMiddleware):
+    """
+    Первый outer-middleware апдейтов в режиме webhook: вебхук отвечает Telegram
+    сразу, а обработка идет в фоне, поэтому игрок ждет здесь, пока апдейт
+    пройдет весь диспетчер.
+    """
+    def __init__(self):
+        self.pending: Dict[int, asyncio.Future] = {}
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        waiter = self.pending.pop(event.update_id, None)
+        try:
+            result = await handler(event, data)
+        except Exception as e:
+            if waiter and not waiter.done():
+                waiter.set_exception(e)
+            raise
+        if waiter and not waiter.done():
+            waiter.set_result(result)
+        return result
+
+
+class Player:
+    """Виртуальный игрок: шлет /start, затем случайно ходит по меню с паузами на «подумать»."""
+    _update_ids = itertools.count(1)
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.message_ids = itertools.count(1)
+        self.user = {"id": user_id, "is_bot": False, "first_name": f"Player {user_id}", "username": f"player_{user_id}"}
+        self.chat = {"id": user_id, "type": "private", "first_name": f"Player {user_id}"}
+
+    def make_update(self, action: str) -> Dict[str, Any]:
+        now = int(time.time())
+        if action.startswith("/"):
+            payload = {"message": {"message_id": next(self.message_ids), "date": now, "chat": self.chat,
+                                   "from": self.user, "text": action}}
+        else:
+            bot_message = {"message_id": next(self.message_ids), "date": now, "chat": self.chat,
+                           "from": BOT_USER, "text": "..."}
+            payload = {"callback_query": {"id": f"{self.user_id}-{next(Player._update_ids)}", "from": self.user,
+                                          "chat_instance": str(self.user_id), "data": action, "message": bot_message}}
+        return {"update_id": next(Player._update_ids), **payload}
+
+
+async def run_player(player: Player, send: Callable[[Dict[str, Any]], Awaitable[Any]], deadline: float,
+                     think_ms: float, latencies: Dict[str, List[float]], errors: Counter):
+    actions, weights = zip(*ACTIONS)
+    action = "/start"
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        try:
+            await send(player.make_update(action))
+        except Exception as e:
+            errors[f"{action}: {type(e).__name__}"] += 1
+        latencies[action].append(time.perf_counter() - started)
+        if think_ms:
+            await asyncio.sleep(random.expovariate(1000 / think_ms))
+        action = random.choices(actions, weights)[0]
+
+
+def _summary(samples: List[float]) -> Dict[str, float]:
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(len(ordered) - 1, round(q * (len(ordered) - 1)))] * 1000
+    return {
+        "count": len(ordered),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 2),
+        "p50_ms": round(pick(0.50), 2),
+        "p99_ms": round(pick(0.99), 2),
+        "max_ms": round(ordered[-1] * 1000, 2),
+    }
+
+
+def _print_table(title: str, rows: Dict[str, Dict[str, float]]):
+    print(f"\n{title}")
+    print(f"  {'':<34}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, row in sorted(rows.items(), key=lambda item: -item[1]["p99_ms"]):
+        print(f"  {name:<34}{row['count']:>8}{row['p50_ms']:>10.1f}{row['p99_ms']:>10.1f}{row['max_ms']:>10.1f}")
+
+
+async def start_webhook(dp: Dispatcher, bot) -> web.AppRunner:
+    """Поднимает вебхук бота на свободном порту (как run_webhook в main.py) и регистрирует его в заглушке."""
+    app = web.Application()
+    DrainingRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=config.WEBHOOK_PATH)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    await bot.set_webhook(
+        url=f"http://127.0.0.1:{port}{config.WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        max_connections=config.WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    return runner
+
+
+async def run(args) -> Dict[str, Any]:
+    api = FakeBotAPI(args.latency_ms, args.jitter_ms, args.rate_429, per_chat_limit=args.per_chat_limit)
+    api_runner = None
+    if args.api_url:
+        config.TELEGRAM_API_SERVER = args.api_url
+    else:
+        api_runner, config.TELEGRAM_API_SERVER = await api.start()
+
+    bot = bot_main.create_bot()
+    dp = Dispatcher()
+    waiter = UpdateWaiter()
+    if args.transport == "webhook":
+        # Раньше остальных middleware: апдейт, отброшенный ими, тоже должен завершиться
+        dp.update.outer_middleware(waiter)
+    db = Database(bench_db_params(args.dbname))
+    logic = GameLogic(db)
+    bot_main.setup_dispatcher(dp, bot, db, logic)
+    timer = HandlerTimer()
+    dp.message.middleware(timer)
+    dp.callback_query.middleware(timer)
+
+    players = [Player(args.first_user_id + i) for i in range(args.players)]
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    errors = Counter()
+
+    async def feed(update: Dict[str, Any]):
+        with assert_max_calls(db_queries=args.max_db_queries, api_calls=args.max_api_calls):
+            await dp.feed_update(bot, Update.model_validate(update))
+
+    async def push(update: Dict[str, Any]):
+        done = asyncio.get_running_loop().create_future()
+        waiter.pending[update["update_id"]] = done
+        api.updates.put_nowait(update)
+        try:
+            await asyncio.wait_for(done, WEBHOOK_UPDATE_TIMEOUT)
+        finally:
+            waiter.pending.pop(update["update_id"], None)
+
+    webhook_runner = None
+    if args.transport == "webhook":
+        webhook_runner = await start_webhook(dp, bot)
+
+    print(f"{args.players} игроков, {args.duration} с, {args.transport}, Bot API: {config.TELEGRAM_API_SERVER}")
+    started = time.monotonic()
+    deadline = started + args.duration
+    try:
+        tasks = []
+        send = push if webhook_runner else feed
+        for player in players:
+            tasks.append(asyncio.create_task(run_player(player, send, deadline, args.think_ms, latencies, errors)))
+            # Игроки подключаются постепенно, а не все в одну миллисекунду
+            await asyncio.sleep(args.ramp_up / max(args.players, 1))
+        await asyncio.gather(*tasks)
+    finally:
+        elapsed = time.monotonic() - started
+        if webhook_runner:
+            await bot.delete_webhook()
+            await webhook_runner.cleanup()
+        await bot.session.close()
+        if api_runner:
+            await api_runner.cleanup()
+
+    total_updates = sum(len(samples) for samples in latencies.values())
+    report = {
+        "players": args.players,
+        "transport": args.transport,
+        "budget": {"db_queries": args.max_db_queries, "api_calls": args.max_api_calls},
+        "duration_s": round(elapsed, 1),
+        "updates": total_updates,
+        "updates_per_second": round(total_updates / elapsed, 1),
+        "api": {"latency_ms": args.latency_ms, "jitter_ms": args.jitter_ms, "rate_429": args.rate_429,
+                "calls": dict(api.calls), "rejected_429": dict(api.rejected),
+                "webhook_responses": dict(api.webhook_responses)},
+        "updates_shed": sum(metrics.UPDATES_SHED._values.values()),
+        "callbacks_deduplicated": sum(metrics.CALLBACKS_DEDUPLICATED._values.values()),
+        "errors": dict(errors),
+        "handlers": {name: _summary(samples) for name, samples in timer.samples.items()},
+        "actions": {name: _summary(samples) for name, samples in latencies.items()},
+    }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с заглушкой Bot API")
+    parser.add_argument("--dbname", default="carbot_bench", help="тестовая база (не рабочая!)")
+    parser.add_argument("--players", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=60, help="секунды")
+    parser.add_argument("--ramp-up", type=float, default=10, help="за сколько секунд подключаются все игроки")
+    parser.add_argument("--think-ms", type=float, default=800, help="средняя пауза игрока между нажатиями")
+    parser.add_argument("--first-user-id", type=int, default=1_000_000)
+    parser.add_argument("--latency-ms", type=float, default=40)
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--per-chat-limit", type=int, default=0)
+    parser.add_argument("--api-url", default=None, help="внешний fake_api вместо встроенного")
+    parser.add_argument("--transport", choices=("direct", "webhook"), default="direct",
+                        help="direct - dp.feed_update, webhook - через вебхук-сервер бота")
+    parser.add_argument("--max-db-queries", type=int, default=None, help="бюджет запросов к БД на апдейт")
+    parser.add_argument("--max-api-calls", type=int, default=None, help="бюджет вызовов Bot API на апдейт")
+    parser.add_argument("--label", default=None)
+    args = parser.parse_args()
+    if args.transport == "webhook" and args.api_url:
+        parser.error("--transport webhook работает только со встроенной заглушкой (без --api-url)")
+    if args.transport == "webhook" and (args.max_db_queries is not None or args.max_api_calls is not None):
+        # Через вебхук апдейт обрабатывается в другой задаче, и счетчик драйвера его не видит
+        parser.error("--max-db-queries / --max-api-calls работают только с --transport direct")
+
+    report = asyncio.run(run(args))
+    _print_table("Хендлеры (время внутри хендлера)", report["handlers"])
+    _print_table("Действия (апдейт целиком, с middleware)", report["actions"])
+    print(f"\nАпдейтов: {report['updates']} ({report['updates_per_second']}/с), "
+          f"отброшено: {report['updates_shed']}, 429: {sum(report['api']['rejected_429'].values())}, "
+          f"ошибок: {sum(report['errors'].values())}")
+
+    os.makedirs(REPORTS_DIR, exist_ok=True)
+    path = os.path.join(REPORTS_DIR, f"load-{args.label or time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Отчет сохранен: {path}")
+
+
+if __name__ == "__main__":
+    main()
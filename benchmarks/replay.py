@@ -0,0 +1,251 @@
+# Copyright (C) 2025 smalllbro42
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+Воспроизведение записанного трафика (config.UPDATE_RECORDING_ENABLED).
+
+Апдейты из recordings/*.jsonl.gz подаются в диспетчер с теми же интервалами,
+что и в жизни (или быстрее в --speed раз), против тестовой базы и заглушки
+Bot API. Игроки, группы и дропы из записи заранее создаются в базе, у новых
+игроков появляется синтетический гараж.
+
+    python -m benchmarks.replay recordings/updates-20250607.jsonl.gz \\
+        --since "2025-06-07 18:00" --until "2025-06-07 19:00" --speed 4 --label saturday-peak
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import random
+import time
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional
+
+from aiogram import Dispatcher
+from aiogram.types import Update
+
+import config
+import main as bot_main
+from db import Database
+from logic import GameLogic
+from utils import metrics
+from benchmarks.fake_api import FakeBotAPI
+from benchmarks.load_test import REPORTS_DIR, HandlerTimer, _print_table, _summary
+from benchmarks.seed_data import _copy, _garage_size, bench_db_params, load_car_pool
+
+EVENT_KEYS = ("message", "callback_query", "edited_message", "pre_checkout_query", "my_chat_member", "chat_member")
+
+
+def _parse_time(value: Optional[str]) -> Optional[float]:
+    return time.mktime(time.strptime(value, "%Y-%m-%d %H:%M")) if value else None
+
+
+def load_records(paths: List[str], since: Optional[float], until: Optional[float]) -> List[Dict[str, Any]]:
+    records = []
+    for path in paths:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                if (since and record["t"] < since) or (until and record["t"] >= until):
+                    continue
+                records.append(record)
+    records.sort(key=lambda r: r["t"])
+    return records
+
+
+def _event(update: Dict[str, Any]) -> Dict[str, Any]:
+    for key in EVENT_KEYS:
+        if key in update:
+            return update[key]
+    return {}
+
+
+def action_name(update: Dict[str, Any]) -> str:
+    """Метка для отчета: префикс callback_data, команда или тип апдейта."""
+    if "callback_query" in update:
+        return (update["callback_query"].get("data") or "").split(":", 1)[0] or "callback"
+    text = update.get("message", {}).get("text", "")
+    if text.startswith("/"):
+        return text.split()[0].split("@")[0]
+    for key in EVENT_KEYS:
+        if key in update:
+            return key
+    return "other"
+
+
+def prepare_database(db: Database, records: List[Dict[str, Any]], cars_per_user: float) -> Dict[str, int]:
+    """Создает в тестовой базе игроков, группы, участников и дропы, которые встречаются в записи."""
+    user_ids, group_ids, members, claims = set(), set(), set(), {}
+    for record in records:
+        event = _event(record["update"])
+        user = event.get("from") or event.get("user")
+        message = event.get("message", event)
+        chat = message.get("chat", {})
+        if user and not user.get("is_bot"):
+            user_ids.add(user["id"])
+        if chat.get("id", 0) < 0:
+            group_ids.add(chat["id"])
+            if user and not user.get("is_bot"):
+                members.add((chat["id"], user["id"]))
+        data = event.get("data") or ""
+        if data.startswith("claim_airdrop:") and data.split(":")[1].isdigit() and chat.get("id"):
+            claims[int(data.split(":")[1])] = (chat["id"], message.get("message_id", 0))
+
+    now = int(time.time())
+    new_users = db._execute(
+        "INSERT INTO users (user_id, created_at, nickname) SELECT u, %s, 'player_' || u FROM unnest(%s::bigint[]) AS u "
+        "ON CONFLICT DO NOTHING RETURNING user_id",
+        (now, list(user_ids)), fetch='all'
+    )
+    cars, cum_weights = load_car_pool()
+    garage_rows = []
+    for row in new_users:
+        for car in random.choices(cars, cum_weights=cum_weights, k=_garage_size(cars_per_user)):
+            garage_rows.append(
+                f"{row['user_id']}\t{car['name']}\t{car['rarity']}\t{car['value']}\t"
+                f"{car.get('brand', 'Неизвестно')}\t{car.get('season', 'Неизвестно')}"
+            )
+    _copy(db, "garage", "user_id, car_name, rarity, value, brand, season", garage_rows)
+
+    db._execute(
+        "INSERT INTO chats (chat_id, title) SELECT c, 'Replay chat' FROM unnest(%s::bigint[]) AS c ON CONFLICT DO NOTHING",
+        (list(group_ids),)
+    )
+    if members:
+        chat_col, user_col = zip(*members)
+        db._execute(
+            "INSERT INTO chat_members (chat_id, user_id) SELECT * FROM unnest(%s::bigint[], %s::bigint[]) ON CONFLICT DO NOTHING",
+            (list(chat_col), list(user_col))
+        )
+    if claims:
+        claim_ids = list(claims)
+        db._execute(
+            "INSERT INTO airdrop_claims (claim_id, chat_id, message_id, created_at) "
+            "SELECT c, ch, m, %s FROM unnest(%s::int[], %s::bigint[], %s::bigint[]) AS t(c, ch, m) ON CONFLICT DO NOTHING",
+            (now, claim_ids, [claims[c][0] for c in claim_ids], [claims[c][1] for c in claim_ids])
+        )
+        # claim_id вставлены явно - сдвигаем последовательность, чтобы новые дропы не конфликтовали
+        db._execute("SELECT setval(pg_get_serial_sequence('airdrop_claims', 'claim_id'), MAX(claim_id)) FROM airdrop_claims")
+        # Повторный прогон той же записи должен снова разыгрывать дропы
+        db._execute("UPDATE airdrop_claims SET claimed_by_user_id = NULL WHERE claim_id = ANY(%s)", (claim_ids,))
+
+    return {"users": len(user_ids), "new_users": len(new_users), "groups": len(group_ids),
+            "chat_members": len(members), "airdrops": len(claims)}
+
+
+async def replay(args) -> Dict[str, Any]:
+    records = load_records(args.files, _parse_time(args.since), _parse_time(args.until))
+    if not records:
+        raise SystemExit("В выбранном интервале нет апдейтов.")
+
+    api = FakeBotAPI(args.latency_ms, args.jitter_ms, args.rate_429, per_chat_limit=args.per_chat_limit)
+    api_runner, config.TELEGRAM_API_SERVER = await api.start()
+    bot = bot_main.create_bot()
+    dp = Dispatcher()
+    db = Database(bench_db_params(args.dbname))
+    logic = GameLogic(db)
+    prepared = prepare_database(db, records, args.cars_per_user)
+    print(f"{len(records)} апдейтов за {records[-1]['t'] - records[0]['t']:.0f} с записи, подготовлено: {prepared}")
+
+    bot_main.setup_dispatcher(dp, bot, db, logic)
+    timer = HandlerTimer()
+    dp.message.middleware(timer)
+    dp.callback_query.middleware(timer)
+
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    lag: List[float] = []
+    errors = Counter()
+    # При --speed 0 апдейты идут без пауз, но не больше concurrency одновременно
+    limiter = asyncio.Semaphore(args.concurrency)
+
+    async def feed(record: Dict[str, Any], scheduled: float):
+        async with limiter:
+            lag.append(max(0.0, time.monotonic() - scheduled))
+            name = action_name(record["update"])
+            started = time.perf_counter()
+            try:
+                await dp.feed_update(bot, Update.model_validate(record["update"]))
+            except Exception as e:
+                errors[f"{name}: {type(e).__name__}"] += 1
+            latencies[name].append(time.perf_counter() - started)
+
+    first_t = records[0]["t"]
+    started = time.monotonic()
+    tasks = []
+    try:
+        for record in records:
+            scheduled = started + ((record["t"] - first_t) / args.speed if args.speed else 0.0)
+            delay = scheduled - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(feed(record, scheduled)))
+        await asyncio.gather(*tasks)
+    finally:
+        elapsed = time.monotonic() - started
+        await bot.session.close()
+        await api_runner.cleanup()
+
+    return {
+        "files": args.files,
+        "since": args.since,
+        "until": args.until,
+        "speed": args.speed,
+        "prepared": prepared,
+        "duration_s": round(elapsed, 1),
+        "updates": len(records),
+        "updates_per_second": round(len(records) / elapsed, 1),
+        "schedule_lag": _summary(lag),
+        "api": {"latency_ms": args.latency_ms, "jitter_ms": args.jitter_ms, "rate_429": args.rate_429,
+                "calls": dict(api.calls), "rejected_429": dict(api.rejected)},
+        "updates_shed": sum(metrics.UPDATES_SHED._values.values()),
+        "callbacks_deduplicated": sum(metrics.CALLBACKS_DEDUPLICATED._values.values()),
+        "errors": dict(errors),
+        "handlers": {name: _summary(samples) for name, samples in timer.samples.items()},
+        "actions": {name: _summary(samples) for name, samples in latencies.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Воспроизведение записанных апдейтов против тестовой базы")
+    parser.add_argument("files", nargs="+", help="файлы recordings/updates-*.jsonl.gz")
+    parser.add_argument("--dbname", default="carbot_bench", help="тестовая база (не рабочая!)")
+    parser.add_argument("--since", help="начало интервала, 'ГГГГ-ММ-ДД ЧЧ:ММ'")
+    parser.add_argument("--until", help="конец интервала, 'ГГГГ-ММ-ДД ЧЧ:ММ'")
+    parser.add_argument("--speed", type=float, default=1.0, help="ускорение (1 - как в жизни, 0 - без пауз)")
+    parser.add_argument("--concurrency", type=int, default=1000, help="максимум одновременно обрабатываемых апдейтов")
+    parser.add_argument("--cars-per-user", type=float, default=60, help="размер гаража для игроков, которых нет в базе")
+    parser.add_argument("--latency-ms", type=float, default=40)
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--per-chat-limit", type=int, default=0)
+    parser.add_argument("--label", default=None)
+    args = parser.parse_args()
+
+    report = asyncio.run(replay(args))
+    _print_table("Хендлеры (время внутри хендлера)", report["handlers"])
+    _print_table("Действия (апдейт целиком, с middleware)", report["actions"])
+    print(f"\nАпдейтов: {report['updates']} ({report['updates_per_second']}/с), "
+          f"отставание от расписания p99: {report['schedule_lag']['p99_ms']} ms, "
+          f"отброшено: {report['updates_shed']}, ошибок: {sum(report['errors'].values())}")
+
+    os.makedirs(REPORTS_DIR, exist_ok=True)
+    path = os.path.join(REPORTS_DIR, f"replay-{args.label or time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Отчет сохранен: {path}")
+
+
+if __name__ == "__main__":
+    main()
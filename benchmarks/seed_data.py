@@ -0,0 +1,202 @@
+# Copyright (C) 2025 smalllbro42
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+Генератор синтетических данных для локальной PostgreSQL.
+
+Создает пользователей, гаражи (машины выпадают с шансами из cars.json),
+историю покрышек, обмены, чаты и участников чатов. Данные заливаются
+через COPY пачками, так что десятки миллионов строк гаража - это минуты.
+
+Запуск (из корня проекта):
+    python -m benchmarks.seed_data --users 100000 --cars-per-user 60 --dbname carbot_bench
+"""
+import argparse
+import io
+import json
+import math
+import random
+import re
+import time
+from typing import Any, Dict, List
+
+import config
+from db import Database
+
+CHUNK_SIZE = 100_000
+NOW = int(time.time())
+TRADE_STATUSES = ["completed"] * 6 + ["cancelled"] * 3 + ["failed", "pending", "active"]
+
+
+def bench_db_params(dbname: str) -> Dict[str, Any]:
+    """Параметры подключения к тестовой базе. Рабочую базу трогать нельзя."""
+    if dbname == config.DB_CONFIG["dbname"]:
+        raise SystemExit(f"Отказ: '{dbname}' - рабочая база из config.DB_CONFIG. Укажите отдельную базу.")
+    return {**config.DB_CONFIG, "dbname": dbname}
+
+
+def load_car_pool(path: str = config.CARS_DATA_PATH) -> tuple:
+    """
+    Возвращает (машины, накопленные веса) так, чтобы random.choices
+    выдавал машины с теми же вероятностями, что и GameLogic.open_case.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        raw = f.read()
+    try:
+        cases = json.loads(raw)
+    except json.JSONDecodeError:
+        # Допускаем висячие запятые, которые встречаются в ручных правках cars.json
+        cases = json.loads(re.sub(r",\s*([}\]])", r"\1", raw))
+
+    case = cases[config.AIRDROP_CASE_NAME]
+    cars, weights = [], []
+    for rarity, chance in case["rarity_chances"].items():
+        of_rarity = [c for c in case["cars"] if c["rarity"] == rarity]
+        if not of_rarity or chance <= 0:
+            continue
+        total_value = sum(c["value"] for c in of_rarity)
+        inner = [total_value - c["value"] for c in of_rarity]
+        if len(of_rarity) == 1 or not any(inner):
+            inner = [1] * len(of_rarity)
+        inner_sum = sum(inner)
+        for car, w in zip(of_rarity, inner):
+            cars.append(car)
+            weights.append(chance * w / inner_sum)
+
+    cum_weights, acc = [], 0.0
+    for w in weights:
+        acc += w
+        cum_weights.append(acc)
+    return cars, cum_weights
+
+
+def _copy(db: Database, table: str, columns: str, rows: List[str]):
+    if not rows:
+        return
+    buffer = io.StringIO("\n".join(rows) + "\n")
+    with db.conn.cursor() as cursor:
+        cursor.copy_expert(f"COPY {table} ({columns}) FROM STDIN", buffer)
+
+
+def _garage_size(mean: float) -> int:
+    # Логнормальное распределение: большинство игроков с небольшим гаражом, немногие - с огромным
+    sigma = 1.0
+    mu = math.log(max(mean, 1)) - sigma ** 2 / 2
+    return int(random.lognormvariate(mu, sigma))
+
+
+def seed(db: Database, users: int, cars_per_user: float, chats: int, tire_logs_per_user: float,
+         trades: int, first_user_id: int = 1_000_000) -> Dict[str, int]:
+    """Заливает синтетические данные и возвращает количество созданных строк по таблицам."""
+    cars, cum_weights = load_car_pool()
+    user_ids = list(range(first_user_id, first_user_id + users))
+    counts = {"users": 0, "garage": 0, "tire_log": 0, "chats": 0, "chat_members": 0, "trades": 0}
+
+    # --- Пользователи, гаражи и история покрышек ---
+    for start in range(0, users, CHUNK_SIZE):
+        chunk = user_ids[start:start + CHUNK_SIZE]
+        user_rows, timer_rows, garage_rows, log_rows = [], [], [], []
+        for user_id in chunk:
+            created_at = NOW - random.randint(0, 365 * 86400)
+            tires = int(random.expovariate(1 / 40))
+            user_rows.append(f"{user_id}\t{created_at}\tplayer_{user_id}\t{tires}")
+            timer_rows.append(f"{user_id}\t{random.randint(0, 5)}\t{NOW - random.randint(0, 86400)}")
+            for car in random.choices(cars, cum_weights=cum_weights, k=_garage_size(cars_per_user)):
+                garage_rows.append(
+                    f"{user_id}\t{car['name']}\t{car['rarity']}\t{car['value']}\t"
+                    f"{car.get('brand', 'Неизвестно')}\t{car.get('season', 'Неизвестно')}"
+                )
+            for _ in range(int(random.expovariate(1 / tire_logs_per_user)) if tire_logs_per_user else 0):
+                amount = random.choice([1, 1, 1, -4, -18, -100, 15, 40])
+                log_rows.append(f"{user_id}\t{amount}\tСинтетическая запись\t{created_at + random.randint(0, NOW - created_at)}")
+
+        _copy(db, "users", "user_id, created_at, nickname, tires", user_rows)
+        _copy(db, "user_timers", "user_id, extra_attempts, last_free_case", timer_rows)
+        _copy(db, "garage", "user_id, car_name, rarity, value, brand, season", garage_rows)
+        _copy(db, "tire_log", "user_id, change_amount, reason, timestamp", log_rows)
+        counts["users"] += len(user_rows)
+        counts["garage"] += len(garage_rows)
+        counts["tire_log"] += len(log_rows)
+        print(f"  users {counts['users']}/{users}, garage {counts['garage']}, tire_log {counts['tire_log']}")
+
+    # --- Групповые чаты: размер по Парето, немного очень больших групп ---
+    chat_rows, member_rows = [], []
+    for i in range(chats):
+        chat_id = -100_000_000_000 - i
+        size = min(users, int(random.paretovariate(1.2) * 10))
+        chat_rows.append(f"{chat_id}\tBench chat {i}\t{'t' if i % 3 == 0 else 'f'}\t0\t{config.DEFAULT_AIRDROP_COOLDOWN}")
+        member_rows.extend(f"{chat_id}\t{user_id}" for user_id in random.sample(user_ids, size))
+    _copy(db, "chats", "chat_id, title, airdrops_enabled, last_airdrop_time, airdrop_cooldown_seconds", chat_rows)
+    _copy(db, "chat_members", "chat_id, user_id", member_rows)
+    counts["chats"], counts["chat_members"] = len(chat_rows), len(member_rows)
+
+    # --- Обмены: предложения собираем из реально существующих машин ---
+    if trades:
+        sample = db._execute(
+            "SELECT car_id, user_id FROM garage TABLESAMPLE SYSTEM (%s) LIMIT %s",
+            (min(100.0, max(0.01, 100.0 * trades * 4 / max(counts["garage"], 1))), trades * 4),
+            fetch='all'
+        )
+        trade_rows = []
+        for i in range(0, len(sample) - 3, 4):
+            a, b = sample[i], sample[i + 2]
+            initiator_offer = json.dumps([a['car_id'], sample[i + 1]['car_id']] if sample[i + 1]['user_id'] == a['user_id'] else [a['car_id']])
+            partner_offer = json.dumps([b['car_id']])
+            trade_rows.append(
+                f"{a['user_id']}\t{b['user_id']}\t{initiator_offer}\t{partner_offer}\t"
+                f"{random.choice(TRADE_STATUSES)}\t{NOW - random.randint(0, 90 * 86400)}"
+            )
+        _copy(db, "trades", "initiator_id, partner_id, initiator_offer, partner_offer, status, created_at", trade_rows)
+        counts["trades"] = len(trade_rows)
+
+    db._execute("ANALYZE")
+    return counts
+
+
+def reset_schema(db: Database):
+    """Полностью очищает тестовую базу и создает таблицы заново."""
+    db._execute("DROP SCHEMA public CASCADE")
+    db._execute("CREATE SCHEMA public")
+    db.setup_database()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Заливка синтетических данных в тестовую базу CarCollect")
+    parser.add_argument("--dbname", default="carbot_bench", help="тестовая база (не рабочая!)")
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--cars-per-user", type=float, default=60, help="среднее число машин в гараже")
+    parser.add_argument("--chats", type=int, default=None, help="по умолчанию users / 200")
+    parser.add_argument("--tire-logs-per-user", type=float, default=20)
+    parser.add_argument("--trades", type=int, default=None, help="по умолчанию users / 10")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--keep", action="store_true", help="не очищать базу перед заливкой")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    db = Database(bench_db_params(args.dbname))
+    if not args.keep:
+        reset_schema(db)
+
+    started = time.perf_counter()
+    counts = seed(
+        db, args.users, args.cars_per_user,
+        chats=args.chats if args.chats is not None else max(1, args.users // 200),
+        tire_logs_per_user=args.tire_logs_per_user,
+        trades=args.trades if args.trades is not None else args.users // 10,
+    )
+    print(f"Готово за {time.perf_counter() - started:.1f} с: {counts}")
+
+
+if __name__ == "__main__":
+    main()
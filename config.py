@@ -27,6 +27,9 @@ ADMIN_IDS = []
 TESTER_IDS = []
 DEVELOPER_USERNAME = "ник разраба"
 CHANNEL_ID = "@carcollect_channel"
+# Свой сервер Bot API (локальный telegram-bot-api или benchmarks/fake_api.py).
+# Пусто - используется api.telegram.org
+TELEGRAM_API_SERVER = os.getenv("telegram_api_server")
 # --- РЕЖИМ ТЕСТИРОВАНИЯ ---
 # Если True, ботом смогут пользоваться только админы из списка ADMIN_IDS и TESTER_IDS
 # Не забудьте поставить False перед запуском для всех!
@@ -40,6 +43,145 @@ DB_CONFIG = {
     "password": os.getenv("serverpassword"),
     "dbname": "carbot_db"
 }
+# Доля заполнения страниц user_timers: свободное место нужно для HOT-обновлений
+USER_TIMERS_FILLFACTOR = 70
+
+#=== Получение апдейтов ===
+# "polling" - long polling (по умолчанию), "webhook" - встроенный aiohttp-сервер
+UPDATE_MODE = os.getenv("update_mode", "polling")
+# Публичный адрес, на который Telegram шлет апдейты (например, https://bot.example.com)
+WEBHOOK_URL = os.getenv("webhook_url")
+WEBHOOK_PATH = "/webhook"
+# Секрет для заголовка X-Telegram-Bot-Api-Secret-Token (обязателен в режиме webhook)
+WEBHOOK_SECRET = os.getenv("webhook_secret")
+# Где слушает локальный сервер (за reverse proxy). Порт можно переопределить для каждого воркера
+WEBHOOK_HOST = "127.0.0.1"
+WEBHOOK_PORT = int(os.getenv("webhook_port", 8080))
+# Сколько одновременных соединений Telegram открывает к вебхуку (1-100)
+WEBHOOK_MAX_CONNECTIONS = 40
+# Сколько секунд при остановке дожидаться уже принятых апдейтов
+WEBHOOK_DRAIN_TIMEOUT = 30
+# Номер процесса при нескольких вебхук-процессах за одним proxy: фоновые задачи
+# (дропы, уведомления, бэкапы, архивация) выполняет только процесс 0,
+# порт метрик - METRICS_PORT + номер. У каждого процесса должен быть свой номер
+WORKER_INDEX = int(os.getenv("worker_index", 0))
+
+#=== Несколько процессов ===
+# Больше 1 - супервизор получает апдейты и раздает их воркерам по user_id
+# (только для режима polling, с webhook бот не запустится). Каждый воркер - отдельный процесс со своим подключением к БД
+WORKERS = int(os.getenv("workers", 1))
+# Сколько секунд воркер дорабатывает принятые апдейты при остановке
+WORKER_DRAIN_TIMEOUT = 30
+
+#=== Хранение состояний FSM ===
+# "postgres" - таблица fsm_states (переживает перезапуск), "memory" - память процесса
+FSM_STORAGE = "postgres"
+FSM_FLUSH_INTERVAL = 2        # секунды: изменения состояний копятся и пишутся в базу одним пакетом
+FSM_CACHE_IDLE = 600          # секунды без обращений, после которых состояние выгружается из памяти
+FSM_STATE_TTL = 7 * 24 * 3600 # состояния, не менявшиеся дольше, удаляются из базы
+
+#=== Защита от двойных нажатий ===
+# Повторное нажатие той же кнопки в том же сообщении в течение окна игнорируется
+CALLBACK_DEDUP_WINDOW = 3  # секунды
+IDEMPOTENT_CALLBACKS = (
+    "confirm_open_case",
+    "open_all_cases",
+    "buy_attempt:",
+    "buy_collect_pass",
+    "craft:do:",
+    "craft:random:",
+    "trade:confirm:",
+)
+
+#=== Приоритеты апдейтов ===
+# Сколько апдейтов каждого класса может обрабатываться одновременно
+UPDATE_PRIORITY_LIMITS = {"high": 100, "normal": 40, "low": 10}
+# Платежи, обмены, дропы и покупки - всегда в приоритете
+HIGH_PRIORITY_CALLBACKS = ("trade:", "claim_airdrop:", "buy_attempt:", "buy_collect_pass", "buy_tires:")
+# Просмотр гаража, списков и истории можно отбросить при перегрузке
+LOW_PRIORITY_CALLBACKS = ("garage:", "group:garage_list", "group:leaderboard", "shop_page:",
+                          "craft:page:", "check_paymod:", "check_tiremod:")
+# Если низкоприоритетный апдейт ждет свободного слота дольше, он отбрасывается
+LOAD_SHED_WAIT = 1.5  # секунды
+
+#=== Метрики ===
+# Локальный HTTP-эндпоинт в формате Prometheus (0 - не запускать)
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9101
+
+#=== Запись трафика ===
+# Если включено, все входящие апдейты с обезличенными id пишутся в
+# UPDATE_RECORDING_DIR/updates-ГГГГММДД.jsonl.gz для benchmarks/replay.py
+UPDATE_RECORDING_ENABLED = False
+UPDATE_RECORDING_DIR = "recordings"
+# Соль для псевдонимов id. Без нее псевдонимы меняются при каждом перезапуске
+UPDATE_RECORDING_SALT = os.getenv("recording_salt")
+
+#=== Рейтинги групп ===
+LEADERBOARD_PAGE_SIZE = 10
+LEADERBOARD_CACHE_TTL = 60       # сколько секунд рейтинг чата отдается из памяти
+LEADERBOARD_MAX_ENTRIES = 100    # сколько мест хранится и листается
+# Общий рейтинг живет в памяти и раз в POLL_INTERVAL секунд подтягивает изменения из user_totals
+GLOBAL_LEADERBOARD_POLL_INTERVAL = 5
+GLOBAL_LEADERBOARD_RESYNC_INTERVAL = 6 * 3600   # полная перестройка
+GLOBAL_LEADERBOARD_NEIGHBOURS = 2                # сколько соседей сверху и снизу показывать
+
+#=== Участники групп ===
+# Раз в MEMBERSHIP_CHECK_INTERVAL секунд проверяется, что бот еще в чатах,
+# и сверяются с Telegram MEMBERSHIP_CHECK_BATCH самых давно проверенных участий
+MEMBERSHIP_CHECK_INTERVAL = 3600
+MEMBERSHIP_CHECK_BATCH = 300
+
+#=== Статистика ===
+# /stats показывает снимок, который раз в STATS_ROLLUP_INTERVAL секунд собирается из счетчиков
+STATS_ROLLUP_INTERVAL = 60
+STATS_ROLLUP_RETENTION = 30 * 24 * 3600   # сколько хранить старые снимки, секунды
+
+#=== Журнал покрышек ===
+# tire_log разбита на секции по месяцам; секции создаются заранее на N месяцев вперед
+TIRE_LOG_PARTITIONS_AHEAD = 2
+TIRE_LOG_RETENTION_MONTHS = 12          # сколько месяцев держать в tire_log (0 - все)
+TIRE_LOG_RETENTION_MODE = "archive"     # "archive" - перенести в схему archive, "drop" - удалить
+TIRE_LOG_MAINTENANCE_INTERVAL = 24 * 3600
+
+#=== Архив ===
+# Завершенные обмены, дропы и закрытые тикеты старше N дней переносятся в archive.batches
+ARCHIVE_INTERVAL = 24 * 3600    # 0 - архивация выключена
+ARCHIVE_AFTER_DAYS = {"trades": 30, "airdrop_claims": 30, "tickets": 90}
+ARCHIVE_BATCH_SIZE = 500
+ARCHIVE_BATCH_PAUSE = 0.2       # пауза между пачками, секунды
+
+#=== Логирование ===
+# Записи кладутся в очередь, а выводом занимается отдельный поток (см. utils/logs.py)
+LOG_LEVEL = os.getenv("log_level", "INFO")
+LOG_FORMAT = os.getenv("log_format", "text")  # "json" - одна запись на строку
+LOG_FILE = os.getenv("log_file")              # не задан - только stderr
+# Доля записей ниже WARNING, которая пишется для шумных логгеров (0 - не писать совсем)
+LOG_SAMPLING = {
+    "aiogram.event": 0.05,               # "Update id=... is handled" на каждый апдейт
+    "carcollect.notifications": 0.1,     # по строке на каждое разосланное уведомление
+}
+
+#=== Контроль блокировок цикла событий ===
+# Задержка цикла замеряется постоянно; если он не отвечает дольше порога,
+# в лог пишется стек с хендлером или фоновой задачей, которая его блокирует
+LOOP_LAG_CHECK_INTERVAL = 0.1   # секунды
+LOOP_STALL_THRESHOLD_MS = 250
+
+#=== Журнал медленных запросов ===
+# Если включено, все запросы дольше порога пишутся в лог,
+# а для части из них снимается план выполнения (EXPLAIN ANALYZE)
+SLOW_QUERY_LOG_ENABLED = False
+SLOW_QUERY_THRESHOLD_MS = 200
+SLOW_QUERY_EXPLAIN_SAMPLE_RATE = 0.2  # доля медленных запросов, для которых снимается план
+SLOW_QUERY_BUFFER_SIZE = 50           # сколько последних планов хранить для /slowlog
+
+#=== Бюджет запросов на один апдейт ===
+# Хендлеры, сделавшие больше запросов к БД / вызовов Telegram API, попадают в лог
+DB_QUERY_BUDGET = 15
+API_CALL_BUDGET = 6
+# Хендлеры, которым по смыслу нужно много запросов (массовые операции)
+CALL_BUDGET_EXEMPT_HANDLERS = ("cq_open_all_cases", "cmd_give", "cmd_broadcast")
 
 #=== Пути к файлам ===
 DB_NAME = "carbot.db" 
@@ -47,6 +189,23 @@ CARS_DATA_PATH = "data/cars.json"
 IMAGES_PATH = "images/"
 BACKUP_PATH = "backups/" 
 
+#=== Резервные копии ===
+# custom - один сжатый файл .dump, directory - каталог, выгружается в BACKUP_JOBS потоков
+BACKUP_FORMAT = "custom"
+BACKUP_JOBS = 4
+BACKUP_COMPRESSION = 6          # уровень сжатия pg_dump -Z
+BACKUP_PROGRESS_INTERVAL = 3    # как часто обновлять сообщение о ходе бэкапа, секунды
+# Автоматические бэкапы (0 - выключены)
+BACKUP_INTERVAL = 24 * 3600
+# Хранение: последний бэкап за каждый из N последних дней / недель / месяцев
+BACKUP_KEEP_DAILY = 7
+BACKUP_KEEP_WEEKLY = 4
+BACKUP_KEEP_MONTHLY = 6
+# Проверка восстановления: свежий бэкап разворачивается в отдельную базу
+# и число строк в таблицах сравнивается с подсчетом на момент дампа
+BACKUP_VERIFY_INTERVAL = 7 * 24 * 3600
+BACKUP_VERIFY_DB = f"{DB_CONFIG['dbname']}_restore_check"
+
 #=== Настройки игровых механик ===
 FREE_CASE_COOLDOWN = 10800
 DICE_COOLDOWN = 604800
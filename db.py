@@ -1,45 +1,141 @@
+import calendar
 import psycopg2
 from psycopg2.extras import DictCursor
+import sys
 import time
+import random
+import re
+import logging
+from collections import deque
 from typing import List, Dict, Any, Optional
 import json
+from contextlib import contextmanager
+
+import config
+from utils import metrics
+from utils.call_budget import count_db_query
+
+# Признаки того, что SELECT что-то меняет или блокирует - такой запрос нельзя повторять через EXPLAIN ANALYZE
+_SIDE_EFFECTS = re.compile(
+    r"\b(INSERT|UPDATE|DELETE|MERGE|RETURNING|PG_ADVISORY\w*|PG_TRY_ADVISORY\w*|SETVAL|NEXTVAL|"
+    r"FOR\s+(UPDATE|SHARE|NO\s+KEY\s+UPDATE|KEY\s+SHARE))\b"
+)
 
 class Database:
     #=== Инициализация и настройка ===
     def __init__(self, db_params: Dict[str, Any]):
+        # Журнал медленных запросов (см. config.SLOW_QUERY_*)
+        self.slow_query_log = config.SLOW_QUERY_LOG_ENABLED
+        self.slow_queries = deque(maxlen=config.SLOW_QUERY_BUFFER_SIZE)
         try:
             self.conn = psycopg2.connect(**db_params)
             self.conn.autocommit = True
-            print("Успешное подключение к PostgreSQL.")
+            logging.info("Успешное подключение к PostgreSQL.")
             self.setup_database()
         except psycopg2.OperationalError as e:
-            print(f"Ошибка подключения к PostgreSQL: {e}")
+            logging.error(f"Ошибка подключения к PostgreSQL: {e}")
             raise
 
+    def close(self):
+        self.conn.close()
+
     def _execute(self, query: str, params: tuple = (), fetch: str = None) -> Any:
-        with self.conn.cursor(cursor_factory=DictCursor) as cursor:
-            cursor.execute(query, params)
-            if fetch == 'one':
-                return cursor.fetchone()
-            if fetch == 'all':
-                return cursor.fetchall()
-            if "RETURNING" in query.upper():
-                return cursor.fetchone()
+        # Имя метода Database, из которого пришел запрос - метка для метрик
+        method = sys._getframe(1).f_code.co_name
+        count_db_query(method)
+        started = time.perf_counter()
+        failed = False
+        try:
+            with self.conn.cursor(cursor_factory=DictCursor) as cursor:
+                cursor.execute(query, params)
+                if fetch == 'one':
+                    return cursor.fetchone()
+                if fetch == 'all':
+                    return cursor.fetchall()
+                if "RETURNING" in query.upper():
+                    return cursor.fetchone()
+                return None
+        except Exception:
+            failed = True
+            metrics.DB_QUERY_ERRORS.inc(method=method)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.DB_QUERY_LATENCY.observe(elapsed, method=method)
+            if self.slow_query_log and elapsed * 1000 >= config.SLOW_QUERY_THRESHOLD_MS:
+                self._log_slow_query(method, query, params, elapsed, failed)
+
+    def _explain_prefix(self, compact_query: str, failed: bool) -> Optional[str]:
+        """
+        Каким EXPLAIN снимать план медленного запроса, или None - не снимать.
+        EXPLAIN ANALYZE выполняет запрос повторно, поэтому он допустим только для
+        обычного SELECT без блокировок и побочных эффектов. Упавшие запросы и запросы
+        внутри _transaction() не трогаем: повтор мог бы взять блокировку или
+        оборвать транзакцию ошибкой.
+        """
+        if failed or self.conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
             return None
+        upper = compact_query.upper()
+        if not upper.startswith(("SELECT", "WITH", "INSERT", "UPDATE", "DELETE")):
+            return None  # DDL, VACUUM, LOCK - у них нет плана
+        if upper.startswith("SELECT") and not _SIDE_EFFECTS.search(upper):
+            return "EXPLAIN (ANALYZE, BUFFERS) "
+        return "EXPLAIN "
+
+    def _log_slow_query(self, method: str, query: str, params: tuple, elapsed: float, failed: bool = False):
+        """Пишет медленный запрос в лог и для части запросов сохраняет план выполнения."""
+        compact_query = " ".join(query.split())
+        logging.warning(f"Slow query in {method}: {elapsed * 1000:.1f} ms | {compact_query} | params={params!r}")
+        if random.random() >= config.SLOW_QUERY_EXPLAIN_SAMPLE_RATE:
+            return
+
+        explain = self._explain_prefix(compact_query, failed)
+        if explain is None:
+            return
+        try:
+            with self.conn.cursor() as cursor:
+                cursor.execute(explain + query, params)
+                plan = "\n".join(row[0] for row in cursor.fetchall())
+        except Exception as e:
+            plan = f"EXPLAIN failed: {e}"
+
+        self.slow_queries.append({
+            "at": int(time.time()),
+            "method": method,
+            "duration_ms": round(elapsed * 1000, 1),
+            "query": compact_query,
+            "params": repr(params),
+            "plan": plan,
+        })
+
+    def get_slow_queries(self) -> List[Dict[str, Any]]:
+        return list(self.slow_queries)
 
     def _column_exists(self, table_name: str, column_name: str) -> bool:
         query = "SELECT 1 FROM information_schema.columns WHERE table_name = %s AND column_name = %s"
         return self._execute(query, (table_name, column_name), fetch='one') is not None
 
+    @contextmanager
+    def _transaction(self):
+        """
+        Явная транзакция поверх autocommit-соединения: все запросы внутри блока
+        выполняются атомарно. В режиме autocommit conn.commit() ничего не делает,
+        поэтому COMMIT/ROLLBACK отправляются обычными командами.
+        """
+        with self.conn.cursor() as cursor:
+            cursor.execute("BEGIN")
+            try:
+                yield
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+            cursor.execute("COMMIT")
+
     def setup_database(self):
         # Users Table
         self._execute('''
         CREATE TABLE IF NOT EXISTS users (
             user_id BIGINT PRIMARY KEY,
-            last_free_case BIGINT DEFAULT 0,
-            last_dice_roll BIGINT DEFAULT 0, 
-            last_coin_flip BIGINT DEFAULT 0,
-            extra_attempts INTEGER DEFAULT 0, 
             tires INTEGER DEFAULT 0,
             is_banned BOOLEAN DEFAULT FALSE, 
             created_at BIGINT DEFAULT 0,
@@ -48,9 +144,7 @@ class Database:
             referrer_id BIGINT, 
             referral_count INTEGER DEFAULT 0,
             collect_pass_active BOOLEAN DEFAULT FALSE,
-            collect_pass_expires_at BIGINT DEFAULT 0,
-            case_notification_sent BOOLEAN DEFAULT FALSE,
-            last_case_notification BIGINT DEFAULT 0
+            collect_pass_expires_at BIGINT DEFAULT 0
         )
         ''')
 
@@ -143,15 +237,6 @@ class Database:
         )
         ''')
         self._execute('''
-        CREATE TABLE IF NOT EXISTS tire_log (
-            log_id SERIAL PRIMARY KEY, 
-            user_id BIGINT NOT NULL REFERENCES users(user_id),
-            change_amount INTEGER NOT NULL, 
-            reason TEXT NOT NULL, 
-            timestamp BIGINT NOT NULL
-        )
-        ''')
-        self._execute('''
         CREATE TABLE IF NOT EXISTS trades (
             trade_id SERIAL PRIMARY KEY, 
             initiator_id BIGINT NOT NULL, 
@@ -166,22 +251,391 @@ class Database:
             partner_message_id BIGINT
         )
         ''')
+
+        # FSM States Table (состояния диалогов, см. utils/fsm_storage.py)
+        self._execute('''
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            storage_key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            updated_at BIGINT NOT NULL
+        )
+        ''')
+        self._execute("CREATE INDEX IF NOT EXISTS idx_fsm_states_updated_at ON fsm_states (updated_at)")
+
+        self._setup_user_timers()
+        self._setup_stat_counters()
+        self._setup_user_totals()
+        self._setup_tire_log()
+        self._setup_archive()
         
         # --- Проверка и обновление существующих таблиц ---
-        if not self._column_exists('users', 'last_case_notification'):
-            print("Обнаружено отсутствие колонки 'last_case_notification' в таблице 'users'. Добавляю...")
-            self._execute("ALTER TABLE users ADD COLUMN last_case_notification BIGINT DEFAULT 0")
-            print("Колонка 'last_case_notification' успешно добавлена.")
-        
         if not self._column_exists('tickets', 'source'):
             self._execute("ALTER TABLE tickets ADD COLUMN source TEXT DEFAULT 'general'")
 
-        if not self._column_exists('users', 'case_notification_sent'):
-            self._execute("ALTER TABLE users ADD COLUMN case_notification_sent BOOLEAN DEFAULT FALSE")
+        # Когда участие последний раз сверялось с Telegram (см. membership_reconciler в main.py)
+        if not self._column_exists('chat_members', 'checked_at'):
+            self._execute("ALTER TABLE chat_members ADD COLUMN checked_at BIGINT NOT NULL DEFAULT 0")
+        self._execute("CREATE INDEX IF NOT EXISTS idx_chat_members_checked_at ON chat_members (checked_at)")
+
+        logging.info("База данных PostgreSQL успешно настроена.")
+
+    def _setup_user_timers(self):
+        """
+        Часто меняющиеся поля игрока (кулдауны, уведомления, доп. попытки) живут
+        в узкой таблице user_timers, а не в широкой строке users. Единственный
+        индекс - первичный ключ, а fillfactor оставляет на странице место,
+        поэтому обновления идут как HOT: без копирования всей строки users
+        и без записи в индексы (в том числе уникальный nickname).
+        """
+        self._execute(f'''
+        CREATE TABLE IF NOT EXISTS user_timers (
+            user_id BIGINT PRIMARY KEY REFERENCES users(user_id) ON DELETE CASCADE,
+            last_free_case BIGINT NOT NULL DEFAULT 0,
+            last_dice_roll BIGINT NOT NULL DEFAULT 0,
+            last_coin_flip BIGINT NOT NULL DEFAULT 0,
+            extra_attempts INTEGER NOT NULL DEFAULT 0,
+            case_notification_sent BOOLEAN NOT NULL DEFAULT FALSE,
+            last_case_notification BIGINT NOT NULL DEFAULT 0
+        ) WITH (fillfactor = {config.USER_TIMERS_FILLFACTOR})
+        ''')
+
+        # Перенос из старой схемы, где эти поля были колонками users
+        with self._transaction():
+            self._execute("SELECT pg_advisory_xact_lock(hashtext('user_timers_migration'))")
+            legacy = [column for column in self.USER_TIMER_COLUMNS if self._column_exists('users', column)]
+            if not legacy:
+                return
+            logging.info(f"Переношу {', '.join(legacy)} из users в user_timers...")
+            self._execute("LOCK TABLE users IN SHARE ROW EXCLUSIVE MODE")
+            values = ", ".join(f"COALESCE({column}, {self.USER_TIMER_COLUMNS[column]})" for column in legacy)
+            self._execute(f'''
+            INSERT INTO user_timers (user_id, {", ".join(legacy)})
+            SELECT user_id, {values} FROM users
+            ON CONFLICT (user_id) DO NOTHING
+            ''')
+            for column in legacy:
+                self._execute(f"ALTER TABLE users DROP COLUMN {column}")
+
+    def _setup_stat_counters(self):
+        """
+        Счетчики для /stats, которые поддерживаются триггерами на users и garage,
+        чтобы статистика не требовала полного прохода по таблицам.
+        Каждый счетчик разбит на 8 строк (shard): параллельные вставки
+        обновляют разные строки и не ждут друг друга.
+        """
+        self._execute('''
+        CREATE TABLE IF NOT EXISTS stat_counters (
+            name TEXT NOT NULL,
+            shard SMALLINT NOT NULL,
+            value BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (name, shard)
+        )
+        ''')
+        # Снимки статистики, которые периодически собирает rollup_stats
+        self._execute('''
+        CREATE TABLE IF NOT EXISTS stats_rollups (
+            taken_at BIGINT PRIMARY KEY,
+            data TEXT NOT NULL
+        )
+        ''')
+        self._execute("CREATE INDEX IF NOT EXISTS idx_users_created_at ON users (created_at)")
+
+        self._execute('''
+        CREATE OR REPLACE FUNCTION bump_stat_counter(counter_name TEXT, delta BIGINT) RETURNS void AS $$
+        BEGIN
+            IF delta <> 0 THEN
+                INSERT INTO stat_counters (name, shard, value)
+                VALUES (counter_name, floor(random() * 8)::smallint, delta)
+                ON CONFLICT (name, shard) DO UPDATE SET value = stat_counters.value + EXCLUDED.value;
+            END IF;
+        END $$ LANGUAGE plpgsql
+        ''')
+        # garage: триггер на оператор - вставка пачки машин (открытие всех кейсов, COPY) дает одно обновление на редкость
+        self._execute('''
+        CREATE OR REPLACE FUNCTION garage_stats() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                PERFORM bump_stat_counter('cars', count(*)) FROM new_rows;
+                PERFORM bump_stat_counter('rarity:' || rarity, count(*)) FROM new_rows GROUP BY rarity;
+            ELSE
+                PERFORM bump_stat_counter('cars', -count(*)) FROM old_rows;
+                PERFORM bump_stat_counter('rarity:' || rarity, -count(*)) FROM old_rows GROUP BY rarity;
+            END IF;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql
+        ''')
+        self._execute('''
+        CREATE OR REPLACE FUNCTION users_stats() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                PERFORM bump_stat_counter('users', 1);
+                PERFORM bump_stat_counter('tires', COALESCE(NEW.tires, 0));
+            ELSIF TG_OP = 'DELETE' THEN
+                PERFORM bump_stat_counter('users', -1);
+                PERFORM bump_stat_counter('tires', -COALESCE(OLD.tires, 0));
+            ELSE
+                PERFORM bump_stat_counter('tires', COALESCE(NEW.tires, 0) - COALESCE(OLD.tires, 0));
+            END IF;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql
+        ''')
+
+        if self._execute("SELECT 1 FROM pg_trigger WHERE tgname = 'garage_stats_insert'", fetch='one'):
+            return
+        # Первая установка: триггеры и начальные значения ставятся под блокировкой,
+        # чтобы ни одна вставка не проскочила между подсчетом и включением триггеров
+        with self._transaction():
+            # Воркеры запускаются одновременно - устанавливает кто-то один, остальные видят готовые триггеры
+            self._execute("SELECT pg_advisory_xact_lock(hashtext('stat_counters_setup'))")
+            if self._execute("SELECT 1 FROM pg_trigger WHERE tgname = 'garage_stats_insert'", fetch='one'):
+                return
+            logging.info("Устанавливаю счетчики статистики и считаю начальные значения...")
+            self._execute("LOCK TABLE users, garage IN SHARE ROW EXCLUSIVE MODE")
+            self._execute("DELETE FROM stat_counters")
+            self._execute("CREATE TRIGGER garage_stats_insert AFTER INSERT ON garage REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION garage_stats()")
+            self._execute("CREATE TRIGGER garage_stats_delete AFTER DELETE ON garage REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION garage_stats()")
+            self._execute("CREATE TRIGGER users_stats_insert_delete AFTER INSERT OR DELETE ON users FOR EACH ROW EXECUTE FUNCTION users_stats()")
+            self._execute("CREATE TRIGGER users_stats_tires AFTER UPDATE OF tires ON users FOR EACH ROW WHEN (OLD.tires IS DISTINCT FROM NEW.tires) EXECUTE FUNCTION users_stats()")
+            self._execute('''
+            INSERT INTO stat_counters (name, shard, value)
+            SELECT 'users', 0, COUNT(*) FROM users
+            UNION ALL SELECT 'tires', 0, COALESCE(SUM(tires), 0) FROM users
+            UNION ALL SELECT 'cars', 0, COUNT(*) FROM garage
+            UNION ALL SELECT 'rarity:' || rarity, 0, COUNT(*) FROM garage GROUP BY rarity
+            ''')
+
+    def _setup_tire_log(self):
+        """
+        tire_log секционирована по месяцам (RANGE по timestamp): свежая история
+        игрока читается из последней секции, а старые месяцы отключаются
+        целиком, без DELETE по всей таблице. Старая несекционированная
+        таблица переносится один раз при первом запуске.
+        """
+        with self._transaction():
+            # Воркеры запускаются одновременно - секциями занимается кто-то один
+            self._lock_tire_log_partitions()
+            table = self._execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('tire_log')", fetch='one')
+            if table is None or table['relkind'] != 'p':
+                self._create_partitioned_tire_log(migrate=table is not None)
+
+        oldest = self._execute("SELECT MIN(timestamp) AS ts FROM tire_log_default", fetch='one')['ts']
+        self._create_tire_log_partitions(int(min(oldest or time.time(), time.time())))
+        self.maintain_tire_log()
+
+    def _create_partitioned_tire_log(self, migrate: bool):
+        self._execute("CREATE SEQUENCE IF NOT EXISTS tire_log_log_id_seq AS BIGINT")
+        if migrate:
+            logging.info("Переношу tire_log в секционированную таблицу...")
+            self._execute("LOCK TABLE tire_log IN ACCESS EXCLUSIVE MODE")
+            self._execute("ALTER TABLE tire_log RENAME TO tire_log_legacy")
+            self._execute("ALTER TABLE tire_log_legacy RENAME CONSTRAINT tire_log_pkey TO tire_log_legacy_pkey")
+            self._execute("ALTER SEQUENCE tire_log_log_id_seq AS BIGINT")
+        self._execute('''
+        CREATE TABLE tire_log (
+            log_id BIGINT NOT NULL DEFAULT nextval('tire_log_log_id_seq'),
+            user_id BIGINT NOT NULL REFERENCES users(user_id),
+            change_amount INTEGER NOT NULL,
+            reason TEXT NOT NULL,
+            timestamp BIGINT NOT NULL,
+            PRIMARY KEY (log_id, timestamp)
+        ) PARTITION BY RANGE (timestamp)
+        ''')
+        self._execute("ALTER SEQUENCE tire_log_log_id_seq OWNED BY tire_log.log_id")
+        self._execute("CREATE TABLE tire_log_default PARTITION OF tire_log DEFAULT")
+        self._execute("CREATE INDEX idx_tire_log_user_timestamp ON tire_log (user_id, timestamp DESC)")
+        if migrate:
+            # Все строки сначала попадают в DEFAULT, по месяцам их разносит _create_tire_log_partitions
+            self._execute('''
+            INSERT INTO tire_log (log_id, user_id, change_amount, reason, timestamp)
+            SELECT log_id, user_id, change_amount, reason, timestamp FROM tire_log_legacy
+            ''')
+            self._execute("DROP TABLE tire_log_legacy")
+
+    def _lock_tire_log_partitions(self):
+        """Блокировка до конца транзакции на изменение набора секций tire_log."""
+        self._execute("SELECT pg_advisory_xact_lock(hashtext('tire_log_partitions'))")
+
+    @staticmethod
+    def _month_start(year: int, month: int) -> int:
+        """Unix-время начала месяца (UTC); month может выходить за 1..12."""
+        year, month = year + (month - 1) // 12, (month - 1) % 12 + 1
+        return calendar.timegm((year, month, 1, 0, 0, 0))
+
+    def _tire_log_partitions(self) -> Dict[str, int]:
+        """Месячные секции tire_log: имя -> начало месяца."""
+        rows = self._execute('''
+        SELECT c.relname AS name FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'tire_log'::regclass AND c.relname ~ '^tire_log_p[0-9]{6}$'
+        ''', fetch='all')
+        return {row['name']: self._month_start(int(row['name'][-6:-2]), int(row['name'][-2:])) for row in rows}
+
+    def _create_tire_log_partitions(self, since: int) -> int:
+        """Создает недостающие секции от месяца since до TIRE_LOG_PARTITIONS_AHEAD месяцев вперед."""
+        existing = self._tire_log_partitions()
+        start, now = time.gmtime(since), time.gmtime()
+        months = (now.tm_year - start.tm_year) * 12 + now.tm_mon - start.tm_mon
+        created = 0
+        for offset in range(months + config.TIRE_LOG_PARTITIONS_AHEAD + 1):
+            lower = self._month_start(start.tm_year, start.tm_mon + offset)
+            upper = self._month_start(start.tm_year, start.tm_mon + offset + 1)
+            name = time.strftime("tire_log_p%Y%m", time.gmtime(lower))
+            if name in existing:
+                continue
+            # Строки этого месяца могли попасть в секцию DEFAULT - переносим их в новую секцию
+            with self._transaction():
+                self._lock_tire_log_partitions()
+                if self._execute("SELECT to_regclass(%s) AS oid", (name,), fetch='one')['oid']:
+                    continue
+                self._execute("CREATE TEMP TABLE tire_log_moved (LIKE tire_log) ON COMMIT DROP")
+                self._execute('''
+                WITH moved AS (DELETE FROM tire_log_default WHERE timestamp >= %s AND timestamp < %s RETURNING *)
+                INSERT INTO tire_log_moved SELECT * FROM moved
+                ''', (lower, upper))
+                self._execute(f"CREATE TABLE {name} PARTITION OF tire_log FOR VALUES FROM ({lower}) TO ({upper})")
+                self._execute("INSERT INTO tire_log SELECT * FROM tire_log_moved")
+            created += 1
+        return created
+
+    def maintain_tire_log(self) -> Dict[str, Any]:
+        """
+        Создает секции на ближайшие месяцы и убирает месяцы старше
+        TIRE_LOG_RETENTION_MONTHS: в режиме "archive" секция отключается от
+        tire_log и переезжает в схему archive, в режиме "drop" удаляется.
+        """
+        created = self._create_tire_log_partitions(int(time.time()))
+        removed = []
+        if config.TIRE_LOG_RETENTION_MONTHS > 0:
+            now = time.gmtime()
+            cutoff = self._month_start(now.tm_year, now.tm_mon - config.TIRE_LOG_RETENTION_MONTHS)
+            for name, month_start in sorted(self._tire_log_partitions().items(), key=lambda item: item[1]):
+                if month_start >= cutoff:
+                    continue
+                with self._transaction():
+                    self._lock_tire_log_partitions()
+                    if name not in self._tire_log_partitions():
+                        continue
+                    self._execute(f"ALTER TABLE tire_log DETACH PARTITION {name}")
+                    if config.TIRE_LOG_RETENTION_MODE == "archive":
+                        self._execute("CREATE SCHEMA IF NOT EXISTS archive")
+                        self._execute(f"ALTER TABLE {name} SET SCHEMA archive")
+                    else:
+                        self._execute(f"DROP TABLE {name}")
+                removed.append(name)
+            if removed:
+                logging.info(f"tire_log: секции {', '.join(removed)} "
+                             f"{'перенесены в схему archive' if config.TIRE_LOG_RETENTION_MODE == 'archive' else 'удалены'}")
+        return {"created": created, "removed": removed}
+
+    def _setup_archive(self):
+        """
+        Архив завершенных обменов, дропов и тикетов (см. archive_batch).
+        Строки переносятся пачками: одна строка archive.batches - одна пачка
+        в виде массива JSONB, который PostgreSQL хранит сжатым (TOAST).
+        """
+        self._execute("CREATE SCHEMA IF NOT EXISTS archive")
+        self._execute('''
+        CREATE TABLE IF NOT EXISTS archive.batches (
+            batch_id BIGSERIAL PRIMARY KEY,
+            source TEXT NOT NULL,
+            first_id BIGINT NOT NULL,
+            last_id BIGINT NOT NULL,
+            row_count INTEGER NOT NULL,
+            oldest_at BIGINT NOT NULL,
+            newest_at BIGINT NOT NULL,
+            archived_at BIGINT NOT NULL,
+            rows JSONB NOT NULL
+        )
+        ''')
+        self._execute("CREATE INDEX IF NOT EXISTS idx_archive_batches_source ON archive.batches (source, first_id)")
+        # /tickets читает только открытые тикеты
+        self._execute("CREATE INDEX IF NOT EXISTS idx_tickets_open ON tickets (created_at) WHERE status = 'open'")
+
+    def _setup_user_totals(self):
+        """
+        Суммарная стоимость и число машин каждого игрока. Поддерживаются
+        триггерами на garage (на оператор, через таблицы переходов), поэтому
+        рейтинги читают одну строку на игрока вместо агрегата по всему гаражу.
+        """
+        self._execute('''
+        CREATE TABLE IF NOT EXISTS user_totals (
+            user_id BIGINT PRIMARY KEY REFERENCES users(user_id) ON DELETE CASCADE,
+            total_value BIGINT NOT NULL DEFAULT 0,
+            car_count INTEGER NOT NULL DEFAULT 0,
+            updated_at BIGINT NOT NULL DEFAULT 0
+        )
+        ''')
+        # Общий рейтинг подтягивает изменения по updated_at (см. utils/leaderboard.py)
+        self._execute("CREATE INDEX IF NOT EXISTS idx_user_totals_updated_at ON user_totals (updated_at)")
+        self._execute('''
+        CREATE OR REPLACE FUNCTION garage_user_totals() RETURNS trigger AS $$
+        DECLARE
+            now_ts BIGINT := extract(epoch FROM now())::bigint;
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                -- Без upsert: при удалении игрока его строка в user_totals уже удалена каскадом
+                UPDATE user_totals t SET total_value = t.total_value - d.total_value,
+                                         car_count = t.car_count - d.car_count, updated_at = now_ts
+                FROM (SELECT user_id, SUM(value) AS total_value, COUNT(*) AS car_count
+                      FROM old_rows GROUP BY user_id) d
+                WHERE t.user_id = d.user_id;
+            ELSIF TG_OP = 'INSERT' THEN
+                INSERT INTO user_totals AS t (user_id, total_value, car_count, updated_at)
+                SELECT user_id, SUM(value), COUNT(*), now_ts FROM new_rows GROUP BY user_id
+                ON CONFLICT (user_id) DO UPDATE SET total_value = t.total_value + EXCLUDED.total_value,
+                                                    car_count = t.car_count + EXCLUDED.car_count,
+                                                    updated_at = EXCLUDED.updated_at;
+            ELSE
+                -- UPDATE (обмен машинами): новому владельцу прибавляем, старому вычитаем
+                INSERT INTO user_totals AS t (user_id, total_value, car_count, updated_at)
+                SELECT user_id, SUM(value), SUM(cars), now_ts FROM (
+                    SELECT user_id, value, 1 AS cars FROM new_rows
+                    UNION ALL
+                    SELECT user_id, -value, -1 FROM old_rows
+                ) d
+                GROUP BY user_id
+                HAVING SUM(value) <> 0 OR SUM(cars) <> 0
+                ON CONFLICT (user_id) DO UPDATE SET total_value = t.total_value + EXCLUDED.total_value,
+                                                    car_count = t.car_count + EXCLUDED.car_count,
+                                                    updated_at = EXCLUDED.updated_at;
+            END IF;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql
+        ''')
 
-        print("База данных PostgreSQL успешно настроена.")
+        if self._execute("SELECT 1 FROM pg_trigger WHERE tgname = 'garage_user_totals_insert'", fetch='one'):
+            return
+        with self._transaction():
+            # Как и для счетчиков статистики: триггеры ставит и начальные суммы считает один воркер
+            self._execute("SELECT pg_advisory_xact_lock(hashtext('user_totals_setup'))")
+            if self._execute("SELECT 1 FROM pg_trigger WHERE tgname = 'garage_user_totals_insert'", fetch='one'):
+                return
+            logging.info("Устанавливаю таблицу user_totals и считаю начальные значения...")
+            self._execute("LOCK TABLE garage IN SHARE ROW EXCLUSIVE MODE")
+            self._execute("DELETE FROM user_totals")
+            self._execute("CREATE TRIGGER garage_user_totals_insert AFTER INSERT ON garage REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION garage_user_totals()")
+            self._execute("CREATE TRIGGER garage_user_totals_update AFTER UPDATE ON garage REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION garage_user_totals()")
+            self._execute("CREATE TRIGGER garage_user_totals_delete AFTER DELETE ON garage REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION garage_user_totals()")
+            self._execute('''
+            INSERT INTO user_totals (user_id, total_value, car_count, updated_at)
+            SELECT user_id, SUM(value), COUNT(*), extract(epoch FROM now())::bigint FROM garage GROUP BY user_id
+            ''')
 
     #=== Users ===
+    # Поля из user_timers и их значения по умолчанию (для игроков без строки в user_timers)
+    USER_TIMER_COLUMNS = {
+        "last_free_case": "0",
+        "last_dice_roll": "0",
+        "last_coin_flip": "0",
+        "extra_attempts": "0",
+        "case_notification_sent": "FALSE",
+        "last_case_notification": "0",
+    }
+    # Игрок целиком, как будто таймеры - колонки users
+    USER_SELECT = "SELECT u.*, " + ", ".join(
+        f"COALESCE(t.{column}, {default}) AS {column}" for column, default in USER_TIMER_COLUMNS.items()
+    ) + " FROM users u LEFT JOIN user_timers t ON t.user_id = u.user_id"
+
     def add_user(self, user_id: int, username: Optional[str], referrer_id: Optional[int] = None) -> bool:
         now = int(time.time())
         if self.get_user(user_id):
@@ -197,17 +651,17 @@ class Database:
             if referrer_id and self.get_user(referrer_id):
                 new_ref_count = self._execute("UPDATE users SET referral_count = referral_count + 1 WHERE user_id = %s RETURNING referral_count", (referrer_id,))['referral_count']
                 if new_ref_count > 0 and new_ref_count % 5 == 0:
-                    self._execute("UPDATE users SET extra_attempts = extra_attempts + 5 WHERE user_id = %s", (referrer_id,))
+                    self.add_extra_attempts(referrer_id, 5)
             return True
         except psycopg2.errors.UniqueViolation:
             self._execute("INSERT INTO users (user_id, created_at, nickname, referrer_id) VALUES (%s, %s, %s, %s) ON CONFLICT (user_id) DO NOTHING", (user_id, now, str(user_id), referrer_id))
             return True
         except Exception as e:
-            print(f"Ошибка при добавлении пользователя {user_id}: {e}")
+            logging.error(f"Ошибка при добавлении пользователя {user_id}: {e}")
             return False
 
     def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
-        return self._execute("SELECT * FROM users WHERE user_id = %s", (user_id,), fetch='one')
+        return self._execute(self.USER_SELECT + " WHERE u.user_id = %s", (user_id,), fetch='one')
     
     def get_all_user_ids(self) -> List[int]:
         rows = self._execute("SELECT user_id FROM users WHERE is_banned = FALSE", fetch='all')
@@ -220,20 +674,25 @@ class Database:
         user = self.get_user(user_id)
         return user.get('last_free_case', 0) if user else 0
 
-    def set_last_free_case_time(self, user_id: int):
-        now = int(time.time())
+    def _set_timers(self, user_id: int, **values):
+        """Записывает поля user_timers, создавая строку игрока при первом обращении."""
+        columns = ", ".join(values)
+        placeholders = ", ".join(["%s"] * len(values))
+        updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in values)
         self._execute(
-            "UPDATE users SET last_free_case = %s, case_notification_sent = FALSE, last_case_notification = 0 WHERE user_id = %s",
-            (now, user_id)
+            f"INSERT INTO user_timers (user_id, {columns}) VALUES (%s, {placeholders}) "
+            f"ON CONFLICT (user_id) DO UPDATE SET {updates}",
+            (user_id, *values.values())
         )
+
+    def set_last_free_case_time(self, user_id: int):
+        now = int(time.time())
+        self._set_timers(user_id, last_free_case=now, case_notification_sent=False, last_case_notification=0)
     
     def update_last_case_notification(self, user_id: int):
         """Обновляет время последнего уведомления о кейсе для пользователя."""
         now = int(time.time())
-        self._execute(
-            "UPDATE users SET last_case_notification = %s, case_notification_sent = TRUE WHERE user_id = %s",
-            (now, user_id)
-        )
+        self._set_timers(user_id, last_case_notification=now, case_notification_sent=True)
 
     def is_nickname_taken(self, nickname: str) -> bool:
         return self._execute("SELECT 1 FROM users WHERE nickname = %s", (nickname,), fetch='one') is not None
@@ -274,43 +733,78 @@ class Database:
 
     def get_users_for_notification_check(self) -> List[Dict[str, Any]]:
         return self._execute(
-            "SELECT user_id, last_free_case, collect_pass_active, collect_pass_expires_at, last_case_notification FROM users WHERE is_banned = FALSE",
+            """
+            SELECT u.user_id, COALESCE(t.last_free_case, 0) AS last_free_case, u.collect_pass_active,
+                   u.collect_pass_expires_at, COALESCE(t.last_case_notification, 0) AS last_case_notification
+            FROM users u LEFT JOIN user_timers t ON t.user_id = u.user_id
+            WHERE u.is_banned = FALSE
+            """,
             fetch='all'
         )
 
     def mark_case_notification_sent(self, user_id: int):
-        self._execute("UPDATE users SET case_notification_sent = TRUE WHERE user_id = %s", (user_id,))
+        self._set_timers(user_id, case_notification_sent=True)
 
     #=== Minigames & Currency ===
     def add_extra_attempts(self, user_id: int, amount: int):
         self._execute(
-            "UPDATE users SET extra_attempts = extra_attempts + %s WHERE user_id = %s",
-            (amount, user_id)
+            "INSERT INTO user_timers AS t (user_id, extra_attempts) VALUES (%s, %s) "
+            "ON CONFLICT (user_id) DO UPDATE SET extra_attempts = t.extra_attempts + EXCLUDED.extra_attempts",
+            (user_id, amount)
         )
 
     def update_dice_roll(self, user_id: int, attempts_won: int):
         now = int(time.time())
         self._execute(
-            "UPDATE users SET last_dice_roll = %s, extra_attempts = extra_attempts + %s WHERE user_id = %s",
-            (now, attempts_won, user_id)
+            "INSERT INTO user_timers AS t (user_id, last_dice_roll, extra_attempts) VALUES (%s, %s, %s) "
+            "ON CONFLICT (user_id) DO UPDATE SET last_dice_roll = EXCLUDED.last_dice_roll, "
+            "extra_attempts = t.extra_attempts + EXCLUDED.extra_attempts",
+            (user_id, now, attempts_won)
         )
     
     def set_last_coin_flip_time(self, user_id: int):
         now = int(time.time())
-        self._execute("UPDATE users SET last_coin_flip = %s WHERE user_id = %s", (now, user_id))
+        self._set_timers(user_id, last_coin_flip=now)
 
-    def change_tires(self, user_id: int, amount: int, reason: str):
-        self._execute("UPDATE users SET tires = tires + %s WHERE user_id = %s", (amount, user_id))
-        self._execute(
-            "INSERT INTO tire_log (user_id, change_amount, reason, timestamp) VALUES (%s, %s, %s, %s)",
-            (user_id, amount, reason, int(time.time()))
+    def change_tires(self, user_id: int, amount: int, reason: str) -> Optional[int]:
+        """Начисляет (или списывает без проверки) покрышки и пишет запись в tire_log. Возвращает новый баланс."""
+        query = """
+        WITH changed AS (
+            UPDATE users SET tires = tires + %s WHERE user_id = %s
+            RETURNING user_id, tires
+        ), logged AS (
+            INSERT INTO tire_log (user_id, change_amount, reason, timestamp)
+            SELECT user_id, %s, %s, %s FROM changed
+        )
+        SELECT tires FROM changed
+        """
+        result = self._execute(query, (amount, user_id, amount, reason, int(time.time())), fetch='one')
+        return result['tires'] if result else None
+
+    def spend_tires(self, user_id: int, amount: int, reason: str) -> Optional[int]:
+        """
+        Списывает amount покрышек, только если их хватает, и пишет запись в tire_log -
+        одним запросом, так что параллельные покупки не уводят баланс в минус.
+        Возвращает новый баланс или None, если покрышек недостаточно.
+        """
+        query = """
+        WITH spent AS (
+            UPDATE users SET tires = tires - %s WHERE user_id = %s AND tires >= %s
+            RETURNING user_id, tires
+        ), logged AS (
+            INSERT INTO tire_log (user_id, change_amount, reason, timestamp)
+            SELECT user_id, %s, %s, %s FROM spent
         )
+        SELECT tires FROM spent
+        """
+        result = self._execute(query, (amount, user_id, amount, -amount, reason, int(time.time())), fetch='one')
+        return result['tires'] if result else None
 
     def use_extra_attempt(self, user_id: int):
-        self._execute("UPDATE users SET extra_attempts = extra_attempts - 1 WHERE user_id = %s", (user_id,))
+        self._execute("UPDATE user_timers SET extra_attempts = extra_attempts - 1 WHERE user_id = %s", (user_id,))
 
     def clear_extra_attempts(self, user_id: int):
-        self._execute("UPDATE users SET extra_attempts = 0 WHERE user_id = %s", (user_id,))
+        self._execute("UPDATE user_timers SET extra_attempts = 0 WHERE user_id = %s", (user_id,))
 
     #=== Garage ===
     def add_car(self, user_id: int, name: str, rarity: str, value: int, brand: str, season: str, image_file_id: Optional[str] = None):
@@ -409,7 +903,7 @@ class Database:
         except psycopg2.errors.UniqueViolation:
             return False
         except Exception as e:
-            print(f"Error in add_promo_code: {e}")
+            logging.error(f"Error in add_promo_code: {e}")
             return False
 
     def edit_promo_code(self, code_text: str, reward_type: str, reward_value: Any, max_activations: int) -> bool:
@@ -424,7 +918,7 @@ class Database:
             self._execute(query, params)
             return True
         except Exception as e:
-            print(f"Error in edit_promo_code: {e}")
+            logging.error(f"Error in edit_promo_code: {e}")
             return False
 
     def get_promo_by_text(self, code_text: str) -> Optional[Dict[str, Any]]:
@@ -463,6 +957,50 @@ class Database:
         query = "SELECT rarity, COUNT(*) as count FROM garage GROUP BY rarity"
         return self._execute(query, fetch='all')
 
+    def rollup_stats(self) -> Dict[str, Any]:
+        """
+        Сводит шарды счетчиков в снимок статистики и сохраняет его в stats_rollups.
+        Запросы здесь дешевые: несколько десятков строк счетчиков и выборка по индексу created_at.
+        """
+        now = int(time.time())
+        counters = {row['name']: int(row['total']) for row in self._execute(
+            "SELECT name, SUM(value) AS total FROM stat_counters GROUP BY name", fetch='all')}
+        snapshot = {
+            "users": counters.get('users', 0),
+            "new_users_24h": self.get_new_users_count(24),
+            "cars": counters.get('cars', 0),
+            "tires": counters.get('tires', 0),
+            "rarity": {name.removeprefix('rarity:'): count for name, count in counters.items()
+                       if name.startswith('rarity:') and count > 0},
+        }
+        self._execute(
+            "INSERT INTO stats_rollups (taken_at, data) VALUES (%s, %s) ON CONFLICT (taken_at) DO UPDATE SET data = EXCLUDED.data",
+            (now, json.dumps(snapshot, ensure_ascii=False))
+        )
+        self._execute("DELETE FROM stats_rollups WHERE taken_at < %s", (now - config.STATS_ROLLUP_RETENTION,))
+        return {"taken_at": now, **snapshot}
+
+    def get_latest_stats(self) -> Optional[Dict[str, Any]]:
+        row = self._execute("SELECT taken_at, data FROM stats_rollups ORDER BY taken_at DESC LIMIT 1", fetch='one')
+        return {"taken_at": row['taken_at'], **json.loads(row['data'])} if row else None
+
+    #=== Leaderboards ===
+    def get_user_totals_page(self, after_user_id: int, limit: int) -> List[Dict[str, Any]]:
+        return self._execute(
+            "SELECT user_id, total_value, car_count, updated_at FROM user_totals WHERE user_id > %s ORDER BY user_id LIMIT %s",
+            (after_user_id, limit), fetch='all'
+        )
+
+    def get_user_totals_changed_since(self, since: int) -> List[Dict[str, Any]]:
+        return self._execute(
+            "SELECT user_id, total_value, car_count, updated_at FROM user_totals WHERE updated_at >= %s ORDER BY updated_at",
+            (since,), fetch='all'
+        )
+
+    def get_nicknames(self, user_ids: List[int]) -> Dict[int, str]:
+        rows = self._execute("SELECT user_id, nickname FROM users WHERE user_id = ANY(%s)", (list(user_ids),), fetch='all')
+        return {row['user_id']: row['nickname'] for row in rows}
+
     #=== Transactions, Tickets & Logs ===
     def log_transaction(self, t_id: str, user_id: int, amount: int, currency: str, payload: str):
         self._execute("INSERT INTO transactions (transaction_id, user_id, amount_stars, currency, payload, created_at, status) VALUES (%s, %s, %s, %s, %s, %s, %s)", (t_id, user_id, amount, currency, payload, int(time.time()), 'completed'))
@@ -490,6 +1028,15 @@ class Database:
 
     def get_tire_log_page(self, user_id: int, page: int = 0, limit: int = 5) -> List[Dict[str, Any]]:
         offset = page * limit
+        # Сначала смотрим только секцию текущего месяца - обычно страницы хватает ее одной
+        now = time.gmtime()
+        month_start = self._month_start(now.tm_year, now.tm_mon)
+        rows = self._execute(
+            "SELECT * FROM tire_log WHERE user_id = %s AND timestamp >= %s ORDER BY timestamp DESC LIMIT %s OFFSET %s",
+            (user_id, month_start, limit, offset), fetch='all'
+        )
+        if len(rows) == limit:
+            return rows
         return self._execute("SELECT * FROM tire_log WHERE user_id = %s ORDER BY timestamp DESC LIMIT %s OFFSET %s", (user_id, limit, offset), fetch='all')
 
     def get_tire_log_count(self, user_id: int) -> int:
@@ -504,7 +1051,7 @@ class Database:
 
     #=== Trades ===
     def get_user_by_nickname(self, nickname: str) -> Optional[Dict[str, Any]]:
-        return self._execute("SELECT * FROM users WHERE nickname = %s", (nickname,), fetch='one')
+        return self._execute(self.USER_SELECT + " WHERE u.nickname = %s", (nickname,), fetch='one')
 
     def create_trade(self, initiator_id: int, partner_id: int) -> int:
         now = int(time.time())
@@ -567,6 +1114,8 @@ class Database:
         trade = self.get_trade(trade_id)
         if not trade: return False
         
+        count_db_query('execute_trade')
+        started = time.perf_counter()
         with self.conn.cursor(cursor_factory=DictCursor) as cursor:
             try:
                 cursor.execute("BEGIN;")
@@ -598,9 +1147,12 @@ class Database:
                 return True
             except Exception as e:
                 self.conn.rollback()
-                print(f"ОШИБКА ОБМЕНА #{trade_id}: {e}")
+                metrics.DB_QUERY_ERRORS.inc(method='execute_trade')
+                logging.error(f"ОШИБКА ОБМЕНА #{trade_id}: {e}")
                 self.update_trade_status(trade_id, 'failed')
                 return False
+            finally:
+                metrics.DB_QUERY_LATENCY.observe(time.perf_counter() - started, method='execute_trade')
 
     #=== Group Chats & Airdrops ===
     def add_or_update_chat(self, chat_id: int, title: str):
@@ -612,17 +1164,66 @@ class Database:
     def add_chat_member(self, chat_id: int, user_id: int):
         self._execute("INSERT INTO chat_members (chat_id, user_id) VALUES (%s, %s) ON CONFLICT DO NOTHING", (chat_id, user_id))
 
-    def get_group_leaderboard(self, chat_id: int, limit: int = 10) -> List[Dict[str, Any]]:
+    def remove_chat_member(self, chat_id: int, user_id: int):
+        self._execute("DELETE FROM chat_members WHERE chat_id = %s AND user_id = %s", (chat_id, user_id))
+
+    def remove_chat(self, chat_id: int) -> int:
+        """Бота больше нет в чате: выключаем дропы и удаляем участников. Возвращает число удаленных участий."""
+        self._execute("UPDATE chats SET airdrops_enabled = FALSE WHERE chat_id = %s", (chat_id,))
+        result = self._execute(
+            "WITH removed AS (DELETE FROM chat_members WHERE chat_id = %s RETURNING 1) SELECT COUNT(*) AS count FROM removed",
+            (chat_id,), fetch='one'
+        )
+        return result['count']
+
+    def migrate_chat(self, old_chat_id: int, new_chat_id: int):
+        """Группа стала супергруппой и получила новый id: переносим настройки дропов и участников."""
+        with self._transaction():
+            self._execute('''
+            INSERT INTO chats (chat_id, title, airdrops_enabled, last_airdrop_time, airdrop_cooldown_seconds)
+            SELECT %s, title, airdrops_enabled, last_airdrop_time, airdrop_cooldown_seconds FROM chats WHERE chat_id = %s
+            ON CONFLICT (chat_id) DO UPDATE SET airdrops_enabled = EXCLUDED.airdrops_enabled,
+                                                airdrop_cooldown_seconds = EXCLUDED.airdrop_cooldown_seconds
+            ''', (new_chat_id, old_chat_id))
+            self._execute(
+                "INSERT INTO chat_members (chat_id, user_id) SELECT %s, user_id FROM chat_members WHERE chat_id = %s ON CONFLICT DO NOTHING",
+                (new_chat_id, old_chat_id)
+            )
+            self.remove_chat(old_chat_id)
+
+    def get_tracked_chat_ids(self) -> List[int]:
+        """Чаты, в которых бот, по нашим данным, еще есть: с дропами или с участниками."""
+        query = """
+        SELECT chat_id FROM chats c
+        WHERE airdrops_enabled OR EXISTS (SELECT 1 FROM chat_members m WHERE m.chat_id = c.chat_id)
+        """
+        return [row['chat_id'] for row in self._execute(query, fetch='all')]
+
+    def get_memberships_to_check(self, limit: int) -> List[Dict[str, Any]]:
+        return self._execute("SELECT chat_id, user_id FROM chat_members ORDER BY checked_at LIMIT %s", (limit,), fetch='all')
+
+    def mark_memberships_checked(self, memberships: List[tuple]):
+        if not memberships:
+            return
+        chat_ids, user_ids = zip(*memberships)
+        self._execute('''
+        UPDATE chat_members m SET checked_at = %s
+        FROM unnest(%s::bigint[], %s::bigint[]) AS c(chat_id, user_id)
+        WHERE m.chat_id = c.chat_id AND m.user_id = c.user_id
+        ''', (int(time.time()), list(chat_ids), list(user_ids)))
+
+    def get_group_leaderboard(self, chat_id: int, limit: int = 10, offset: int = 0) -> List[Dict[str, Any]]:
+        """Игроки чата по стоимости коллекции - из user_totals, без агрегата по гаражу."""
         query = """
-        SELECT u.nickname, SUM(g.value) as total_value
-        FROM garage g
-        JOIN users u ON g.user_id = u.user_id
-        WHERE g.user_id IN (SELECT user_id FROM chat_members WHERE chat_id = %s)
-        GROUP BY u.nickname
-        ORDER BY total_value DESC
-        LIMIT %s
+        SELECT u.user_id, u.nickname, t.total_value, t.car_count
+        FROM chat_members m
+        JOIN user_totals t ON t.user_id = m.user_id
+        JOIN users u ON u.user_id = m.user_id
+        WHERE m.chat_id = %s AND t.car_count > 0
+        ORDER BY t.total_value DESC, m.user_id
+        LIMIT %s OFFSET %s
         """
-        return self._execute(query, (chat_id, limit), fetch='all')
+        return self._execute(query, (chat_id, limit, offset), fetch='all')
 
     def update_airdrop_settings(self, chat_id: int, enabled: bool, cooldown_seconds: Optional[int] = None):
         if cooldown_seconds is not None:
@@ -639,12 +1240,113 @@ class Database:
         result = self._execute("INSERT INTO airdrop_claims (chat_id, message_id, created_at) VALUES (%s, %s, %s) RETURNING claim_id", (chat_id, message_id, now))
         return result['claim_id']
 
-    def claim_airdrop(self, claim_id: int, user_id: int) -> bool:
+    def claim_airdrop_with_car(self, claim_id: int, user_id: int, car: Dict[str, Any]) -> bool:
+        """
+        Забирает дроп и выдает выигранную машину одним запросом: машина
+        появляется в гараже, только если дроп еще был свободен. Если вставка
+        в гараж не удалась, дроп тоже остается незабранным.
+        """
         query = """
-        UPDATE airdrop_claims
-        SET claimed_by_user_id = %s
-        WHERE claim_id = %s AND claimed_by_user_id IS NULL
-        RETURNING claim_id
+        WITH claimed AS (
+            UPDATE airdrop_claims
+            SET claimed_by_user_id = %s
+            WHERE claim_id = %s AND claimed_by_user_id IS NULL
+            RETURNING claimed_by_user_id
+        )
+        INSERT INTO garage (user_id, car_name, rarity, value, brand, season, image_file_id)
+        SELECT claimed_by_user_id, %s, %s, %s, %s, %s, %s FROM claimed
+        RETURNING car_id
         """
-        result = self._execute(query, (user_id, claim_id), fetch='one')
+        result = self._execute(query, (
+            user_id, claim_id, car['name'], car['rarity'], car['value'],
+            car.get('brand', "Неизвестно"), car.get('season', "Неизвестно"), car.get('image_file_id'),
+        ), fetch='one')
         return result is not None
+
+    #=== FSM States ===
+    def get_fsm_record(self, storage_key: str, ttl_seconds: int) -> Optional[Dict[str, Any]]:
+        min_updated_at = int(time.time()) - ttl_seconds
+        return self._execute(
+            "SELECT state, data FROM fsm_states WHERE storage_key = %s AND updated_at > %s",
+            (storage_key, min_updated_at), fetch='one'
+        )
+
+    def save_fsm_records(self, records: List[tuple]):
+        """Пакетная запись состояний: records - список (storage_key, state, data_json)."""
+        if not records:
+            return
+        keys, states, datas = (list(column) for column in zip(*records))
+        query = """
+        INSERT INTO fsm_states (storage_key, state, data, updated_at)
+        SELECT k, s, d, %s FROM unnest(%s::text[], %s::text[], %s::text[]) AS t(k, s, d)
+        ON CONFLICT (storage_key) DO UPDATE SET state = EXCLUDED.state, data = EXCLUDED.data, updated_at = EXCLUDED.updated_at
+        """
+        self._execute(query, (int(time.time()), keys, states, datas))
+
+    def delete_fsm_records(self, storage_keys: List[str]):
+        if storage_keys:
+            self._execute("DELETE FROM fsm_states WHERE storage_key = ANY(%s)", (storage_keys,))
+
+    def delete_expired_fsm_states(self, ttl_seconds: int) -> int:
+        result = self._execute(
+            "WITH deleted AS (DELETE FROM fsm_states WHERE updated_at <= %s RETURNING 1) SELECT COUNT(*) AS count FROM deleted",
+            (int(time.time()) - ttl_seconds,), fetch='one'
+        )
+        return result['count']
+
+    #=== Archive ===
+    # Таблица -> (ключ, условие "строка больше не изменится")
+    ARCHIVE_SOURCES = {
+        "trades": ("trade_id", "status IN ('completed', 'cancelled', 'failed')"),
+        "airdrop_claims": ("claim_id", "claimed_by_user_id IS NOT NULL"),
+        "tickets": ("ticket_id", "status = 'closed'"),
+    }
+
+    def archive_batch(self, table: str, older_than: int, limit: int) -> Dict[str, int]:
+        """
+        Переносит до limit завершенных строк старше older_than в archive.batches
+        одним запросом. Строки, занятые другими транзакциями, пропускаются
+        (SKIP LOCKED), так что архивация не ждет обработчики и не блокирует их.
+        Возвращает {"rows", "raw_bytes", "batch_id"}.
+        """
+        key, finished = self.ARCHIVE_SOURCES[table]
+        query = f"""
+        WITH picked AS (
+            SELECT {key} FROM {table}
+            WHERE {finished} AND created_at < %s
+            ORDER BY {key} LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        ), moved AS (
+            DELETE FROM {table} t USING picked WHERE t.{key} = picked.{key}
+            RETURNING t.*
+        ), batch AS (
+            INSERT INTO archive.batches (source, first_id, last_id, row_count, oldest_at, newest_at, archived_at, rows)
+            SELECT %s, MIN({key}), MAX({key}), COUNT(*), MIN(created_at), MAX(created_at), %s,
+                   jsonb_agg(to_jsonb(moved) ORDER BY {key})
+            FROM moved HAVING COUNT(*) > 0
+            RETURNING batch_id, row_count
+        )
+        SELECT COALESCE((SELECT row_count FROM batch), 0) AS rows,
+               COALESCE((SELECT SUM(pg_column_size(moved.*)) FROM moved), 0)::bigint AS raw_bytes,
+               (SELECT batch_id FROM batch) AS batch_id
+        """
+        return dict(self._execute(query, (older_than, limit, table, int(time.time())), fetch='one'))
+
+    def get_archived_bytes(self, batch_ids: List[int]) -> int:
+        """Сколько места пачки занимают в архиве (уже после сжатия)."""
+        if not batch_ids:
+            return 0
+        result = self._execute(
+            "SELECT COALESCE(SUM(pg_column_size(rows)), 0)::bigint AS size FROM archive.batches WHERE batch_id = ANY(%s)",
+            (batch_ids,), fetch='one'
+        )
+        return result['size']
+
+    def get_table_size(self, table: str) -> int:
+        return self._execute("SELECT pg_total_relation_size(%s::regclass) AS size", (table,), fetch='one')['size']
+
+    def vacuum_table(self, table: str):
+        """Обычный VACUUM (не FULL): место удаленных строк становится доступным для новых без блокировки таблицы."""
+        if table not in self.ARCHIVE_SOURCES:
+            raise ValueError(f"Unknown table: {table}")
+        self._execute(f"VACUUM (ANALYZE) {table}")
@@ -13,27 +13,33 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 import re
+import html
 import asyncio
+import logging
 from datetime import datetime
 from contextlib import suppress
 
 from aiogram import Router, F, Bot
 from aiogram.filters import Command
-from aiogram.types import Message, CallbackQuery, InlineKeyboardButton
+from aiogram.types import Message, CallbackQuery, InlineKeyboardButton, BufferedInputFile
 from aiogram.fsm.context import FSMContext
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from aiogram.exceptions import TelegramForbiddenError
+from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest
 
 import config
 from db import Database
 from logic import GameLogic
-from middlewares.main_middlewares import IsAdmin
+from middlewares.main_middlewares import IsAdmin, DuplicateCallbackMiddleware
 from utils.fsm import Form
 from utils.helpers import safe_edit_text, format_value
-from backup_manager import create_backup
+from utils.metrics import registry
+from backup_manager import create_backup, human_size, list_backups, verify_restore, format_verification
 
 router = Router()
 
+# Бэкап идет в фоне; держим ссылку на задачу, чтобы ее не собрал сборщик мусора
+_backup_task: asyncio.Task | None = None
+
 
 # === Вспомогательная функция для поиска машины ===
 
@@ -51,13 +57,67 @@ def find_car_in_logic(car_name: str, logic: GameLogic) -> dict | None:
 async def cmd_backup(message: Message):
     """
     Создает резервную копию базы данных по команде администратора.
+    pg_dump работает в фоне, ход выполнения обновляется в сообщении.
     """
-    await message.answer("⏳ Начинаю процесс создания резервной копии...")
-    success, result_message = create_backup()
+    global _backup_task
+    if _backup_task and not _backup_task.done():
+        await message.answer("⏳ Резервная копия уже создается, дождитесь завершения.")
+        return
+    status = await message.answer("⏳ Начинаю процесс создания резервной копии...")
+    _backup_task = asyncio.create_task(run_backup(status))
+
+
+async def run_backup(status: Message):
+    async def report(size: int, elapsed: float):
+        with suppress(TelegramBadRequest):
+            await status.edit_text(
+                f"⏳ Создается резервная копия...\n"
+                f"Записано: {human_size(size)} за {elapsed:.0f} с ({human_size(size / max(elapsed, 0.001))}/с)"
+            )
+
+    try:
+        success, result_message, stats = await create_backup(progress=report)
+    except Exception as e:
+        logging.exception("Ошибка создания бэкапа по команде /backup")
+        success, result_message, stats = False, str(e), None
     if success:
-        await message.answer(f"✅ Резервная копия успешно создана!\nПуть к файлу: <code>{result_message}</code>")
+        speed = stats['size'] / max(stats['duration'], 0.001)
+        text = (
+            f"✅ Резервная копия успешно создана!\n"
+            f"Путь к файлу: <code>{html.escape(result_message)}</code>\n"
+            f"Размер: {human_size(stats['size'])}\n"
+            f"Время: {stats['duration']:.1f} с ({human_size(speed)}/с)"
+        )
     else:
-        await message.answer(f"❌ <b>Произошла ошибка при создании бэкапа:</b>\n\n<code>{result_message}</code>")
+        text = f"❌ <b>Произошла ошибка при создании бэкапа:</b>\n\n<code>{html.escape(result_message)}</code>"
+    with suppress(TelegramBadRequest):
+        await status.edit_text(text)
+
+
+@router.message(Command("verifybackup"), IsAdmin())
+async def cmd_verify_backup(message: Message):
+    """Разворачивает последний бэкап в отдельную базу и сверяет число строк."""
+    global _backup_task
+    if _backup_task and not _backup_task.done():
+        await message.answer("⏳ Сейчас идет работа с бэкапом, дождитесь завершения.")
+        return
+    backups = await asyncio.to_thread(list_backups)
+    if not backups:
+        await message.answer("❌ Бэкапов не найдено.")
+        return
+    status = await message.answer(f"⏳ Восстанавливаю <code>{backups[0][1]}</code> в базу <code>{config.BACKUP_VERIFY_DB}</code>...")
+
+    async def run_verification():
+        try:
+            _, report = await verify_restore(backups[0][1])
+            text = format_verification(report)
+        except Exception as e:
+            logging.exception("Ошибка проверки бэкапа по команде /verifybackup")
+            text = f"❌ <b>Проверка восстановления не удалась:</b>\n\n<code>{html.escape(str(e))}</code>"
+        with suppress(TelegramBadRequest):
+            await status.edit_text(text)
+
+    _backup_task = asyncio.create_task(run_verification())
 
 
 @router.message(Command("addpromo", "editpromo"), IsAdmin())
@@ -345,27 +405,33 @@ async def cmd_broadcast(message: Message, bot: Bot, db: Database):
 
 
 @router.message(Command("stats"), IsAdmin())
-async def cmd_stats(message: Message, db: Database):
-    total_cars = db.get_total_cars_in_game()
+async def cmd_stats(message: Message, db: Database, callback_dedup: DuplicateCallbackMiddleware):
+    """
+    Статистика из последнего снимка (см. Database.rollup_stats): сам ответ
+    не трогает большие таблицы. Если снимка еще нет, он собирается сразу.
+    """
+    stats = db.get_latest_stats() or db.rollup_stats()
+    total_cars = stats['cars']
+    as_of = datetime.fromtimestamp(stats['taken_at']).strftime('%d.%m.%Y %H:%M:%S')
     stats_text = (
         "<b>📊 Статистика бота</b>\n\n"
-        f"Всего пользователей: <b>{db.get_total_users()}</b>\n"
-        f"Новых за 24ч: <b>{db.get_new_users_count(24)}</b>\n"
+        f"Всего пользователей: <b>{stats['users']}</b>\n"
+        f"Новых за 24ч: <b>{stats['new_users_24h']}</b>\n"
         f"Всего машин в игре: <b>{total_cars}</b>\n"
-        f"Всего покрышек в экономике: <b>{db.get_total_tires()} 🛞</b>"
+        f"Всего покрышек в экономике: <b>{stats['tires']} 🛞</b>\n"
+        f"Отсечено двойных нажатий: <b>{callback_dedup.prevented}</b>"
     )
 
     if total_cars > 0:
-        rarity_dist = db.get_rarity_distribution()
+        rarity_dist = stats['rarity']
         if rarity_dist:
             stats_text += "\n\n<b>Распределение по редкости:</b>\n"
+            rarity_order = list(config.RARITY_STYLES.keys())
             sorted_dist = sorted(
-                rarity_dist,
-                key=lambda item: list(config.RARITY_STYLES.keys()).index(item['rarity'])
+                rarity_dist.items(),
+                key=lambda item: rarity_order.index(item[0]) if item[0] in rarity_order else len(rarity_order)
             )
-            for item in sorted_dist:
-                rarity = item['rarity']
-                count = item['count']
+            for rarity, count in sorted_dist:
                 percentage = (count / total_cars) * 100
                 style = config.RARITY_STYLES.get(rarity, {})
                 stats_text += (
@@ -373,9 +439,54 @@ async def cmd_stats(message: Message, db: Database):
                     f"<b>{count}</b> шт. ({percentage:.2f}%)\n"
                 )
 
+    stats_text = stats_text.rstrip("\n") + f"\n\n<i>Данные на {as_of}</i>"
     await message.answer(stats_text)
 
 
+@router.message(Command("metrics"), IsAdmin())
+async def cmd_metrics(message: Message):
+    """Отправляет текущие метрики в формате Prometheus файлом."""
+    report = registry.render().encode("utf-8")
+    await message.answer_document(BufferedInputFile(report, filename="metrics.txt"), caption="📈 Метрики бота")
+
+
+@router.message(Command("slowlog"), IsAdmin())
+async def cmd_slowlog(message: Message, db: Database):
+    """
+    Журнал медленных запросов.
+    /slowlog - выгрузить сохраненные планы, /slowlog on|off - включить/выключить, /slowlog clear - очистить.
+    """
+    parts = message.text.split()
+    arg = parts[1].lower() if len(parts) > 1 else ""
+
+    if arg in ("on", "off"):
+        db.slow_query_log = arg == "on"
+        return await message.answer(
+            f"Журнал медленных запросов {'включен' if db.slow_query_log else 'выключен'} "
+            f"(порог {config.SLOW_QUERY_THRESHOLD_MS} мс)."
+        )
+    if arg == "clear":
+        db.slow_queries.clear()
+        return await message.answer("Журнал медленных запросов очищен.")
+
+    entries = db.get_slow_queries()
+    if not entries:
+        status = "включен" if db.slow_query_log else "выключен"
+        return await message.answer(f"Сохраненных планов нет. Журнал {status}.")
+
+    report = ""
+    for entry in entries:
+        date = datetime.fromtimestamp(entry['at']).strftime('%Y-%m-%d %H:%M:%S')
+        report += (
+            f"=== {date} | {entry['method']} | {entry['duration_ms']} ms ===\n"
+            f"{entry['query']}\nparams: {entry['params']}\n\n{entry['plan']}\n\n"
+        )
+    await message.answer_document(
+        BufferedInputFile(report.encode("utf-8"), filename="slow_queries.txt"),
+        caption=f"🐢 Медленные запросы: {len(entries)}"
+    )
+
+
 @router.message(Command("promolist"), IsAdmin())
 async def cmd_promolist(message: Message, db: Database):
     promos = db.get_all_promos()
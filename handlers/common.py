@@ -12,6 +12,7 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
+import logging
 from contextlib import suppress
 
 from aiogram import Router, F, Bot
@@ -101,5 +102,5 @@ async def cq_check_subscription(call: CallbackQuery, bot: Bot, db: Database):
             await call.answer("❌ Вы все еще не подписаны на канал.", show_alert=True)
     except Exception as e:
         await call.answer("Произошла ошибка при проверке. Попробуйте позже.", show_alert=True)
-        print(f"Ошибка повторной проверки подписки для {user_id}: {e}")
+        logging.warning(f"Ошибка повторной проверки подписки для {user_id}: {e}")
 
@@ -12,16 +12,20 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
+import logging
+from datetime import datetime
+
 from aiogram import Router, F, Bot
-from aiogram.filters import Command
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup
+from aiogram.filters import Command, ChatMemberUpdatedFilter, JOIN_TRANSITION, LEAVE_TRANSITION
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, ChatMemberUpdated
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 import config
 from db import Database
 from logic import GameLogic
-from middlewares.main_middlewares import IsAdmin
-from utils.helpers import format_value
+from middlewares.main_middlewares import AirdropClaimMiddleware, IsAdmin
+from utils.helpers import format_value, safe_edit_text
+from utils.leaderboard import LeaderboardCache
 
 router = Router()
 
@@ -50,6 +54,39 @@ async def cmd_disable_airdrops(message: Message, db: Database):
     await message.answer("❌ Дропы в этом чате отключены.")
 
 
+# === Участники чатов ===
+# chat_member приходит, только если бот - администратор группы
+
+@router.my_chat_member(F.chat.type.in_({"group", "supergroup"}), ChatMemberUpdatedFilter(LEAVE_TRANSITION))
+async def on_bot_removed(event: ChatMemberUpdated, db: Database, leaderboard: LeaderboardCache):
+    removed = db.remove_chat(event.chat.id)
+    leaderboard.invalidate(event.chat.id)
+    logging.info(f"Бот удален из чата {event.chat.id}: дропы выключены, удалено участников: {removed}")
+
+
+@router.my_chat_member(F.chat.type.in_({"group", "supergroup"}), ChatMemberUpdatedFilter(JOIN_TRANSITION))
+async def on_bot_added(event: ChatMemberUpdated, db: Database):
+    db.add_or_update_chat(event.chat.id, event.chat.title)
+
+
+@router.chat_member(ChatMemberUpdatedFilter(LEAVE_TRANSITION))
+async def on_member_left(event: ChatMemberUpdated, db: Database, leaderboard: LeaderboardCache):
+    db.remove_chat_member(event.chat.id, event.new_chat_member.user.id)
+    leaderboard.invalidate(event.chat.id)
+
+
+@router.chat_member(ChatMemberUpdatedFilter(JOIN_TRANSITION))
+async def on_member_joined(event: ChatMemberUpdated, db: Database):
+    if not event.new_chat_member.user.is_bot:
+        db.add_chat_member(event.chat.id, event.new_chat_member.user.id)
+
+
+@router.message(F.migrate_to_chat_id)
+async def on_chat_migrated(message: Message, db: Database):
+    db.migrate_chat(message.chat.id, message.migrate_to_chat_id)
+    logging.info(f"Чат {message.chat.id} стал супергруппой {message.migrate_to_chat_id}, данные перенесены")
+
+
 # === Обработчики колбэков ===
 
 @router.callback_query(F.data == "group:garage_list")
@@ -68,41 +105,79 @@ async def cq_group_garage_list(call: CallbackQuery, db: Database):
     await call.answer()
 
 
+def leaderboard_text(chat_title: str, rows: list, page: int, page_size: int, built_at: float) -> str:
+    text = f"🏆 <b>Топ игроков в чате \"{chat_title}\":</b>\n\n"
+    for i, row in enumerate(rows, page * page_size + 1):
+        place_emoji = {1: "🥇", 2: "🥈", 3: "🥉"}.get(i, f"<b>{i}.</b>")
+        text += f"{place_emoji} {row['nickname']} - {format_value(row['total_value'])}\n"
+    text += f"\n<i>Обновлено в {datetime.fromtimestamp(built_at).strftime('%H:%M:%S')}</i>"
+    return text
+
+
+def leaderboard_keyboard(page: int, pages: int) -> InlineKeyboardMarkup | None:
+    if pages <= 1:
+        return None
+    builder = InlineKeyboardBuilder()
+    if page > 0:
+        builder.button(text="⬅️", callback_data=f"group:leaderboard:{page - 1}")
+    builder.button(text=f"{page + 1}/{pages}", callback_data="group:noop")
+    if page < pages - 1:
+        builder.button(text="➡️", callback_data=f"group:leaderboard:{page + 1}")
+    return builder.as_markup()
+
+
 @router.callback_query(F.data == "group:leaderboard")
-async def cq_group_leaderboard(call: CallbackQuery, db: Database):
-    leaderboard_data = db.get_group_leaderboard(call.message.chat.id)
-    if not leaderboard_data:
+async def cq_group_leaderboard(call: CallbackQuery, leaderboard: LeaderboardCache):
+    rows, page, pages, built_at = leaderboard.page(call.message.chat.id, 0, config.LEADERBOARD_PAGE_SIZE)
+    if not rows:
         return await call.answer("В этом чате пока нет игроков с машинами.", show_alert=True)
 
-    text = f"🏆 <b>Топ игроков в чате \"{call.message.chat.title}\":</b>\n\n"
-    for i, row in enumerate(leaderboard_data, 1):
-        place_emoji = {1: "🥇", 2: "🥈", 3: "🥉"}.get(i, f"<b>{i}.</b>")
-        text += f"{place_emoji} {row['nickname']} - {format_value(row['total_value'])}\n"
-    
-    await call.message.answer(text)
+    text = leaderboard_text(call.message.chat.title, rows, page, config.LEADERBOARD_PAGE_SIZE, built_at)
+    await call.message.answer(text, reply_markup=leaderboard_keyboard(page, pages))
+    await call.answer()
+
+
+@router.callback_query(F.data.startswith("group:leaderboard:"))
+async def cq_group_leaderboard_page(call: CallbackQuery, leaderboard: LeaderboardCache):
+    requested = int(call.data.split(":")[2])
+    rows, page, pages, built_at = leaderboard.page(call.message.chat.id, requested, config.LEADERBOARD_PAGE_SIZE)
+    if not rows:
+        return await call.answer("В этом чате пока нет игроков с машинами.", show_alert=True)
+
+    text = leaderboard_text(call.message.chat.title, rows, page, config.LEADERBOARD_PAGE_SIZE, built_at)
+    await safe_edit_text(call, text, reply_markup=leaderboard_keyboard(page, pages))
+    await call.answer()
+
+
+@router.callback_query(F.data == "group:noop")
+async def cq_group_noop(call: CallbackQuery):
     await call.answer()
 
 
 @router.callback_query(F.data.startswith("claim_airdrop:"))
-async def cq_claim_airdrop(call: CallbackQuery, db: Database, logic: GameLogic):
+async def cq_claim_airdrop(call: CallbackQuery, db: Database, logic: GameLogic, airdrop_claims: AirdropClaimMiddleware):
     claim_id = int(call.data.split(":")[1])
     user_id = call.from_user.id
 
-    if db.claim_airdrop(claim_id, user_id):
-        result = logic.open_case(user_id, config.AIRDROP_CASE_NAME, use_cooldown=False)
-        if result['status'] == 'success':
-            car = result['car']
-            style = config.RARITY_STYLES.get(car['rarity'], {})
-            await call.answer(f"🎉 Вы получили машину: {car['name']}!", show_alert=True)
-            
-            new_text = (
-                f"🎁 <b>Дроп забран!</b>\n\n"
-                f"Счастливчик: {call.from_user.full_name}\n"
-                f"Приз: {style.get('color', '')} {car['name']}"
-            )
-            await call.message.edit_text(new_text, reply_markup=None)
-        else:
-            await call.answer("Ошибка при выдаче приза. Обратитесь к администратору.", show_alert=True)
+    # Машина разыгрывается заранее, а дроп и приз записываются одним запросом
+    result = logic.roll_case(config.AIRDROP_CASE_NAME)
+    if result['status'] != 'success':
+        await call.answer("Ошибка при выдаче приза. Обратитесь к администратору.", show_alert=True)
+        return
+
+    claimed = db.claim_airdrop_with_car(claim_id, user_id, result['car'])
+    airdrop_claims.settle(claim_id)
+    if claimed:
+        car = result['car']
+        style = config.RARITY_STYLES.get(car['rarity'], {})
+        await call.answer(f"🎉 Вы получили машину: {car['name']}!", show_alert=True)
+
+        new_text = (
+            f"🎁 <b>Дроп забран!</b>\n\n"
+            f"Счастливчик: {call.from_user.full_name}\n"
+            f"Приз: {style.get('color', '')} {car['name']}"
+        )
+        await call.message.edit_text(new_text, reply_markup=None)
     else:
         await call.answer("Этот дроп уже кто-то забрал!", show_alert=True)
 
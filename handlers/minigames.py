@@ -118,14 +118,12 @@ async def cq_play_coin_flip(call: CallbackQuery, db: Database):
     user_id = call.from_user.id
     
     db.check_and_update_pass_status(user_id)
-    user = db.get_user(user_id)
     
     db.set_last_coin_flip_time(user_id)
     bot_choice = random.choice(['heads', 'tails'])
     
     if user_choice == bot_choice:
-        db.change_tires(user_id, 1, "Победа в 'Броске монетки'")
-        new_total = user.get('tires', 0) + 1
+        new_total = db.change_tires(user_id, 1, "Победа в 'Броске монетки'")
         result_text = f"Выпал(а) <b>{'орел' if bot_choice == 'heads' else 'решка'}</b>! Вы угадали!\n\n" \
                       f"🎉 +1 покрышка! Теперь у вас: <b>{new_total} 🛞</b>"
     else:
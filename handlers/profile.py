@@ -26,7 +26,8 @@ import config
 from db import Database
 from logic import GameLogic
 from utils.fsm import Form
-from utils.helpers import format_time, safe_edit_text, get_main_menu_content, answer_in_private
+from utils.helpers import format_time, format_value, safe_edit_text, get_main_menu_content, answer_in_private
+from utils.leaderboard import GlobalLeaderboard
 
 router = Router()
 
@@ -37,6 +38,7 @@ def profile_menu_kb() -> InlineKeyboardBuilder:
     builder = InlineKeyboardBuilder()
     builder.button(text="Сменить ник", callback_data="change_nick_start")
     builder.button(text="🤝 Пригласить друзей", callback_data="referral_info")
+    builder.button(text="🏆 Общий рейтинг", callback_data="global_leaderboard")
     builder.button(text="↩️ В меню", callback_data="main_menu")
     builder.adjust(1)
     return builder.as_markup()
@@ -45,7 +47,8 @@ def profile_menu_kb() -> InlineKeyboardBuilder:
 # === Обработчики ===
 
 @router.callback_query(F.data == "profile_menu")
-async def cq_profile_menu(call: CallbackQuery, state: FSMContext, db: Database, bot: Bot):
+async def cq_profile_menu(call: CallbackQuery, state: FSMContext, db: Database, bot: Bot,
+                          global_leaderboard: GlobalLeaderboard):
     if call.message.chat.type != 'private':
         return await answer_in_private(call, bot, "Перехожу в ваш профиль...")
 
@@ -61,6 +64,9 @@ async def cq_profile_menu(call: CallbackQuery, state: FSMContext, db: Database,
         f"<b>Приглашено друзей:</b> {user.get('referral_count', 0)}\n"
         f"<b>Бесплатных смен ника:</b> {user.get('free_nick_changes', 0)}\n"
     )
+    rank = global_leaderboard.rank(call.from_user.id)
+    if rank:
+        text += f"<b>Место в общем рейтинге:</b> {rank} из {len(global_leaderboard)}\n"
 
     if has_pass:
         remaining = user.get('collect_pass_expires_at', 0) - int(time.time())
@@ -70,6 +76,40 @@ async def cq_profile_menu(call: CallbackQuery, state: FSMContext, db: Database,
     await call.answer()
 
 
+@router.callback_query(F.data == "global_leaderboard")
+async def cq_global_leaderboard(call: CallbackQuery, db: Database, global_leaderboard: GlobalLeaderboard):
+    if not global_leaderboard.ready:
+        return await call.answer("Рейтинг еще собирается, попробуйте через минуту.", show_alert=True)
+
+    user_id = call.from_user.id
+    top = global_leaderboard.top(10)
+    rank = global_leaderboard.rank(user_id)
+    neighbours = global_leaderboard.around(rank, config.GLOBAL_LEADERBOARD_NEIGHBOURS) if rank else []
+    # Соседей, которые и так видны в топе, второй раз не показываем
+    neighbours = [row for row in neighbours if row[0] > len(top)]
+    nicknames = db.get_nicknames([row[1] for row in top + neighbours])
+
+    def line(place: int, player_id: int, value: int) -> str:
+        place_emoji = {1: "🥇", 2: "🥈", 3: "🥉"}.get(place, f"<b>{place}.</b>")
+        name = nicknames.get(player_id, player_id)
+        name = f"<u>{name}</u>" if player_id == user_id else name
+        return f"{place_emoji} {name} - {format_value(value)}\n"
+
+    text = f"🏆 <b>Общий рейтинг коллекционеров</b> ({len(global_leaderboard)} игроков)\n\n"
+    text += "".join(line(*row) for row in top)
+    if neighbours:
+        if neighbours[0][0] > len(top) + 1:
+            text += "...\n"
+        text += "".join(line(*row) for row in neighbours)
+    if not rank:
+        text += "\nВы пока не в рейтинге - откройте свой первый кейс!"
+
+    builder = InlineKeyboardBuilder()
+    builder.button(text="↩️ В профиль", callback_data="profile_menu")
+    await safe_edit_text(call, text, reply_markup=builder.as_markup())
+    await call.answer()
+
+
 @router.callback_query(F.data == "referral_info")
 async def cq_referral_info(call: CallbackQuery, db: Database, bot: Bot):
     user = db.get_user(call.from_user.id)
@@ -205,17 +245,13 @@ async def process_new_nickname(message: Message, state: FSMContext, db: Database
     is_free_change = user.get('free_nick_changes', 0) > 0
     has_pass = db.check_and_update_pass_status(user_id)
     cost = config.COLLECT_PASS_NICK_CHANGE_COST if has_pass else config.NICK_CHANGE_COST
-    user_tires = user.get('tires', 0)
 
-    if not is_free_change and user_tires < cost:
+    if not is_free_change and db.spend_tires(user_id, cost, "Смена никнейма") is None:
         await message.answer(f"❌ Недостаточно покрышек! Нужно: {cost} 🛞")
         await asyncio.sleep(2)
         text, kb = await get_main_menu_content(db, user_id)
         return await message.answer(text, reply_markup=kb)
 
-    if not is_free_change:
-        db.change_tires(user_id, -cost, "Смена никнейма")
-
     db.change_nickname(user_id, new_nick, is_free=is_free_change)
     
     await message.answer(f"✅ Никнейм успешно изменен на <b>{new_nick}</b>!")
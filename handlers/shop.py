@@ -215,13 +215,11 @@ async def cq_buy_attempt(call: CallbackQuery, bot: Bot, db: Database):
     pack_id = call.data.split(":")[1]
     pack = config.ATTEMPT_PACKS.get(pack_id)
     user_id = call.from_user.id
-    user = db.get_user(user_id)
-    
+
     has_pass = db.check_and_update_pass_status(user_id)
     cost = round(pack['cost'] * (1 - config.ATTEMPTS_DISCOUNT_PERCENT / 100)) if has_pass else pack['cost']
 
-    if user.get('tires', 0) >= cost:
-        db.change_tires(user_id, -cost, f"Покупка {pack['attempts']} попыток")
+    if db.spend_tires(user_id, cost, f"Покупка {pack['attempts']} попыток") is not None:
         db.add_extra_attempts(user_id, pack['attempts'])
         await call.answer(f"✅ Покупка успешна! Начислено {pack['attempts']} доп. попыток.", show_alert=True)
         await cq_shop_menu(call, bot, db)
@@ -256,9 +254,7 @@ async def cq_collect_pass_shop_info(call: CallbackQuery, db: Database):
 
 @router.callback_query(F.data == "buy_collect_pass")
 async def cq_buy_collect_pass(call: CallbackQuery, db: Database):
-    user = db.get_user(call.from_user.id)
-    if user.get('tires', 0) >= config.COLLECT_PASS_COST:
-        db.change_tires(call.from_user.id, -config.COLLECT_PASS_COST, "Покупка CollectPass")
+    if db.spend_tires(call.from_user.id, config.COLLECT_PASS_COST, "Покупка CollectPass") is not None:
         db.activate_collect_pass(call.from_user.id, config.COLLECT_PASS_DURATION)
         await call.answer("✅ Подписка CollectPass активирована!", show_alert=True)
         await cq_collect_pass_shop_info(call, db)
@@ -15,6 +15,7 @@
 
 import json
 import json
+import logging
 import random
 import time
 from typing import Dict, Any
@@ -33,7 +34,7 @@ class GameLogic:
             with open(config.CARS_DATA_PATH, "r", encoding="utf-8") as f:
                 return json.load(f)
         except (FileNotFoundError, json.JSONDecodeError) as e:
-            print(f"Ошибка при загрузке {config.CARS_DATA_PATH}: {e}")
+            logging.error(f"Ошибка при загрузке {config.CARS_DATA_PATH}: {e}")
             return {}
 
     def open_case(self, user_id: int, case_name: str, use_cooldown: bool = True) -> Dict[str, Any]:
@@ -62,6 +63,28 @@ class GameLogic:
             
             self.db.set_last_free_case_time(user_id)
 
+        roll = self.roll_case(case_name)
+        if roll['status'] != 'success':
+            return roll
+        won_car = roll['car']
+
+        self.db.add_car(
+            user_id=user_id,
+            name=won_car["name"],
+            rarity=won_car["rarity"],
+            value=won_car["value"],
+            brand=won_car.get("brand", "Неизвестно"),
+            season=won_car.get("season", "Неизвестно"),
+            image_file_id=won_car.get("image_file_id")
+        )
+        
+        return {"status": "success", "car": won_car}
+
+    def roll_case(self, case_name: str) -> Dict[str, Any]:
+        """Разыгрывает машину из кейса, ничего не записывая в БД."""
+        if case_name not in self.cases:
+            return {"status": "error", "message": "Кейс не найден."}
+
         case_data = self.cases[case_name]
         
         rarity_chances = case_data.get("rarity_chances", {})
@@ -94,17 +117,7 @@ class GameLogic:
                 won_car = random.choice(cars_of_rarity)
             else:
                 won_car = random.choices(cars_of_rarity, weights=weights, k=1)[0]
-        
-        self.db.add_car(
-            user_id=user_id,
-            name=won_car["name"],
-            rarity=won_car["rarity"],
-            value=won_car["value"],
-            brand=won_car.get("brand", "Неизвестно"),
-            season=won_car.get("season", "Неизвестно"),
-            image_file_id=won_car.get("image_file_id")
-        )
-        
+
         return {"status": "success", "car": won_car}
 
     def craft_car(self, target_rarity: str) -> Dict[str, Any]:
@@ -14,34 +14,61 @@
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 
 import asyncio
+import html
 import logging
 import os
+import signal
+import sys
 import time
 from contextlib import suppress
+from typing import Optional
 
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
-from aiogram.enums import ParseMode
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.enums import ChatMemberStatus, ParseMode
+from aiogram.exceptions import (TelegramAPIError, TelegramBadRequest, TelegramForbiddenError,
+                                TelegramMigrateToChat)
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiogram.webhook.aiohttp_server import setup_application
+from aiohttp import web
 
+import backup_manager
 import config
 from db import Database
 from logic import GameLogic
-from middlewares.main_middlewares import SubscriptionMiddleware, BanMiddleware, GroupMemberMiddleware, TestModeMiddleware
+from middlewares.main_middlewares import (SubscriptionMiddleware, BanMiddleware, GroupMemberMiddleware,
+                                          TestModeMiddleware, UserLaneMiddleware,
+                                          DuplicateCallbackMiddleware, PriorityMiddleware, AirdropClaimMiddleware,
+                                          MetricsMiddleware, ApiMetricsMiddleware, CallBudgetMiddleware,
+                                          UpdateRecorderMiddleware)
 from handlers import (admin, common, garage, group, minigames, profile, shop, support, trade, craft)
+from utils import metrics
+from utils.metrics import start_metrics_server
+from utils.update_recorder import UpdateRecorder
+from utils.fsm_storage import PostgresStorage
+from utils.leaderboard import LeaderboardCache, GlobalLeaderboard
+from utils.logs import setup_logging
+from utils.loop_monitor import LoopLagMonitor
+from utils.webhook import DrainingRequestHandler
 
 # Настройка логирования
-logging.basicConfig(level=logging.INFO)
+setup_logging()
+notifications_log = logging.getLogger("carcollect.notifications")
+
+
+def create_bot() -> Bot:
+    """Создает бота. Если задан TELEGRAM_API_SERVER, запросы идут на него, а не на api.telegram.org."""
+    session = None
+    if config.TELEGRAM_API_SERVER:
+        session = AiohttpSession(api=TelegramAPIServer.from_base(config.TELEGRAM_API_SERVER))
+    return Bot(token=config.BOT_TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 
-# Инициализация основных компонентов
-bot = Bot(token=config.BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher()
-db_instance = Database(config.DB_CONFIG)
-logic_instance = GameLogic(db_instance)
 
 # === Фоновые задачи ===
 
-async def case_notifier():
+async def case_notifier(bot: Bot, db: Database):
     """
     Периодически проверяет, готов ли у пользователей бесплатный кейс,
     и отправляет уведомления, включая повторные напоминания.
@@ -50,16 +77,16 @@ async def case_notifier():
         await asyncio.sleep(config.CASE_NOTIFIER_INTERVAL)
         logging.info("Проверка пользователей для уведомлений о кейсах...")
         
-        users_to_check = db_instance.get_users_for_notification_check()
+        users_to_check = db.get_users_for_notification_check()
         now = int(time.time())
 
         for user_data in users_to_check:
             user_id = user_data['user_id']
             
             # 1. Определяем актуальный кулдаун для пользователя
-            db_instance.check_and_update_pass_status(user_id)
+            db.check_and_update_pass_status(user_id)
             # Пере-получаем данные, так как check_and_update_pass_status мог их изменить
-            refreshed_user_data = db_instance.get_user(user_id) 
+            refreshed_user_data = db.get_user(user_id) 
             if not refreshed_user_data: continue
 
             last_free_case_time = refreshed_user_data['last_free_case']
@@ -90,29 +117,29 @@ async def case_notifier():
                 try:
                     builder = InlineKeyboardBuilder().button(text="🎉 Открыть кейс", callback_data="confirm_open_case")
                     await bot.send_message(user_id, "🎁 Ваш бесплатный кейс готов!", reply_markup=builder.as_markup())
-                    db_instance.update_last_case_notification(user_id)
-                    logging.info(f"Отправлено уведомление о кейсе пользователю {user_id}")
+                    db.update_last_case_notification(user_id)
+                    notifications_log.info(f"Отправлено уведомление о кейсе пользователю {user_id}")
                 except Exception as e:
-                    logging.warning(f"Не удалось отправить уведомление {user_id}: {e}")
+                    notifications_log.warning(f"Не удалось отправить уведомление {user_id}: {e}")
                     # Обновляем таймер даже при ошибке, чтобы не спамить
-                    db_instance.update_last_case_notification(user_id) 
+                    db.update_last_case_notification(user_id) 
                 await asyncio.sleep(0.2)
 
 
-async def airdrop_notifier():
+async def airdrop_notifier(bot: Bot, db: Database):
     """Periodically checks chats and sends airdrops if it's time."""
     logging.info("Airdrop background task started. Initial delay of 10 seconds...")
     await asyncio.sleep(10)  # Initial delay
     
     known_chat_ids = set()
-    initial_chats = db_instance.get_chats_for_airdrop()
+    initial_chats = db.get_chats_for_airdrop()
     if initial_chats:
         known_chat_ids = {chat['chat_id'] for chat in initial_chats}
     logging.info(f"Initial check found {len(known_chat_ids)} chats with airdrops enabled.")
 
     while True:
         try:
-            current_chats = db_instance.get_chats_for_airdrop()
+            current_chats = db.get_chats_for_airdrop()
             current_chat_ids = {chat['chat_id'] for chat in current_chats}
 
             # Log only if the set of chats has changed
@@ -136,13 +163,18 @@ async def airdrop_notifier():
                         msg = await bot.send_message(chat_id, "🎁 <b>Внимание, дроп!</b>", reply_markup=kb)
 
                         # Create the airdrop record in the DB to get a unique ID
-                        claim_id = db_instance.create_airdrop(chat_id, msg.message_id)
+                        claim_id = db.create_airdrop(chat_id, msg.message_id)
 
                         # Update the message with the correct button including the claim ID
                         updated_kb = InlineKeyboardBuilder().button(text="🎉 Забрать!", callback_data=f"claim_airdrop:{claim_id}").as_markup()
                         await msg.edit_reply_markup(reply_markup=updated_kb)
 
                         logging.info(f"Airdrop successfully sent to chat {chat_id}, claim_id: {claim_id}")
+                    except TelegramAPIError as e:
+                        if is_chat_gone(e):
+                            forget_chat(db, chat_id, e)
+                        else:
+                            logging.error(f"Failed to send airdrop to chat {chat_id}: {e}")
                     except Exception as e:
                         logging.error(f"Failed to send airdrop to chat {chat_id}: {e}")
 
@@ -154,11 +186,229 @@ async def airdrop_notifier():
         await asyncio.sleep(config.AIRDROP_NOTIFIER_INTERVAL)
 
 
-# === Запуск бота ===
-async def main():
-    # Запуск фоновых задач
-    airdrop_task = asyncio.create_task(airdrop_notifier())
-    notifier_task = asyncio.create_task(case_notifier())
+def forget_chat(db: Database, chat_id: int, reason: Exception):
+    """Бот больше не может писать в чат: выключаем дропы и забываем участников."""
+    if isinstance(reason, TelegramMigrateToChat):
+        db.migrate_chat(chat_id, reason.migrate_to_chat_id)
+        logging.info(f"Чат {chat_id} стал супергруппой {reason.migrate_to_chat_id}, данные перенесены")
+        return
+    removed = db.remove_chat(chat_id)
+    logging.info(f"Бот больше не в чате {chat_id} ({reason}): дропы выключены, удалено участников: {removed}")
+
+
+def is_chat_gone(error: Exception) -> bool:
+    if isinstance(error, (TelegramForbiddenError, TelegramMigrateToChat)):
+        return True
+    return isinstance(error, TelegramBadRequest) and "chat not found" in error.message
+
+
+async def membership_reconciler(bot: Bot, db: Database):
+    """
+    Сверяет chat_members с Telegram на случай пропущенных chat_member апдейтов
+    (бот не админ, простой бота): чаты, где бота больше нет, забываются,
+    ушедшие участники удаляются. За проход проверяется MEMBERSHIP_CHECK_BATCH участий.
+    """
+    left_statuses = (ChatMemberStatus.LEFT, ChatMemberStatus.KICKED)
+    while True:
+        await asyncio.sleep(config.MEMBERSHIP_CHECK_INTERVAL)
+        try:
+            gone_chats = set()
+            for chat_id in db.get_tracked_chat_ids():
+                try:
+                    member = await bot.get_chat_member(chat_id, bot.id)
+                    if member.status in left_statuses:
+                        forget_chat(db, chat_id, Exception(member.status))
+                        gone_chats.add(chat_id)
+                except TelegramAPIError as e:
+                    if is_chat_gone(e):
+                        forget_chat(db, chat_id, e)
+                        gone_chats.add(chat_id)
+                await asyncio.sleep(0.1)
+
+            checked, removed = [], 0
+            for row in db.get_memberships_to_check(config.MEMBERSHIP_CHECK_BATCH):
+                chat_id, user_id = row['chat_id'], row['user_id']
+                if chat_id in gone_chats:
+                    continue
+                try:
+                    member = await bot.get_chat_member(chat_id, user_id)
+                    if member.status in left_statuses:
+                        db.remove_chat_member(chat_id, user_id)
+                        removed += 1
+                    else:
+                        checked.append((chat_id, user_id))
+                except TelegramAPIError as e:
+                    if is_chat_gone(e):
+                        forget_chat(db, chat_id, e)
+                        gone_chats.add(chat_id)
+                    elif isinstance(e, TelegramBadRequest) and "user not found" in e.message:
+                        db.remove_chat_member(chat_id, user_id)
+                        removed += 1
+                    else:
+                        checked.append((chat_id, user_id))
+                await asyncio.sleep(0.1)
+            db.mark_memberships_checked(checked)
+            logging.info(f"Сверка участников: проверено {len(checked) + removed}, удалено {removed}, чатов без бота: {len(gone_chats)}")
+        except Exception as e:
+            logging.error(f"Ошибка сверки участников чатов: {e}")
+
+
+async def stats_rollup(db: Database):
+    """Периодически сводит счетчики статистики в снимок для /stats."""
+    while True:
+        try:
+            db.rollup_stats()
+        except Exception as e:
+            logging.error(f"Не удалось обновить снимок статистики: {e}")
+        await asyncio.sleep(config.STATS_ROLLUP_INTERVAL)
+
+
+async def tire_log_maintenance(db: Database):
+    """Создает секции tire_log на следующие месяцы и убирает старые (см. TIRE_LOG_*)."""
+    while True:
+        await asyncio.sleep(config.TIRE_LOG_MAINTENANCE_INTERVAL)
+        try:
+            db.maintain_tire_log()
+        except Exception as e:
+            logging.error(f"Ошибка обслуживания секций tire_log: {e}")
+
+
+async def notify_admins(bot: Bot, text: str):
+    for admin_id in config.ADMIN_IDS:
+        try:
+            await bot.send_message(admin_id, text)
+        except Exception as e:
+            logging.warning(f"Не удалось отправить сообщение администратору {admin_id}: {e}")
+
+
+async def run_archival(db: Database) -> dict:
+    """
+    Переносит завершенные строки старше ARCHIVE_AFTER_DAYS в архив пачками
+    по ARCHIVE_BATCH_SIZE с паузой между пачками. Возвращает отчет по таблицам.
+    Запросы идут в отдельном потоке, так что db не должно быть общим
+    подключением бота - иначе VACUUM большой таблицы задержит хендлеры.
+    """
+    report = {}
+    for table, days in config.ARCHIVE_AFTER_DAYS.items():
+        if not days:
+            continue
+        older_than = int(time.time()) - days * 86400
+        size_before = await asyncio.to_thread(db.get_table_size, table)
+        rows, raw_bytes, batch_ids = 0, 0, []
+        while True:
+            batch = await asyncio.to_thread(db.archive_batch, table, older_than, config.ARCHIVE_BATCH_SIZE)
+            if not batch['rows']:
+                break
+            rows += batch['rows']
+            raw_bytes += batch['raw_bytes']
+            batch_ids.append(batch['batch_id'])
+            await asyncio.sleep(config.ARCHIVE_BATCH_PAUSE)
+        if rows:
+            await asyncio.to_thread(db.vacuum_table, table)
+        report[table] = {
+            "rows": rows,
+            "raw_bytes": raw_bytes,
+            "archived_bytes": await asyncio.to_thread(db.get_archived_bytes, batch_ids),
+            "size_before": size_before,
+            "size_after": await asyncio.to_thread(db.get_table_size, table),
+        }
+    return report
+
+
+def format_archival_report(report: dict) -> str:
+    lines = ["🗄 <b>Архивация завершена</b>\n"]
+    for table, stats in report.items():
+        lines.append(
+            f"<b>{table}</b>: {stats['rows']} строк, освобождено {backup_manager.human_size(stats['raw_bytes'])} "
+            f"(в архиве {backup_manager.human_size(stats['archived_bytes'])}), "
+            f"размер таблицы {backup_manager.human_size(stats['size_before'])} → {backup_manager.human_size(stats['size_after'])}"
+        )
+    return "\n".join(lines)
+
+
+async def archiver(bot: Bot):
+    """
+    Раз в ARCHIVE_INTERVAL переносит старые обмены, дропы и тикеты в архив.
+    Для архивации открывается свое подключение к БД, после нее оно закрывается.
+    """
+    while True:
+        await asyncio.sleep(config.ARCHIVE_INTERVAL)
+        archive_db = None
+        try:
+            archive_db = await asyncio.to_thread(Database, config.DB_CONFIG)
+            report = await run_archival(archive_db)
+            logging.info(f"Архивация: {report}")
+            if any(stats['rows'] for stats in report.values()):
+                await notify_admins(bot, format_archival_report(report))
+        except Exception as e:
+            logging.error(f"Ошибка архивации: {e}")
+        finally:
+            if archive_db:
+                archive_db.close()
+
+
+async def backup_scheduler(bot: Bot):
+    """
+    Раз в BACKUP_INTERVAL создает бэкап, удаляет лишние по политике хранения
+    и раз в BACKUP_VERIFY_INTERVAL проверяет, что свежий бэкап восстанавливается.
+    Расписание считается от времени последнего бэкапа на диске, так что перезапуск бота его не сбивает.
+    """
+    while True:
+        try:
+            backups = await asyncio.to_thread(backup_manager.list_backups)
+            last_backup = backups[0][0].timestamp() if backups else 0
+            await asyncio.sleep(max(60, last_backup + config.BACKUP_INTERVAL - time.time()))
+
+            success, result_message, stats = await backup_manager.create_backup()
+            if not success:
+                logging.error(f"Автоматический бэкап не удался: {result_message}")
+                await notify_admins(bot, f"❌ <b>Автоматический бэкап не удался:</b>\n\n<code>{html.escape(result_message)}</code>")
+                await asyncio.sleep(3600)  # повторим через час
+                continue
+            metrics.BACKUP_LAST_SUCCESS.set(time.time())
+            metrics.BACKUP_SIZE.set(stats['size'])
+            logging.info(f"Автоматический бэкап создан: {result_message} ({backup_manager.human_size(stats['size'])}, {stats['duration']:.1f} с)")
+
+            removed = await asyncio.to_thread(backup_manager.apply_retention)
+            if removed:
+                logging.info(f"Удалено старых бэкапов: {len(removed)}")
+
+            last_check = await asyncio.to_thread(backup_manager.last_verification)
+            if last_check and time.time() - last_check['at'] < config.BACKUP_VERIFY_INTERVAL:
+                continue
+            verified, report = await backup_manager.verify_restore(result_message)
+            metrics.BACKUP_VERIFY_OK.set(1 if verified else 0)
+            if report['restore_seconds'] is not None:
+                metrics.BACKUP_RESTORE_SECONDS.set(report['restore_seconds'])
+            logging.log(logging.INFO if verified else logging.ERROR, f"Проверка восстановления: {report}")
+            await notify_admins(bot, backup_manager.format_verification(report))
+        except Exception as e:
+            # Без этого одна ошибка (диск, права, конфиг) навсегда остановила бы плановые бэкапы
+            logging.exception("Ошибка планировщика бэкапов")
+            await notify_admins(bot, f"❌ <b>Ошибка планировщика бэкапов:</b>\n\n<code>{html.escape(str(e))}</code>")
+            await asyncio.sleep(3600)  # повторим через час
+
+
+# === Сборка диспетчера ===
+def setup_dispatcher(dp: Dispatcher, bot: Bot, db: Database, logic: GameLogic, recorder: UpdateRecorder = None):
+    """
+    Регистрирует middleware, зависимости и роутеры.
+    Используется и при обычном запуске, и в нагрузочных тестах (benchmarks/load_test.py).
+    """
+    # Запись трафика должна видеть все апдейты, поэтому стоит первой
+    if recorder:
+        dp.update.outer_middleware(UpdateRecorderMiddleware(recorder))
+
+    # Проигравшие нажатия на дроп отсекаются до всех проверок и запросов к БД
+    airdrop_claims = AirdropClaimMiddleware()
+    dp.update.outer_middleware(airdrop_claims)
+    dp["airdrop_claims"] = airdrop_claims
+
+    # Апдейты одного пользователя обрабатываются строго по очереди,
+    # разных пользователей - параллельно
+    dp.update.outer_middleware(UserLaneMiddleware())
+    # Платежи и обмены не ждут, пока освободятся слоты под листание гаража
+    dp.update.outer_middleware(PriorityMiddleware())
 
     if config.TEST_MODE:
         dp.update.outer_middleware(TestModeMiddleware())
@@ -170,10 +420,30 @@ async def main():
     dp.message.middleware(GroupMemberMiddleware())
     dp.callback_query.middleware(GroupMemberMiddleware())
 
+    # Защита от двойных нажатий на кнопки покупок, кейсов и крафта
+    callback_dedup = DuplicateCallbackMiddleware()
+    dp.callback_query.outer_middleware(callback_dedup)
+    dp["callback_dedup"] = callback_dedup
+
+    # Метрики: время хендлеров, запросов к БД и вызовов Telegram API
+    dp.message.middleware(MetricsMiddleware())
+    dp.callback_query.middleware(MetricsMiddleware())
+    bot.session.middleware(ApiMetricsMiddleware())
+    # Поиск хендлеров, делающих слишком много запросов за один апдейт
+    dp.message.middleware(CallBudgetMiddleware())
+    dp.callback_query.middleware(CallBudgetMiddleware())
+
     # Передача зависимостей (db, logic) в хендлеры
-    dp["db"] = db_instance
-    dp["logic"] = logic_instance
-    
+    dp["db"] = db
+    dp["logic"] = logic
+    dp["leaderboard"] = LeaderboardCache(db, config.LEADERBOARD_CACHE_TTL, config.LEADERBOARD_MAX_ENTRIES)
+    dp["global_leaderboard"] = GlobalLeaderboard(db, config.GLOBAL_LEADERBOARD_POLL_INTERVAL,
+                                                 config.GLOBAL_LEADERBOARD_RESYNC_INTERVAL)
+
+    include_routers(dp)
+
+
+def include_routers(dp: Dispatcher):
     # Подключение роутеров
     routers_to_include = [
         admin.router, common.router, garage.router, group.router, 
@@ -183,17 +453,149 @@ async def main():
     for r in routers_to_include:
         dp.include_router(r)
 
+
+# === Режимы получения апдейтов ===
+async def run_polling(dp: Dispatcher, bot: Bot):
     # Удаление вебхука и запуск поллинга
     await bot.delete_webhook(drop_pending_updates=True)
+    await dp.start_polling(bot)
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+    """
+    Принимает апдейты через aiohttp-сервер. Несколько процессов можно запустить
+    на разных webhook_port за одним reverse proxy.
+    """
+    if not config.WEBHOOK_URL or not config.WEBHOOK_SECRET:
+        raise ValueError("Для режима webhook нужны webhook_url и webhook_secret в .env")
+
+    app = web.Application()
+    handler = DrainingRequestHandler(
+        dispatcher=dp, bot=bot,
+        secret_token=config.WEBHOOK_SECRET,
+        drain_timeout=config.WEBHOOK_DRAIN_TIMEOUT,
+    )
+    handler.register(app, path=config.WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, config.WEBHOOK_HOST, config.WEBHOOK_PORT).start()
+    logging.info(f"Webhook server listening on http://{config.WEBHOOK_HOST}:{config.WEBHOOK_PORT}{config.WEBHOOK_PATH}")
+
+    await bot.set_webhook(
+        url=config.WEBHOOK_URL.rstrip("/") + config.WEBHOOK_PATH,
+        secret_token=config.WEBHOOK_SECRET,
+        max_connections=config.WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+
+    # Ждем Ctrl+C или SIGTERM, затем останавливаем прием и дорабатываем принятые апдейты
+    stop_event = asyncio.Event()
+    with suppress(NotImplementedError):  # add_signal_handler недоступен на Windows
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop_event.set)
     try:
-        await dp.start_polling(bot)
+        await stop_event.wait()
+    finally:
+        await runner.cleanup()
+
+
+async def run_queue(dp: Dispatcher, bot: Bot, updates_queue):
+    """
+    Режим воркера (см. supervisor.py): апдейты приходят от супервизора через
+    multiprocessing.Queue. None в очереди - сигнал завершиться.
+    """
+    loop = asyncio.get_running_loop()
+    in_flight = set()
+
+    async def process(raw_update: dict):
+        try:
+            await dp.feed_raw_update(bot, raw_update)
+        except Exception:
+            logging.exception(f"Ошибка при обработке апдейта {raw_update.get('update_id')}")
+
+    while True:
+        raw_update = await loop.run_in_executor(None, updates_queue.get)
+        if raw_update is None:
+            break
+        # Порядок апдейтов одного игрока сохраняет UserLaneMiddleware: задачи стартуют в порядке очереди
+        task = asyncio.create_task(process(raw_update))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+
+    if in_flight:
+        await asyncio.wait(in_flight, timeout=config.WORKER_DRAIN_TIMEOUT)
+
+
+# === Запуск бота ===
+async def main(worker_index: Optional[int] = None, updates_queue=None, recording_salt: Optional[str] = None):
+    """
+    Обычный запуск - без аргументов. Воркеры supervisor.py передают свой номер
+    и очередь апдейтов: у каждого свои бот, подключение к БД и GameLogic.
+    Вебхук-процессы передают номер из config.WORKER_INDEX.
+    """
+    bot = create_bot()
+    db = Database(config.DB_CONFIG)
+    logic = GameLogic(db)
+    # Состояния диалогов (гараж, крафт, обмен) переживают перезапуск и не копятся в памяти вечно
+    fsm_storage = None
+    if config.FSM_STORAGE == "postgres":
+        # Вебхук-процессов может быть несколько, и прокси не привязывает игрока к одному из них,
+        # поэтому в режиме webhook состояния не кэшируются. Воркеры supervisor.py получают
+        # апдейты игрока всегда в одном процессе - им кэш не мешает.
+        fsm_storage = PostgresStorage(db, config.FSM_FLUSH_INTERVAL, config.FSM_CACHE_IDLE, config.FSM_STATE_TTL,
+                                      write_through=config.UPDATE_MODE == "webhook")
+    dp = Dispatcher(storage=fsm_storage)
+    recorder = None
+    if config.UPDATE_RECORDING_ENABLED:
+        # Воркеры пишут каждый в свой файл, соль общая - псевдонимы совпадают
+        suffix = f"-w{worker_index}" if worker_index is not None else ""
+        recorder = UpdateRecorder(config.UPDATE_RECORDING_DIR, recording_salt or config.UPDATE_RECORDING_SALT, suffix=suffix)
+    setup_dispatcher(dp, bot, db, logic, recorder)
+
+    # Запуск фоновых задач (при нескольких воркерах или вебхук-процессах - только в нулевом,
+    # иначе дропы и уведомления продублируются)
+    recorder_task = asyncio.create_task(recorder.run()) if recorder else None
+    fsm_task = asyncio.create_task(fsm_storage.run()) if fsm_storage else None
+    loop_monitor = LoopLagMonitor(config.LOOP_LAG_CHECK_INTERVAL, config.LOOP_STALL_THRESHOLD_MS)
+    loop_monitor_task = asyncio.create_task(loop_monitor.run())
+    # Общий рейтинг нужен профилю в каждом воркере
+    leaderboard_task = asyncio.create_task(dp["global_leaderboard"].run())
+    background_tasks = []
+    if not worker_index:
+        background_tasks.append(asyncio.create_task(airdrop_notifier(bot, db)))
+        background_tasks.append(asyncio.create_task(case_notifier(bot, db)))
+        background_tasks.append(asyncio.create_task(stats_rollup(db)))
+        background_tasks.append(asyncio.create_task(tire_log_maintenance(db)))
+        if config.ARCHIVE_INTERVAL:
+            background_tasks.append(asyncio.create_task(archiver(bot)))
+        background_tasks.append(asyncio.create_task(membership_reconciler(bot, db)))
+        if config.BACKUP_INTERVAL:
+            background_tasks.append(asyncio.create_task(backup_scheduler(bot)))
+    metrics_port = config.METRICS_PORT + (worker_index or 0) if config.METRICS_PORT else 0
+    metrics_runner = await start_metrics_server(config.METRICS_HOST, metrics_port)
+
+    try:
+        if updates_queue is not None:
+            await run_queue(dp, bot, updates_queue)
+        elif config.UPDATE_MODE == "webhook":
+            await run_webhook(dp, bot)
+        else:
+            await run_polling(dp, bot)
     finally:
         # Корректное завершение фоновых задач
-        airdrop_task.cancel()
-        notifier_task.cancel()
-        with suppress(asyncio.CancelledError):
-            await airdrop_task
-            await notifier_task
+        for task in background_tasks:
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+        # Остатки буферов (запись трафика, состояния FSM) сохраняются при отмене задач
+        for task in (recorder_task, fsm_task, loop_monitor_task, leaderboard_task):
+            if task:
+                task.cancel()
+                with suppress(asyncio.CancelledError):
+                    await task
+        if metrics_runner:
+            await metrics_runner.cleanup()
         await bot.session.close()
 
 
@@ -204,7 +606,19 @@ if __name__ == "__main__":
     if not os.path.exists("images/default_car.png"):
         logging.warning("Файл-заглушка 'images/default_car.png' не найден.")
     
+    if config.WORKERS > 1 and config.UPDATE_MODE == "webhook":
+        # Супервизор получает апдейты long polling'ом и удалил бы вебхук
+        logging.error("workers > 1 поддерживается только в режиме polling. Для нескольких вебхук-процессов "
+                      "запустите их отдельно с разными webhook_port и worker_index")
+        sys.exit(1)
+
     try:
-        asyncio.run(main())
+        if config.WORKERS > 1:
+            from supervisor import Supervisor
+            Supervisor(config.WORKERS).run()
+        elif config.UPDATE_MODE == "webhook":
+            asyncio.run(main(worker_index=config.WORKER_INDEX))
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         logging.info("Бот остановлен вручную.")
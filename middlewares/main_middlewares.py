@@ -12,19 +12,351 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
+import asyncio
 import logging
+import time
+from collections import OrderedDict
 from typing import Callable, Dict, Any, Awaitable, Union
 from contextlib import suppress
 
 from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 from aiogram.filters import Filter
-from aiogram.types import Message, CallbackQuery, TelegramObject
+from aiogram.types import Message, CallbackQuery, TelegramObject, Update
 from aiogram.enums import ChatMemberStatus
 from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from aiogram.methods.base import TelegramMethod
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 import config
 from db import Database
+from utils import metrics
+from utils.call_budget import count_api_call, track_calls
+from utils.update_recorder import UpdateRecorder
+
+
+class UpdateRecorderMiddleware(BaseMiddleware):
+    """
+    Сохраняет каждый входящий апдейт (с обезличенными id) для воспроизведения
+    в нагрузочных тестах. Регистрируется первым, чтобы в запись попадали и
+    апдейты, отброшенные дальше по цепочке.
+    """
+    def __init__(self, recorder: UpdateRecorder):
+        self.recorder = recorder
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        try:
+            self.recorder.record(event)
+        except Exception as e:
+            logging.warning(f"Не удалось записать апдейт: {e}")
+        return await handler(event, data)
+
+
+class UserLaneMiddleware(BaseMiddleware):
+    """
+    Выстраивает апдейты одного пользователя в очередь ("полосу").
+    Апдейты одного user_id выполняются строго по порядку, апдейты разных
+    пользователей - параллельно. Блокировка удаляется из словаря, как только
+    у пользователя не остается ожидающих апдейтов.
+    """
+    def __init__(self):
+        # user_id -> [asyncio.Lock, количество апдейтов в полосе]
+        self._lanes: Dict[int, list] = {}
+
+    @property
+    def active_lanes(self) -> int:
+        return len(self._lanes)
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        user = data.get('event_from_user')
+        if not user:
+            return await handler(event, data)
+
+        lane = self._lanes.get(user.id)
+        if lane is None:
+            lane = self._lanes[user.id] = [asyncio.Lock(), 0]
+        lane[1] += 1
+        try:
+            async with lane[0]:
+                return await handler(event, data)
+        finally:
+            lane[1] -= 1
+            if lane[1] == 0:
+                self._lanes.pop(user.id, None)
+
+
+class PriorityMiddleware(BaseMiddleware):
+    """
+    Делит апдейты на классы high / normal / low и ограничивает число
+    одновременно обрабатываемых апдейтов каждого класса.
+    Платежи и обмены не конкурируют с листанием гаража, а низкоприоритетные
+    апдейты при перегрузке отбрасываются с вежливым ответом.
+    """
+    BUSY_TEXT = "⏳ Бот сейчас перегружен, попробуйте еще раз через пару секунд."
+
+    def __init__(self, limits: Dict[str, int] = config.UPDATE_PRIORITY_LIMITS, shed_wait: float = config.LOAD_SHED_WAIT):
+        self.shed_wait = shed_wait
+        self._semaphores = {name: asyncio.Semaphore(limit) for name, limit in limits.items()}
+        self.shed = 0
+
+    @staticmethod
+    def classify(update: Update) -> str:
+        if update.pre_checkout_query or (update.message and update.message.successful_payment):
+            return "high"
+        if update.callback_query and update.callback_query.data:
+            data = update.callback_query.data
+            if data.startswith(config.HIGH_PRIORITY_CALLBACKS):
+                return "high"
+            if data.startswith(config.LOW_PRIORITY_CALLBACKS):
+                return "low"
+        return "normal"
+
+    async def _acquire_within(self, semaphore: asyncio.Semaphore) -> bool:
+        """
+        Ждет слот не дольше shed_wait. wait_for(semaphore.acquire()) здесь
+        не подходит: если таймаут совпадает с получением слота, слот теряется.
+        Поэтому ожидание идет в отдельной задаче, а слот, полученный уже после
+        отказа, сразу возвращается.
+        """
+        if not semaphore.locked():
+            await semaphore.acquire()
+            return True
+
+        def release_abandoned(task: asyncio.Task):
+            if not task.cancelled():
+                semaphore.release()
+
+        waiter = asyncio.ensure_future(semaphore.acquire())
+        acquired = False
+        try:
+            await asyncio.wait({waiter}, timeout=self.shed_wait)
+            acquired = waiter.done()
+        finally:
+            if not acquired:
+                waiter.cancel()
+                waiter.add_done_callback(release_abandoned)
+        return acquired
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: Update,
+            data: Dict[str, Any]
+    ) -> Any:
+        priority = self.classify(event)
+        data['update_priority'] = priority
+        semaphore = self._semaphores[priority]
+
+        if priority == "low":
+            if not await self._acquire_within(semaphore):
+                self.shed += 1
+                metrics.UPDATES_SHED.inc()
+                logging.warning(f"Load shedding: dropped low-priority update {event.update_id} (total shed: {self.shed})")
+                with suppress(TelegramBadRequest, TelegramForbiddenError):
+                    if event.callback_query:
+                        await event.callback_query.answer(self.BUSY_TEXT)
+                    elif event.message:
+                        await event.message.answer(self.BUSY_TEXT)
+                return
+        else:
+            await semaphore.acquire()
+
+        try:
+            return await handler(event, data)
+        finally:
+            semaphore.release()
+
+
+class AirdropClaimMiddleware(BaseMiddleware):
+    """
+    Быстрый отказ для нажатий "Забрать!" на уже разыгранный дроп.
+    Когда дроп приходит в большую группу, за секунду его пытаются забрать
+    десятки людей, а выиграть может только один. Процесс помнит разыгранные
+    claim_id и отвечает проигравшим сразу - до проверок подписки, бана,
+    участия в группе и до запроса в БД. Пока первое нажатие обрабатывается,
+    остальные тоже получают отказ. Если оно не дошло до розыгрыша (не прошло
+    проверки), дроп снова открыт.
+    """
+    TAKEN_TEXT = "Этот дроп уже кто-то забрал!"
+    BUSY_TEXT = "Дроп уже забирают, попробуйте через секунду."
+
+    def __init__(self, max_claims: int = 10000):
+        self.max_claims = max_claims
+        self.rejected = 0
+        # claim_id -> True (разыгран) / False (нажатие обрабатывается)
+        self._claims: OrderedDict = OrderedDict()
+
+    def settle(self, claim_id: int):
+        """Вызывается хендлером, когда БД ответила: дроп больше не свободен."""
+        self._claims[claim_id] = True
+        self._claims.move_to_end(claim_id)
+        while len(self._claims) > self.max_claims:
+            self._claims.popitem(last=False)
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: Update,
+            data: Dict[str, Any]
+    ) -> Any:
+        call = event.callback_query
+        if not call or not call.data or not call.data.startswith("claim_airdrop:"):
+            return await handler(event, data)
+
+        claim_id = int(call.data.split(":")[1])
+        state = self._claims.get(claim_id)
+        # claim_airdrop:0 - кнопка еще не получила id дропа
+        if claim_id <= 0 or state is not None:
+            self.rejected += 1
+            metrics.AIRDROP_CLICKS_REJECTED.inc()
+            with suppress(TelegramBadRequest):
+                await call.answer(self.TAKEN_TEXT if claim_id <= 0 or state else self.BUSY_TEXT, show_alert=True)
+            return
+
+        self._claims[claim_id] = False
+        try:
+            return await handler(event, data)
+        finally:
+            if self._claims.get(claim_id) is False:
+                del self._claims[claim_id]
+
+
+class DuplicateCallbackMiddleware(BaseMiddleware):
+    """
+    Отсекает повторные нажатия одной и той же кнопки.
+    Ключ - (user_id, message_id, callback_data). Если такой колбэк уже
+    обрабатывается или был обработан меньше window секунд назад, хендлер
+    не вызывается. Проверяются только колбэки из config.IDEMPOTENT_CALLBACKS.
+    """
+    def __init__(self, window: float = config.CALLBACK_DEDUP_WINDOW, prefixes: tuple = config.IDEMPOTENT_CALLBACKS):
+        self.window = window
+        self.prefixes = prefixes
+        self.prevented = 0
+        # ключ -> время окончания обработки (None, пока хендлер выполняется)
+        self._seen: OrderedDict = OrderedDict()
+
+    def _cleanup(self, now: float):
+        while self._seen:
+            key, finished_at = next(iter(self._seen.items()))
+            if finished_at is None or now - finished_at < self.window:
+                break
+            self._seen.popitem(last=False)
+
+    async def __call__(
+            self,
+            handler: Callable[[CallbackQuery, Dict[str, Any]], Awaitable[Any]],
+            event: CallbackQuery,
+            data: Dict[str, Any]
+    ) -> Any:
+        if not event.data or not event.data.startswith(self.prefixes):
+            return await handler(event, data)
+
+        now = time.monotonic()
+        self._cleanup(now)
+
+        message_id = event.message.message_id if event.message else event.inline_message_id
+        key = (event.from_user.id, message_id, event.data)
+        if key in self._seen:
+            finished_at = self._seen[key]
+            if finished_at is None or now - finished_at < self.window:
+                self.prevented += 1
+                metrics.CALLBACKS_DEDUPLICATED.inc(prefix=event.data.split(":", 1)[0])
+                logging.info(f"Duplicate callback '{event.data}' from {event.from_user.id} ignored (total prevented: {self.prevented})")
+                with suppress(TelegramBadRequest):
+                    await event.answer()
+                return
+
+        self._seen[key] = None
+        self._seen.move_to_end(key)
+        try:
+            return await handler(event, data)
+        finally:
+            self._seen[key] = time.monotonic()
+            self._seen.move_to_end(key)
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """
+    Замеряет время работы хендлеров, считает ошибки и число
+    одновременно выполняющихся хендлеров.
+    Метки: имя хендлера и префикс callback_data (до первого ':').
+    """
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        handler_object = data.get('handler')
+        handler_name = getattr(getattr(handler_object, 'callback', None), '__name__', 'unknown')
+        if isinstance(event, CallbackQuery):
+            prefix = (event.data or "").split(":", 1)[0]
+        else:
+            prefix = "message"
+
+        metrics.HANDLERS_IN_FLIGHT.inc(handler=handler_name)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.HANDLER_ERRORS.inc(handler=handler_name, prefix=prefix)
+            raise
+        finally:
+            metrics.HANDLER_LATENCY.observe(time.perf_counter() - started, handler=handler_name, prefix=prefix)
+            metrics.HANDLERS_IN_FLIGHT.dec(handler=handler_name)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Замеряет время вызовов Telegram Bot API по методам."""
+    async def __call__(self, make_request, bot: Bot, method: TelegramMethod):
+        api_method = method.__api_method__
+        count_api_call(api_method)
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            metrics.API_CALL_ERRORS.inc(method=api_method)
+            raise
+        finally:
+            metrics.API_CALL_LATENCY.observe(time.perf_counter() - started, method=api_method)
+
+
+class CallBudgetMiddleware(BaseMiddleware):
+    """
+    Считает запросы к БД и вызовы Telegram API, сделанные хендлером за один
+    апдейт. Превышение config.DB_QUERY_BUDGET / config.API_CALL_BUDGET
+    пишется в лог с разбивкой по методам - так видны запросы в циклах (N+1).
+    """
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        handler_object = data.get('handler')
+        handler_name = getattr(getattr(handler_object, 'callback', None), '__name__', 'unknown')
+
+        with track_calls() as counter:
+            try:
+                return await handler(event, data)
+            finally:
+                metrics.DB_QUERIES_PER_UPDATE.observe(counter.db_queries, handler=handler_name)
+                metrics.API_CALLS_PER_UPDATE.observe(counter.api_calls, handler=handler_name)
+                over_budget = counter.db_queries > config.DB_QUERY_BUDGET or counter.api_calls > config.API_CALL_BUDGET
+                if over_budget and handler_name not in config.CALL_BUDGET_EXEMPT_HANDLERS:
+                    metrics.CALL_BUDGET_EXCEEDED.inc(handler=handler_name)
+                    logging.warning(f"Call budget exceeded in {handler_name}: {counter.summary()}")
+
 
 class UserCheckMiddleware(BaseMiddleware):
     """
@@ -114,6 +446,11 @@ class IsAdmin(Filter):
         return event.from_user.id in config.ADMIN_IDS
 
 
+def is_membership_update(event: TelegramObject) -> bool:
+    """Апдейты о вступлении/выходе из чата нужны для учета участников, даже если их автор не прошел бы проверки."""
+    return isinstance(event, Update) and bool(event.chat_member or event.my_chat_member)
+
+
 class SubscriptionMiddleware(BaseMiddleware):
     """
     Middleware для проверки подписки пользователя на обязательный канал.
@@ -127,8 +464,8 @@ class SubscriptionMiddleware(BaseMiddleware):
         user = data.get('event_from_user')
         bot: Bot = data.get('bot')
 
-        # Пропускаем, если нет пользователя или это админ
-        if not user or user.id in config.ADMIN_IDS:
+        # Пропускаем, если нет пользователя, это админ или апдейт об участниках чата
+        if not user or user.id in config.ADMIN_IDS or is_membership_update(event):
             return await handler(event, data)
 
         try:
@@ -205,7 +542,7 @@ class BanMiddleware(BaseMiddleware):
             data: Dict[str, Any]
     ) -> Any:
         user = data.get('event_from_user')
-        if not user:
+        if not user or is_membership_update(event):
             return await handler(event, data)
 
         db: Database = data['db']
@@ -0,0 +1,179 @@
+# Copyright (C) 2025 smalllbro42
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import time
+from contextlib import suppress
+from typing import Any, Dict
+
+from aiogram import Dispatcher
+from aiogram.exceptions import (TelegramNetworkError, TelegramRetryAfter, TelegramServerError,
+                                TelegramUnauthorizedError)
+
+import config
+
+# Поля апдейта, в которых может лежать событие с автором
+EVENT_KEYS = (
+    "message", "edited_message", "callback_query", "pre_checkout_query", "shipping_query",
+    "inline_query", "chosen_inline_result", "my_chat_member", "chat_member", "chat_join_request",
+    "poll_answer", "message_reaction",
+)
+
+
+def shard_for(update: Dict[str, Any], workers: int) -> int:
+    """
+    Номер воркера для апдейта. Все апдейты одного пользователя попадают
+    к одному воркеру, поэтому их порядок сохраняется. Апдейты без автора
+    распределяются по id чата.
+    """
+    for key in EVENT_KEYS:
+        event = update.get(key)
+        if not event:
+            continue
+        author = event.get("from") or event.get("user")
+        if author:
+            return author["id"] % workers
+        chat = event.get("chat") or event.get("message", {}).get("chat")
+        if chat:
+            return abs(chat["id"]) % workers
+    return 0
+
+
+def worker_process(index: int, updates_queue, recording_salt: str):
+    """Точка входа процесса-воркера."""
+    # Остановкой управляет супервизор через None в очереди
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from utils.logs import setup_logging
+    setup_logging(worker=index)
+    import main
+    asyncio.run(main.main(worker_index=index, updates_queue=updates_queue, recording_salt=recording_salt))
+
+
+class Supervisor:
+    """
+    Получает апдейты long polling'ом и раздает их N процессам-воркерам
+    по user_id. Упавший воркер перезапускается с той же очередью.
+    """
+    RESTART_DELAY = 5
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._ctx = multiprocessing.get_context("spawn")
+        self.queues = [self._ctx.Queue() for _ in range(workers)]
+        self.processes = [None] * workers
+        self._started_at = [0.0] * workers
+        # Общая соль нужна, чтобы записи трафика разных воркеров использовали одни псевдонимы
+        self.recording_salt = config.UPDATE_RECORDING_SALT or os.urandom(16).hex()
+
+    def _start_worker(self, index: int):
+        process = self._ctx.Process(
+            target=worker_process, args=(index, self.queues[index], self.recording_salt),
+            name=f"carcollect-worker-{index}", daemon=False,
+        )
+        process.start()
+        self.processes[index] = process
+        self._started_at[index] = time.monotonic()
+        logging.info(f"Воркер {index} запущен (pid {process.pid})")
+
+    def _check_workers(self):
+        for index, process in enumerate(self.processes):
+            if process is None or process.is_alive():
+                continue
+            # Воркер, падающий сразу после старта, перезапускаем не чаще раза в RESTART_DELAY секунд
+            if time.monotonic() - self._started_at[index] < self.RESTART_DELAY:
+                continue
+            logging.error(f"Воркер {index} завершился с кодом {process.exitcode}, перезапускаю")
+            self._start_worker(index)
+
+    async def _watch_workers(self):
+        """Проверяет воркеры раз в секунду: очередь упавшего воркера не должна стоять, пока идет long polling."""
+        while True:
+            self._check_workers()
+            await asyncio.sleep(1)
+
+    async def _poll(self, bot, allowed_updates: list):
+        await bot.delete_webhook(drop_pending_updates=True)
+        offset = None
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                continue
+            except (TelegramNetworkError, TelegramServerError) as e:
+                logging.warning(f"Ошибка получения апдейтов: {e}")
+                await asyncio.sleep(1)
+                continue
+            except TelegramUnauthorizedError:
+                # Неверный токен не исправится повтором - супервизор завершается с ошибкой
+                raise
+            except Exception as e:
+                logging.exception(f"Непредвиденная ошибка получения апдейтов: {e}")
+                await asyncio.sleep(5)
+                continue
+
+            for update in updates:
+                raw_update = update.model_dump(mode="json", exclude_none=True, by_alias=True)
+                self.queues[shard_for(raw_update, self.workers)].put(raw_update)
+                offset = update.update_id + 1
+
+    async def _run(self):
+        import main
+        bot = main.create_bot()
+        # Диспетчер нужен только чтобы узнать, какие типы апдейтов используют роутеры
+        dp = Dispatcher()
+        main.include_routers(dp)
+        allowed_updates = dp.resolve_used_update_types()
+
+        stop_event = asyncio.Event()
+        with suppress(NotImplementedError):  # add_signal_handler недоступен на Windows
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop_event.set)
+
+        poller = asyncio.create_task(self._poll(bot, allowed_updates))
+        watcher = asyncio.create_task(self._watch_workers())
+        stopper = asyncio.create_task(stop_event.wait())
+        try:
+            await asyncio.wait((poller, watcher, stopper), return_when=asyncio.FIRST_COMPLETED)
+            # Получение апдейтов или проверка воркеров завершились сами - это ошибка, а не остановка
+            for task in (poller, watcher):
+                if task.done():
+                    task.result()
+                    raise RuntimeError("Фоновая задача супервизора завершилась неожиданно")
+        finally:
+            for task in (poller, watcher, stopper):
+                if not task.done():
+                    task.cancel()
+                    with suppress(asyncio.CancelledError):
+                        await task
+            await bot.session.close()
+
+    def run(self):
+        logging.info(f"Запуск супервизора с {self.workers} воркерами")
+        for index in range(self.workers):
+            self._start_worker(index)
+        try:
+            asyncio.run(self._run())
+        finally:
+            logging.info("Остановка воркеров...")
+            for updates_queue in self.queues:
+                updates_queue.put(None)
+            for index, process in enumerate(self.processes):
+                process.join(config.WORKER_DRAIN_TIMEOUT + 5)
+                if process.is_alive():
+                    logging.warning(f"Воркер {index} не успел завершиться, останавливаю принудительно")
+                    process.terminate()
@@ -0,0 +1,92 @@
+# Copyright (C) 2025 smalllbro42
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+# === Подсчет запросов к БД и вызовов Telegram API в рамках одного апдейта ===
+
+class CallCounter:
+    """Счетчики запросов к БД и вызовов API для текущего контекста (апдейта или теста)."""
+    def __init__(self, parent: Optional["CallCounter"] = None):
+        self.parent = parent
+        self.db_queries = 0
+        self.api_calls = 0
+        self.db_by_method = Counter()
+        self.api_by_method = Counter()
+
+    def add_db_query(self, method: str):
+        counter = self
+        while counter:
+            counter.db_queries += 1
+            counter.db_by_method[method] += 1
+            counter = counter.parent
+
+    def add_api_call(self, method: str):
+        counter = self
+        while counter:
+            counter.api_calls += 1
+            counter.api_by_method[method] += 1
+            counter = counter.parent
+
+    def summary(self) -> str:
+        """Краткая сводка: какие методы сколько раз вызывались (самые частые первыми)."""
+        db = ", ".join(f"{name} x{count}" for name, count in self.db_by_method.most_common())
+        api = ", ".join(f"{name} x{count}" for name, count in self.api_by_method.most_common())
+        return f"db={self.db_queries} [{db}] api={self.api_calls} [{api}]"
+
+
+_current: ContextVar[Optional[CallCounter]] = ContextVar("call_counter", default=None)
+
+
+def count_db_query(method: str):
+    counter = _current.get()
+    if counter is not None:
+        counter.add_db_query(method)
+
+
+def count_api_call(method: str):
+    counter = _current.get()
+    if counter is not None:
+        counter.add_api_call(method)
+
+
+@contextmanager
+def track_calls():
+    """Считает все запросы к БД и вызовы API внутри блока (вложенные блоки учитываются и во внешних)."""
+    counter = CallCounter(parent=_current.get())
+    token = _current.set(counter)
+    try:
+        yield counter
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def assert_max_calls(db_queries: Optional[int] = None, api_calls: Optional[int] = None):
+    """
+    Для тестов: падает с AssertionError, если внутри блока было больше
+    запросов к БД или вызовов API, чем разрешено.
+
+        with assert_max_calls(db_queries=5):
+            await cq_craft_menu(call, state, db, bot)
+    """
+    with track_calls() as counter:
+        yield counter
+    if db_queries is not None and counter.db_queries > db_queries:
+        raise AssertionError(f"Expected at most {db_queries} DB queries, got {counter.db_queries}: {counter.summary()}")
+    if api_calls is not None and counter.api_calls > api_calls:
+        raise AssertionError(f"Expected at most {api_calls} API calls, got {counter.api_calls}: {counter.summary()}")
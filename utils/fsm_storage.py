@@ -0,0 +1,182 @@
+# Copyright (C) 2025 smalllbro42
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from psycopg2.extras import DictRow
+
+from db import Database
+
+# === Хранение состояний FSM в PostgreSQL ===
+
+def to_plain(value: Any) -> Any:
+    """
+    Приводит данные состояния к виду, который переживает JSON:
+    строки БД (DictRow - это список!) превращаются в словари, State - в строку.
+    """
+    if isinstance(value, DictRow):
+        return {key: to_plain(item) for key, item in value.items()}
+    if isinstance(value, dict):
+        return {str(key): to_plain(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, set)):
+        return [to_plain(item) for item in value]
+    if isinstance(value, State):
+        return value.state
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+class _Record:
+    __slots__ = ("state", "data", "touched")
+
+    def __init__(self, state: Optional[str] = None, data: Optional[dict] = None):
+        self.state = state
+        self.data = data or {}
+        self.touched = time.monotonic()
+
+
+class PostgresStorage(BaseStorage):
+    """
+    FSM-хранилище в таблице fsm_states.
+
+    Состояния читаются из базы один раз и дальше живут в памяти. Изменения
+    (часто по несколько update_data за одно нажатие) копятся и пишутся
+    в базу одним пакетом раз в flush_interval секунд. Записи, к которым
+    не обращались cache_idle секунд, выгружаются из памяти, а в базе
+    удаляются состояния, не менявшиеся дольше ttl.
+
+    С write_through=True кэша нет: каждое чтение идет в базу, каждое
+    изменение сразу пишется. Нужно, когда апдейты одного игрока могут попасть
+    в разные процессы (несколько вебхук-процессов за одним прокси) - иначе
+    процесс читает устаревшее состояние из своего кэша и затирает им чужое.
+    """
+    def __init__(self, db: Database, flush_interval: float = 2.0, cache_idle: float = 600, ttl: int = 7 * 86400,
+                 write_through: bool = False):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.cache_idle = cache_idle
+        self.ttl = ttl
+        self.write_through = write_through
+        self.key_builder = DefaultKeyBuilder(prefix="fsm", with_bot_id=True,
+                                             with_business_connection_id=True, with_destiny=True)
+        self._cache: Dict[str, _Record] = {}
+        self._dirty: set = set()
+
+    @property
+    def cached(self) -> int:
+        return len(self._cache)
+
+    def _record(self, key: StorageKey) -> tuple:
+        storage_key = self.key_builder.build(key)
+        record = self._cache.get(storage_key)
+        if record is None:
+            row = self.db.get_fsm_record(storage_key, self.ttl)
+            record = _Record(row['state'], json.loads(row['data'])) if row else _Record()
+            if not self.write_through:
+                self._cache[storage_key] = record
+        record.touched = time.monotonic()
+        return storage_key, record
+
+    @staticmethod
+    def _dump(record: _Record) -> str:
+        return json.dumps(record.data, ensure_ascii=False, separators=(",", ":"))
+
+    def _changed(self, storage_key: str, record: _Record):
+        if not self.write_through:
+            self._dirty.add(storage_key)
+        elif record.state is None and not record.data:
+            self.db.delete_fsm_records([storage_key])
+        else:
+            self.db.save_fsm_records([(storage_key, record.state, self._dump(record))])
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key, record = self._record(key)
+        record.state = state.state if isinstance(state, State) else state
+        self._changed(storage_key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return self._record(key)[1].state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        storage_key, record = self._record(key)
+        record.data = to_plain(data)
+        self._changed(storage_key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return json.loads(json.dumps(self._record(key)[1].data))
+
+    async def update_data(self, key: StorageKey, data: Mapping[str, Any]) -> Dict[str, Any]:
+        storage_key, record = self._record(key)
+        record.data.update(to_plain(data))
+        self._changed(storage_key, record)
+        return json.loads(json.dumps(record.data))
+
+    def flush(self):
+        """Пишет накопленные изменения в базу: пустые состояния удаляются, остальные - upsert."""
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        to_save, to_delete = [], []
+        for storage_key in dirty:
+            record = self._cache.get(storage_key)
+            if record is None:
+                continue
+            if record.state is None and not record.data:
+                to_delete.append(storage_key)
+            else:
+                to_save.append((storage_key, record.state, self._dump(record)))
+        try:
+            self.db.save_fsm_records(to_save)
+            self.db.delete_fsm_records(to_delete)
+        except Exception as e:
+            # Не теряем изменения - попробуем в следующий раз
+            self._dirty |= dirty
+            logging.error(f"Не удалось сохранить состояния FSM: {e}")
+
+    def evict_idle(self):
+        """Выгружает из памяти давно не использовавшиеся состояния (они уже сохранены в базе)."""
+        threshold = time.monotonic() - self.cache_idle
+        for storage_key in [k for k, r in self._cache.items() if r.touched < threshold and k not in self._dirty]:
+            del self._cache[storage_key]
+
+    async def run(self):
+        """Фоновая задача: пакетная запись, выгрузка из памяти и удаление устаревших состояний."""
+        last_cleanup = 0.0
+        try:
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                self.flush()
+                self.evict_idle()
+                if time.monotonic() - last_cleanup > 3600:
+                    last_cleanup = time.monotonic()
+                    try:
+                        removed = self.db.delete_expired_fsm_states(self.ttl)
+                    except Exception as e:
+                        # Сбой очистки не должен останавливать запись и выгрузку - повторим через час
+                        logging.error(f"Не удалось удалить устаревшие состояния FSM: {e}")
+                    else:
+                        if removed:
+                            logging.info(f"Удалено устаревших состояний FSM: {removed}")
+        finally:
+            self.flush()
+
+    async def close(self) -> None:
+        self.flush()
@@ -12,6 +12,7 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
+import logging
 import time
 from contextlib import suppress
 from typing import Tuple, Union
@@ -69,7 +70,7 @@ async def safe_edit_text(call: CallbackQuery, text: str, reply_markup: InlineKey
                 await call.message.delete()
             await call.message.answer(text, reply_markup=reply_markup, **kwargs)
         else:
-            print(f"Unhandled TelegramBadRequest in safe_edit_text: {e}")
+            logging.warning(f"Unhandled TelegramBadRequest in safe_edit_text: {e}")
 
 
 async def answer_in_private(call: CallbackQuery, bot: Bot, text: str, reply_markup: InlineKeyboardMarkup = None, **kwargs):
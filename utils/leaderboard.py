@@ -0,0 +1,289 @@
+# Copyright (C) 2025 smalllbro42
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import logging
+import random
+import time
+from typing import Dict, List, Optional, Tuple
+
+from db import Database
+
+# === Кэш рейтингов групп ===
+
+class LeaderboardCache:
+    """
+    Рейтинг чата строится из user_totals один раз и живет в памяти ttl секунд.
+    Листание страниц и повторные нажатия читают готовый список, а не базу.
+    Хранится не больше max_entries мест - дальше рейтинг не листается.
+    """
+    def __init__(self, db: Database, ttl: float = 60, max_entries: int = 100):
+        self.db = db
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: Dict[int, Tuple[float, float, List[dict]]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, chat_id: int) -> Tuple[List[dict], float]:
+        """Возвращает (строки рейтинга, unix-время построения)."""
+        now = time.monotonic()
+        cached = self._entries.get(chat_id)
+        if cached and cached[0] > now:
+            self.hits += 1
+            return cached[2], cached[1]
+
+        self.misses += 1
+        rows = [dict(row) for row in self.db.get_group_leaderboard(chat_id, limit=self.max_entries)]
+        built_at = time.time()
+        self._entries[chat_id] = (now + self.ttl, built_at, rows)
+        if len(self._entries) > 1000:
+            self._evict(now)
+        return rows, built_at
+
+    def page(self, chat_id: int, page: int, page_size: int) -> Tuple[List[dict], int, int, float]:
+        """Страница рейтинга: (строки, номер страницы, всего страниц, время построения)."""
+        rows, built_at = self.get(chat_id)
+        pages = max(1, -(-len(rows) // page_size))
+        page = min(max(page, 0), pages - 1)
+        return rows[page * page_size:(page + 1) * page_size], page, pages, built_at
+
+    def invalidate(self, chat_id: int):
+        self._entries.pop(chat_id, None)
+
+    def _evict(self, now: float):
+        for chat_id in [chat_id for chat_id, (expires_at, _, _) in self._entries.items() if expires_at <= now]:
+            del self._entries[chat_id]
+
+
+# === Общий рейтинг: дерево порядковых статистик ===
+
+class _Node:
+    __slots__ = ("key", "priority", "left", "right", "size")
+
+    def __init__(self, key: int):
+        self.key = key
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+        self.size = 1
+
+
+def _size(node: Optional[_Node]) -> int:
+    return node.size if node else 0
+
+
+def _update(node: _Node):
+    node.size = 1 + _size(node.left) + _size(node.right)
+
+
+def _split(node: Optional[_Node], key: int):
+    """Делит дерево на (ключи < key, ключи >= key)."""
+    if node is None:
+        return None, None
+    if node.key < key:
+        left, right = _split(node.right, key)
+        node.right = left
+        _update(node)
+        return node, right
+    left, right = _split(node.left, key)
+    node.left = right
+    _update(node)
+    return left, node
+
+
+def _merge(left: Optional[_Node], right: Optional[_Node]) -> Optional[_Node]:
+    """Склеивает два дерева, все ключи left меньше ключей right."""
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        _update(left)
+        return left
+    right.left = _merge(left, right.left)
+    _update(right)
+    return right
+
+
+class RankTree:
+    """
+    Декартово дерево (treap) с размерами поддеревьев: вставка, удаление,
+    "какое место у ключа" и "какой ключ на месте k" - все за O(log n).
+    Ключи - целые числа, одинаковых ключей в дереве нет.
+    """
+    def __init__(self):
+        self.root: Optional[_Node] = None
+
+    def __len__(self) -> int:
+        return _size(self.root)
+
+    @classmethod
+    def from_sorted(cls, keys: List[int]) -> "RankTree":
+        """Строит дерево из отсортированных ключей за O(n) (декартово дерево через стек)."""
+        tree = cls()
+        stack: List[_Node] = []
+        for key in keys:
+            node = _Node(key)
+            last = None
+            while stack and stack[-1].priority < node.priority:
+                last = stack.pop()
+            node.left = last
+            if stack:
+                stack[-1].right = node
+            stack.append(node)
+        tree.root = stack[0] if stack else None
+
+        # Размеры поддеревьев - обходом в обратном порядке без рекурсии
+        order, pending = [], [tree.root] if tree.root else []
+        while pending:
+            node = pending.pop()
+            order.append(node)
+            pending.extend(child for child in (node.left, node.right) if child)
+        for node in reversed(order):
+            _update(node)
+        return tree
+
+    def insert(self, key: int):
+        left, right = _split(self.root, key)
+        self.root = _merge(_merge(left, _Node(key)), right)
+
+    def remove(self, key: int):
+        left, rest = _split(self.root, key)
+        _, right = _split(rest, key + 1)
+        self.root = _merge(left, right)
+
+    def rank(self, key: int) -> Optional[int]:
+        """Место ключа (с 1) или None, если его нет."""
+        node, less = self.root, 0
+        while node:
+            if key < node.key:
+                node = node.left
+            elif key > node.key:
+                less += _size(node.left) + 1
+                node = node.right
+            else:
+                return less + _size(node.left) + 1
+        return None
+
+    def select(self, position: int) -> Optional[int]:
+        """Ключ на месте position (с 1)."""
+        node = self.root
+        while node:
+            left_size = _size(node.left)
+            if position <= left_size:
+                node = node.left
+            elif position == left_size + 1:
+                return node.key
+            else:
+                position -= left_size + 1
+                node = node.right
+        return None
+
+
+# Ключ дерева: сначала больше стоимость коллекции, при равенстве - меньше user_id
+_SCORE_CAP = 1 << 62
+_USER_MASK = (1 << 64) - 1
+
+
+def _rank_key(user_id: int, total_value: int) -> int:
+    return ((_SCORE_CAP - total_value) << 64) | user_id
+
+
+def _decode_key(key: int) -> Tuple[int, int]:
+    return key & _USER_MASK, _SCORE_CAP - (key >> 64)
+
+
+class GlobalLeaderboard:
+    """
+    Общий рейтинг по стоимости коллекции в памяти процесса.
+    При запуске загружается из user_totals, дальше раз в poll_interval секунд
+    подтягивает только изменившиеся строки (по индексу updated_at).
+    Раз в resync_interval рейтинг перестраивается целиком - так уходят удаленные игроки.
+    """
+    # Запас на транзакции, которые закоммитились позже, чем выставили updated_at
+    LOOKBACK = 5
+
+    def __init__(self, db: Database, poll_interval: float = 5, resync_interval: float = 6 * 3600):
+        self.db = db
+        self.poll_interval = poll_interval
+        self.resync_interval = resync_interval
+        self.tree = RankTree()
+        self.scores: Dict[int, int] = {}
+        self.ready = False
+        self._since = 0
+
+    def __len__(self) -> int:
+        return len(self.tree)
+
+    def _set(self, user_id: int, total_value: int, car_count: int):
+        old_value = self.scores.pop(user_id, None)
+        if old_value is not None:
+            self.tree.remove(_rank_key(user_id, old_value))
+        if car_count > 0:
+            self.scores[user_id] = total_value
+            self.tree.insert(_rank_key(user_id, total_value))
+
+    async def load(self, batch_size: int = 10000):
+        """Полная загрузка пачками по user_id, между пачками цикл событий свободен."""
+        started = int(time.time())
+        scores, last_user_id = {}, 0
+        while True:
+            batch = self.db.get_user_totals_page(last_user_id, batch_size)
+            if not batch:
+                break
+            for row in batch:
+                if row['car_count'] > 0:
+                    scores[row['user_id']] = row['total_value']
+            last_user_id = batch[-1]['user_id']
+            await asyncio.sleep(0)
+        self.tree = RankTree.from_sorted(sorted(_rank_key(user_id, value) for user_id, value in scores.items()))
+        self.scores = scores
+        self._since = started - self.LOOKBACK
+        self.ready = True
+        logging.info(f"Общий рейтинг загружен: {len(scores)} игроков")
+
+    def apply_changes(self):
+        for row in self.db.get_user_totals_changed_since(self._since):
+            self._set(row['user_id'], row['total_value'], row['car_count'])
+            self._since = max(self._since, row['updated_at'] - self.LOOKBACK)
+
+    def rank(self, user_id: int) -> Optional[int]:
+        value = self.scores.get(user_id)
+        return None if value is None else self.tree.rank(_rank_key(user_id, value))
+
+    def around(self, position: int, radius: int) -> List[Tuple[int, int, int]]:
+        """Места position-radius..position+radius: [(место, user_id, стоимость)]."""
+        result = []
+        for place in range(max(1, position - radius), min(len(self.tree), position + radius) + 1):
+            user_id, value = _decode_key(self.tree.select(place))
+            result.append((place, user_id, value))
+        return result
+
+    def top(self, count: int) -> List[Tuple[int, int, int]]:
+        return self.around(1, count - 1)
+
+    async def run(self):
+        """Фоновая задача: загрузка и поддержание рейтинга в актуальном состоянии."""
+        while True:
+            try:
+                await self.load()
+                resync_at = time.monotonic() + self.resync_interval
+                while time.monotonic() < resync_at:
+                    await asyncio.sleep(self.poll_interval)
+                    self.apply_changes()
+            except Exception as e:
+                logging.error(f"Ошибка обновления общего рейтинга: {e}")
+                await asyncio.sleep(self.poll_interval)
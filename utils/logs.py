@@ -0,0 +1,146 @@
+# Copyright (C) 2025 smalllbro42
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+from typing import Dict, Optional
+
+import config
+
+# === Логирование через очередь ===
+
+# Стандартные атрибуты LogRecord - все остальное пришло через extra и попадет в JSON
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName"}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON: время, уровень, логгер, сообщение и поля из extra."""
+    def __init__(self, worker: Optional[int] = None):
+        super().__init__()
+        self.worker = worker
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if self.worker is not None:
+            payload["worker"] = self.worker
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                payload[key] = value
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            payload["exc"] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Прореживает шумные логгеры: из записей ниже WARNING пропускается
+    каждая N-я, где N = 1 / доля из rates. Предупреждения и ошибки проходят всегда.
+    К прошедшей фильтр записи добавляется поле sampled = N.
+    """
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.every = {name: max(1, round(1 / rate)) for name, rate in rates.items() if rate > 0}
+        self.muted = {name for name, rate in rates.items() if rate <= 0}
+        self._seen: Dict[str, int] = {}
+
+    def _rule(self, name: str) -> Optional[str]:
+        # Правило для "aiogram" действует и на "aiogram.event"
+        while name:
+            if name in self.every or name in self.muted:
+                return name
+            name = name.rpartition(".")[0]
+        return None
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rule = self._rule(record.name)
+        if rule is None:
+            return True
+        if rule in self.muted:
+            return False
+        seen = self._seen.get(rule, 0)
+        self._seen[rule] = seen + 1
+        if seen % self.every[rule]:
+            return False
+        if self.every[rule] > 1:
+            record.sampled = self.every[rule]
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Как QueueHandler, но не склеивает трассировку с сообщением - JsonFormatter кладет ее в отдельное поле."""
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging(worker: Optional[int] = None) -> logging.handlers.QueueListener:
+    """
+    Настраивает корневой логгер: в потоке цикла событий запись только
+    кладется в очередь, а форматирование в JSON и вывод в stderr/файл
+    делает отдельный поток QueueListener. Повторный вызов ничего не меняет.
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    if config.LOG_FORMAT == "json":
+        formatter = JsonFormatter(worker)
+    else:
+        prefix = f"[worker {worker}] " if worker is not None else ""
+        formatter = logging.Formatter(prefix + "%(asctime)s %(levelname)s:%(name)s:%(message)s")
+
+    outputs = [logging.StreamHandler(sys.stderr)]
+    if config.LOG_FILE:
+        path = config.LOG_FILE if worker is None else f"{config.LOG_FILE}.w{worker}"
+        outputs.append(logging.handlers.WatchedFileHandler(path, encoding="utf-8"))
+    for handler in outputs:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _QueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(config.LOG_SAMPLING))
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(config.LOG_LEVEL)
+
+    _listener = logging.handlers.QueueListener(log_queue, *outputs, respect_handler_level=True)
+    _listener.start()
+    # При выходе дописываем все, что осталось в очереди
+    atexit.register(_listener.stop)
+    return _listener
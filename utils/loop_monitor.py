@@ -0,0 +1,136 @@
+# Copyright (C) 2025 smalllbro42
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import List, Optional, Tuple
+
+from utils import metrics
+
+# === Контроль задержек цикла событий ===
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _is_project_frame(frame: traceback.FrameSummary) -> bool:
+    path = os.path.abspath(frame.filename)
+    return (path.startswith(PROJECT_ROOT + os.sep)
+            and "site-packages" not in path
+            and f"{os.sep}venv{os.sep}" not in path)
+
+
+def attribute_stack(stack: List[traceback.FrameSummary]) -> Tuple[str, str]:
+    """
+    По стеку зависшего цикла возвращает (источник, место блокировки):
+    источник - ближайший к вершине стека хендлер или фоновая задача из main.py,
+    место - самый глубокий кадр кода проекта (например, db.py:_execute).
+    """
+    project = [f for f in stack if _is_project_frame(f)]
+    if not project:
+        last = stack[-1] if stack else None
+        location = f"{os.path.basename(last.filename)}:{last.name}" if last else "unknown"
+        return "unknown", location
+
+    def label(frame: traceback.FrameSummary) -> str:
+        return f"{os.path.relpath(frame.filename, PROJECT_ROOT)}:{frame.name}"
+
+    source = project[-1]
+    for frame in reversed(project):
+        relpath = os.path.relpath(frame.filename, PROJECT_ROOT)
+        if relpath.startswith("handlers" + os.sep) or relpath == "main.py":
+            source = frame
+            break
+    deepest = project[-1]
+    return label(source), f"{label(deepest)}:{deepest.lineno}"
+
+
+class LoopLagMonitor:
+    """
+    Раз в interval секунд проверяет, насколько позже положенного проснулся
+    цикл событий. Отдельный поток-сторож замечает, что цикл не отвечает дольше
+    threshold_ms, и снимает стек главного потока - так видно, какой хендлер
+    или фоновая задача блокирует цикл (синхронный запрос к БД, pg_dump и т.п.).
+    """
+    def __init__(self, interval: float = 0.1, threshold_ms: float = 250, window: int = 3000):
+        self.interval = interval
+        self.threshold = threshold_ms / 1000
+        self.samples = deque(maxlen=window)
+        self.stalls = deque(maxlen=50)
+        self._loop_thread_id: Optional[int] = None
+        self._last_beat = time.monotonic()
+        self._pending_stack: Optional[List[traceback.FrameSummary]] = None
+        self._stop = threading.Event()
+
+    def percentile(self, q: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def _watch(self):
+        """Поток-сторож: работает, даже когда цикл событий заблокирован."""
+        reported_beat = None
+        while not self._stop.wait(self.threshold / 4):
+            beat = self._last_beat
+            if beat == reported_beat or time.monotonic() - beat < self.threshold:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            reported_beat = beat
+            self._pending_stack = traceback.extract_stack(frame)
+
+    def _report(self, stack: List[traceback.FrameSummary], lag: float):
+        source, location = attribute_stack(stack)
+        metrics.LOOP_STALLS.inc(source=source)
+        self.stalls.append({"at": int(time.time()), "lag_ms": round(lag * 1000, 1), "source": source, "location": location})
+        project_frames = "".join(traceback.format_list([f for f in stack if _is_project_frame(f)] + stack[-1:]))
+        logging.warning(f"Event loop blocked for {lag * 1000:.0f} ms in {source} at {location}\n{project_frames}")
+
+    def _export(self):
+        for q in (0.5, 0.9, 0.99):
+            metrics.LOOP_LAG_QUANTILES.set(self.percentile(q), quantile=str(q))
+        metrics.LOOP_LAG_QUANTILES.set(max(self.samples, default=0.0), quantile="1")
+
+    async def run(self):
+        """Фоновая задача: замер задержки цикла и запуск потока-сторожа."""
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stop.clear()
+        threading.Thread(target=self._watch, name="loop-lag-watchdog", daemon=True).start()
+        last_export = time.monotonic()
+        try:
+            while True:
+                before = time.monotonic()
+                await asyncio.sleep(self.interval)
+                now = time.monotonic()
+                self._last_beat = now
+                lag = max(0.0, now - before - self.interval)
+                self.samples.append(lag)
+                metrics.LOOP_LAG.observe(lag)
+
+                stack, self._pending_stack = self._pending_stack, None
+                if stack:
+                    self._report(stack, lag)
+                if now - last_export >= 10:
+                    self._export()
+                    last_export = now
+        finally:
+            self._stop.set()
@@ -0,0 +1,194 @@
+# Copyright (C) 2025 smalllbro42
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+import bisect
+import logging
+from typing import Dict, Tuple, Optional
+
+from aiohttp import web
+
+# === Простейший реестр метрик в формате Prometheus ===
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels_key(labels: Dict[str, str]) -> Tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key: Tuple, extra: Optional[Tuple] = None) -> str:
+    items = list(key) + ([extra] if extra else [])
+    if not items:
+        return ""
+    parts = []
+    for name, value in items:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{name}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+class Counter:
+    """Монотонно растущий счетчик."""
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _labels_key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(_labels_key(labels), 0)
+
+    def render(self) -> list:
+        return [f"{self.name}{_format_labels(key)} {value}" for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    """Значение, которое может как расти, так и уменьшаться."""
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[_labels_key(labels)] = value
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram:
+    """Гистограмма с фиксированными границами корзин."""
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        # ключ -> [счетчики по корзинам..., +Inf], сумма
+        self._counts: Dict[Tuple, list] = {}
+        self._sums: Dict[Tuple, float] = {}
+
+    def observe(self, value: float, **labels):
+        key = _labels_key(labels)
+        counts = self._counts.get(key)
+        if counts is None:
+            counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+            self._sums[key] = 0.0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[key] += value
+
+    def count(self, **labels) -> int:
+        return sum(self._counts.get(_labels_key(labels), ()))
+
+    def render(self) -> list:
+        lines = []
+        for key, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(key, ('le', bound))} {cumulative}")
+            cumulative += counts[-1]
+            lines.append(f"{self.name}_bucket{_format_labels(key, ('le', '+Inf'))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {self._sums[key]}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            return self._metrics[metric.name]
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self._register(Counter(name, help_text))
+
+    def gauge(self, name: str, help_text: str) -> Gauge:
+        return self._register(Gauge(name, help_text))
+
+    def histogram(self, name: str, help_text: str, buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, buckets))
+
+    def render(self) -> str:
+        """Возвращает все метрики в текстовом формате Prometheus."""
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+# --- Хендлеры ---
+HANDLER_LATENCY = registry.histogram("carcollect_handler_seconds", "Handler execution time")
+HANDLER_ERRORS = registry.counter("carcollect_handler_errors_total", "Unhandled exceptions in handlers")
+HANDLERS_IN_FLIGHT = registry.gauge("carcollect_handlers_in_flight", "Handlers currently running")
+
+# --- База данных ---
+DB_QUERY_LATENCY = registry.histogram("carcollect_db_query_seconds", "Database call time per Database method")
+DB_QUERY_ERRORS = registry.counter("carcollect_db_query_errors_total", "Failed database calls per Database method")
+
+# --- Telegram Bot API ---
+API_CALL_LATENCY = registry.histogram("carcollect_telegram_api_seconds", "Telegram Bot API call time")
+API_CALL_ERRORS = registry.counter("carcollect_telegram_api_errors_total", "Failed Telegram Bot API calls")
+
+# --- Запросы на один апдейт ---
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 50, 100)
+DB_QUERIES_PER_UPDATE = registry.histogram("carcollect_db_queries_per_update", "Database calls made by one handler", QUERY_COUNT_BUCKETS)
+API_CALLS_PER_UPDATE = registry.histogram("carcollect_api_calls_per_update", "Telegram API calls made by one handler", QUERY_COUNT_BUCKETS)
+CALL_BUDGET_EXCEEDED = registry.counter("carcollect_call_budget_exceeded_total", "Handlers that exceeded the per-update call budget")
+
+# --- Резервные копии ---
+BACKUP_LAST_SUCCESS = registry.gauge("carcollect_backup_last_success_timestamp", "Unix time of the last successful backup")
+BACKUP_SIZE = registry.gauge("carcollect_backup_size_bytes", "Size of the last successful backup")
+BACKUP_RESTORE_SECONDS = registry.gauge("carcollect_backup_restore_seconds", "Restore time measured by the last verification")
+BACKUP_VERIFY_OK = registry.gauge("carcollect_backup_verify_ok", "1 if the last restore verification passed")
+
+# --- Цикл событий ---
+LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LOOP_LAG = registry.histogram("carcollect_event_loop_lag_seconds", "Event loop wake-up delay", LOOP_LAG_BUCKETS)
+LOOP_LAG_QUANTILES = registry.gauge("carcollect_event_loop_lag_quantile_seconds", "Event loop lag percentiles over the recent window")
+LOOP_STALLS = registry.counter("carcollect_event_loop_stalls_total", "Event loop blocks longer than the threshold, by handler or task")
+
+# --- Защитные механизмы ---
+CALLBACKS_DEDUPLICATED = registry.counter("carcollect_callbacks_deduplicated_total", "Duplicate callback queries ignored")
+UPDATES_SHED = registry.counter("carcollect_updates_shed_total", "Low-priority updates dropped under load")
+AIRDROP_CLICKS_REJECTED = registry.counter("carcollect_airdrop_clicks_rejected_total", "Airdrop claim clicks rejected without touching the database")
+
+
+# === HTTP-эндпоинт для Prometheus ===
+
+async def _metrics_view(request: web.Request) -> web.Response:
+    return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server(host: str, port: int) -> Optional[web.AppRunner]:
+    """Запускает локальный HTTP-сервер с /metrics. Возвращает runner для остановки."""
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics_view)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Metrics server listening on http://{host}:{port}/metrics")
+    return runner
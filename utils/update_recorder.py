@@ -0,0 +1,120 @@
+# Copyright (C) 2025 smalllbro42
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import time
+from typing import Any, Optional
+
+from aiogram.types import Update
+
+# === Запись входящих апдейтов для последующего воспроизведения (benchmarks/replay.py) ===
+
+# Поля с id пользователей и чатов - заменяются стабильным псевдонимом
+ID_KEYS = {"id", "user_id", "chat_id", "sender_chat_id", "migrate_to_chat_id", "migrate_from_chat_id"}
+# Поля с именами и прочими личными данными - заменяются заглушкой
+NAME_KEYS = {"first_name", "last_name", "username", "title", "bio", "phone_number", "invite_link"}
+# Свободный текст: команды сохраняются, остальное - только длина
+TEXT_KEYS = {"text", "caption"}
+# Строковые идентификаторы, которые тоже не должны попадать в запись как есть
+HASH_KEYS = {"chat_instance", "telegram_payment_charge_id", "provider_payment_charge_id", "file_id", "file_unique_id"}
+
+
+class UpdateRecorder:
+    """
+    Пишет апдейты в gzip JSONL: одна строка = {"t": unix-время, "update": {...}}.
+    Все id пользователей и чатов заменяются псевдонимами (HMAC от id), так что
+    один и тот же игрок в записи всегда под одним id, но настоящий id не восстановить.
+    Запись идет в памяти, на диск буфер сбрасывается фоновой задачей.
+    """
+    def __init__(self, directory: str, salt: Optional[str] = None, flush_interval: float = 5.0, suffix: str = ""):
+        self.directory = directory
+        self.suffix = suffix
+        self.flush_interval = flush_interval
+        # Без заданной соли псевдонимы меняются при каждом перезапуске бота
+        self._salt = (salt or os.urandom(16).hex()).encode()
+        self._buffer: list = []
+        self.recorded = 0
+
+    def current_path(self) -> str:
+        return os.path.join(self.directory, f"updates-{time.strftime('%Y%m%d')}{self.suffix}.jsonl.gz")
+
+    def _pseudonym(self, value: int) -> int:
+        digest = hmac.new(self._salt, str(abs(value)).encode(), hashlib.sha256).digest()
+        alias = 10 ** 12 + int.from_bytes(digest[:6], "big") % 10 ** 12
+        # Знак сохраняется: отрицательные id - группы и каналы
+        return -alias if value < 0 else alias
+
+    def _scrub_text(self, text: str) -> str:
+        if not text.startswith("/"):
+            return "x" * min(len(text), 64)
+        command, _, args = text.partition(" ")
+        # /start <id пригласившего> - единственная команда, чей аргумент нужен для воспроизведения
+        if args.lstrip("-").isdigit():
+            return f"{command} {self._pseudonym(int(args))}"
+        return command if not args else f"{command} {'x' * min(len(args), 64)}"
+
+    def anonymize(self, value: Any, key: Optional[str] = None) -> Any:
+        if isinstance(value, dict):
+            return {k: self.anonymize(v, k) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self.anonymize(item, key) for item in value]
+        if key in ID_KEYS and isinstance(value, int) and not isinstance(value, bool):
+            return self._pseudonym(value)
+        if isinstance(value, str):
+            if key in NAME_KEYS:
+                return key
+            if key in TEXT_KEYS:
+                return self._scrub_text(value)
+            if key in HASH_KEYS:
+                return hmac.new(self._salt, value.encode(), hashlib.sha256).hexdigest()[:16]
+        return value
+
+    def record(self, update: Update):
+        payload = update.model_dump(mode="json", exclude_none=True, by_alias=True)
+        line = json.dumps({"t": round(time.time(), 3), "update": self.anonymize(payload)},
+                          ensure_ascii=False, separators=(",", ":"))
+        self._buffer.append(line)
+        self.recorded += 1
+
+    def _write(self, lines: list):
+        os.makedirs(self.directory, exist_ok=True)
+        with gzip.open(self.current_path(), "at", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        lines, self._buffer = self._buffer, []
+        try:
+            await asyncio.to_thread(self._write, lines)
+        except OSError as e:
+            logging.error(f"Не удалось записать {len(lines)} апдейтов: {e}")
+
+    async def run(self):
+        """Фоновая задача: периодически сбрасывает буфер на диск."""
+        logging.info(f"Запись апдейтов включена: {self.directory}")
+        try:
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                await self.flush()
+        finally:
+            if self._buffer:
+                self._write(self._buffer)
+                self._buffer = []
@@ -0,0 +1,54 @@
+# Copyright (C) 2025 smalllbro42
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import logging
+from typing import Any
+
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+
+# === Прием апдейтов через вебхук ===
+
+class DrainingRequestHandler(SimpleRequestHandler):
+    """
+    Обработчик вебхука с корректной остановкой: после начала остановки новые
+    апдейты получают 503 (Telegram пришлет их повторно), а уже принятые
+    дорабатываются в течение drain_timeout секунд, и только потом закрывается сессия бота.
+    """
+    def __init__(self, *args: Any, drain_timeout: float = 30, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.drain_timeout = drain_timeout
+        self.draining = False
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._background_feed_update_tasks)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.draining:
+            return web.Response(status=503, text="Shutting down")
+        return await super().handle(request)
+
+    async def close(self) -> None:
+        self.draining = True
+        tasks = set(self._background_feed_update_tasks)
+        if tasks:
+            logging.info(f"Вебхук: дожидаемся {len(tasks)} апдейтов (не дольше {self.drain_timeout} с)...")
+            done, pending = await asyncio.wait(tasks, timeout=self.drain_timeout)
+            if pending:
+                logging.warning(f"Вебхук: {len(pending)} апдейтов не успели обработаться и будут прерваны")
+                for task in pending:
+                    task.cancel()
+        await super().close()